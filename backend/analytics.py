@@ -0,0 +1,325 @@
+"""
+Daily rollups per store and per product: orders, units sold, revenue, days to expiry at
+purchase, and how many of the bought units were eaten or went off in a fridge. They are
+kept up to date by the events themselves (checkout webhook, consume, the scheduler's day
+rollover), so the analytics endpoints read at most one row per day in the range and never
+scan carts or fridge items. `python analytics.py backfill` rebuilds past days from scratch.
+
+An item counts as consumed when it is consumed on or before its best before date and as
+expired when that date passes while it is still in the fridge (or it is consumed later).
+Items removed before that date and items added by hand count for neither.
+"""
+import argparse
+import logging
+import os
+from collections import Counter, defaultdict
+from datetime import date, datetime, time, timedelta
+from itertools import groupby
+
+from flask import Blueprint, request, jsonify
+
+from models import db, utc_today, Cart, CartItem, CartItemLot, FridgeItem, Product, ProductLot, ProductDailyStats, StoreDailyStats, \
+    dialect_insert
+from model_functions import split_by_lot
+from db_routing import read_only
+from serializers import render
+from store import store_employee_required
+from products import admin_required
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ('orders', 'units_sold', 'revenue', 'expiry_days_total', 'items_consumed', 'items_expired')
+DEFAULT_RANGE_DAYS = 30
+MAX_RANGE_DAYS = 366
+WRITE_CHUNK_SIZE = int(os.getenv("ANALYTICS_WRITE_CHUNK_SIZE", 1000))    # rollup rows per statement
+READ_CHUNK_SIZE = int(os.getenv("ANALYTICS_READ_CHUNK_SIZE", 5000))      # source rows fetched per batch
+
+analytics_bp = Blueprint('analytics', __name__)
+
+
+class Rollup:
+    """
+    Counter increments for many (store, product, day) keys, written to both rollup tables
+    with one statement per chunk of rows.
+    """
+    def __init__(self):
+        self.stores = defaultdict(Counter)      # (store_id, day) -> counters
+        self.products = defaultdict(Counter)    # (product_id, day) -> counters
+        self.product_stores = {}
+
+    def add(self, store_id, product_id, day, **counters):
+        self.add_store(store_id, day, **counters)
+        if product_id:
+            self.add_product(product_id, store_id, day, **counters)
+
+    def add_store(self, store_id, day, **counters):
+        self.stores[(store_id, day)].update(counters)
+
+    def add_product(self, product_id, store_id, day, **counters):
+        self.products[(product_id, day)].update(counters)
+        self.product_stores[product_id] = store_id
+
+    def write(self, replace=False):
+        """
+        Adds the counters to the stored rows, creating missing ones. With replace the rows must
+        not exist yet (backfill deletes them first). Does not commit.
+        """
+        _write(StoreDailyStats, ('store_id', 'day'), [
+            {'store_id': store_id, 'day': day, **_counters(counters)}
+            for (store_id, day), counters in self.stores.items()], replace)
+        _write(ProductDailyStats, ('product_id', 'day'), [
+            {'product_id': product_id, 'day': day, 'store_id': self.product_stores[product_id], **_counters(counters)}
+            for (product_id, day), counters in self.products.items()], replace)
+
+
+def _counters(counters):
+    return {name: counters.get(name, 0) for name in COUNTERS}
+
+
+def _write(model, keys, rows, replace):
+    if not rows:
+        return
+    if replace:
+        stmt = db.insert(model)
+    else:
+        insert = dialect_insert(model)
+        stmt = insert.on_conflict_do_update(
+            index_elements=[getattr(model, key) for key in keys],
+            set_={name: getattr(model, name) + getattr(insert.excluded, name) for name in COUNTERS})
+    for i in range(0, len(rows), WRITE_CHUNK_SIZE):
+        db.session.execute(stmt, rows[i:i + WRITE_CHUNK_SIZE])
+
+
+def _add_sale(rollup, lines, day):
+    # lines: (product_id, store_id, price, quantity, best_before_date) of one cart, one per lot
+    for product_id, store_id, price, quantity, bbd in lines:
+        rollup.add(store_id, product_id, day, units_sold=quantity, revenue=price * quantity,
+                   expiry_days_total=quantity * (bbd - day).days if bbd else 0)
+    for product_id, store_id in {line[:2] for line in lines}:
+        rollup.add_product(product_id, store_id, day, orders=1)
+    for store_id in {line[1] for line in lines}:
+        rollup.add_store(store_id, day, orders=1)
+
+
+def record_sale(lines, day=None):
+    """
+    Counts a paid cart, given its model_functions.cart_lines(). Does not commit.
+    """
+    rollup = Rollup()
+    _add_sale(rollup, [(product_id, store_id, price, quantity, bbd)
+                       for user_id, product_id, store_id, name, price, quantity, lot_id, bbd in lines],
+              day or utc_today())
+    rollup.write()
+
+
+def record_consumed(item, day=None):
+    """
+    Counts a fridge item that was just consumed. Does not commit.
+    """
+    day = day or utc_today()
+    if item.store_id is None or item.best_before_date < day:
+        return  # added by hand, or already counted as expired
+    rollup = Rollup()
+    rollup.add(item.store_id, item.product_id, day, items_consumed=item.quantity or 1)
+    rollup.write()
+
+
+def _add_expired(rollup, start, end):
+    """
+    Bought items whose best before date is in [start, end) and that were not consumed by then.
+    """
+    rows = db.session.query(FridgeItem.product_id, FridgeItem.store_id, FridgeItem.best_before_date,
+                            FridgeItem.quantity, FridgeItem.status, FridgeItem.consumed_at) \
+        .filter(FridgeItem.store_id.isnot(None),
+                FridgeItem.best_before_date >= start, FridgeItem.best_before_date < end,
+                db.or_(FridgeItem.status == 'active',
+                       db.and_(FridgeItem.status == 'consumed', FridgeItem.consumed_at >= datetime.combine(start, time.min)))) \
+        .execution_options(yield_per=READ_CHUNK_SIZE)
+    for product_id, store_id, bbd, quantity, status, consumed_at in rows:
+        if status == 'active' or consumed_at.date() > bbd:
+            rollup.add(store_id, product_id, bbd, items_expired=quantity or 1)
+
+
+def record_expired(start, end):
+    """
+    Counts the items that expired on the days start..end-1, called once per day by the
+    scheduler in the same transaction that moves its state on. Returns the units counted.
+    Does not commit.
+    """
+    rollup = Rollup()
+    _add_expired(rollup, start, end)
+    rollup.write()
+    return sum(counters['items_expired'] for counters in rollup.stores.values())
+
+
+def backfill(start, end, today=None):
+    """
+    Rebuilds the rollups of the days start..end from carts and fridge items, replacing what is
+    stored for them. Meant for days that are over, live events for them would be lost.
+    Items removed from fridges are gone and can't be counted again. Commits.
+    """
+    today = today or utc_today()
+    after = end + timedelta(days=1)
+    rollup = Rollup()
+
+    paid_at = db.func.coalesce(Cart.payed_at, Cart.created_at)
+    lines = db.session.query(Cart.cart_id, paid_at, CartItem.cart_item_id, CartItem.quantity, CartItemLot.quantity,
+                             Product.product_id, Product.store_id, Product.price,
+                             CartItemLot.lot_id, ProductLot.best_before_date, Product.best_before_date) \
+        .join(CartItem, CartItem.cart_id == Cart.cart_id) \
+        .join(Product, Product.product_id == CartItem.product_id) \
+        .outerjoin(CartItemLot, CartItemLot.cart_item_id == CartItem.cart_item_id) \
+        .outerjoin(ProductLot, ProductLot.lot_id == CartItemLot.lot_id) \
+        .filter(Cart.payed == True, paid_at >= datetime.combine(start, time.min), paid_at < datetime.combine(after, time.min)) \
+        .order_by(Cart.cart_id, CartItem.cart_item_id).execution_options(yield_per=READ_CHUNK_SIZE)
+    for _, cart in groupby(lines, key=lambda line: line[0]):
+        cart = list(cart)
+        _add_sale(rollup, [(product_id, store_id, price, quantity, bbd) for product_id, store_id, price, quantity, lot_id, bbd
+                           in split_by_lot(line[2:] for line in cart)],
+                  _as_date(cart[0][1]))
+
+    consumed = db.session.query(FridgeItem.product_id, FridgeItem.store_id, FridgeItem.best_before_date,
+                                FridgeItem.quantity, FridgeItem.consumed_at) \
+        .filter(FridgeItem.store_id.isnot(None), FridgeItem.status == 'consumed',
+                FridgeItem.consumed_at >= datetime.combine(start, time.min),
+                FridgeItem.consumed_at < datetime.combine(after, time.min)) \
+        .execution_options(yield_per=READ_CHUNK_SIZE)
+    for product_id, store_id, bbd, quantity, consumed_at in consumed:
+        if consumed_at.date() <= bbd:
+            rollup.add(store_id, product_id, consumed_at.date(), items_consumed=quantity or 1)
+
+    _add_expired(rollup, start, min(after, today))
+
+    StoreDailyStats.query.filter(StoreDailyStats.day >= start, StoreDailyStats.day <= end).delete(synchronize_session=False)
+    ProductDailyStats.query.filter(ProductDailyStats.day >= start, ProductDailyStats.day <= end).delete(synchronize_session=False)
+    rollup.write(replace=True)
+    db.session.commit()
+    return {'store_days': len(rollup.stores), 'product_days': len(rollup.products)}
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _summary(counters):
+    summary = _counters(counters)
+    summary['revenue'] = round(summary['revenue'], 2)
+    summary['avg_days_to_expiry'] = round(summary['expiry_days_total'] / summary['units_sold'], 2) \
+        if summary['units_sold'] else None
+    outcomes = summary['items_consumed'] + summary['items_expired']
+    summary['waste_rate'] = round(summary['items_expired'] / outcomes, 4) if outcomes else None
+    return summary
+
+
+def _day_range(data):
+    """
+    (start, end) from 'from' / 'to' ISO dates, the last DEFAULT_RANGE_DAYS days by default.
+    Raises ValueError for bad dates or ranges.
+    """
+    end = date.fromisoformat(data['to']) if data.get('to') else utc_today()
+    start = date.fromisoformat(data['from']) if data.get('from') else end - timedelta(days=DEFAULT_RANGE_DAYS - 1)
+    if start > end or (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'from must not be after to, and the range at most {MAX_RANGE_DAYS} days')
+    return start, end
+
+
+def _sums(model):
+    return [db.func.coalesce(db.func.sum(getattr(model, name)), 0).label(name) for name in COUNTERS]
+
+
+@analytics_bp.route('/stores/<store_id>', methods=['GET'])
+@read_only
+@store_employee_required
+def store_stats(store_id):
+    """
+    Totals and one entry per day with activity for ?from= .. ?to= (ISO dates).
+    """
+    try:
+        start, end = _day_range(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    rows = StoreDailyStats.query.filter(StoreDailyStats.store_id == store_id,
+                                        StoreDailyStats.day >= start, StoreDailyStats.day <= end) \
+        .order_by(StoreDailyStats.day).all()
+    totals = Counter()
+    days = []
+    for row in rows:
+        counters = {name: getattr(row, name) for name in COUNTERS}
+        totals.update(counters)
+        days.append({'day': row.day.isoformat(), **_summary(counters)})
+    return render({'store_id': store_id, 'from': start.isoformat(), 'to': end.isoformat(),
+                   'totals': _summary(totals), 'days': days})
+
+
+@analytics_bp.route('/stores/<store_id>/products', methods=['GET'])
+@read_only
+@store_employee_required
+def product_stats(store_id):
+    """
+    Per-product totals for ?from= .. ?to=, best first by ?order= (units_sold, revenue,
+    items_consumed or items_expired), at most ?limit= products.
+    """
+    try:
+        start, end = _day_range(request.args)
+        limit = min(int(request.args.get('limit', 50)), 200)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    order = request.args.get('order', 'units_sold')
+    if order not in ('units_sold', 'revenue', 'items_consumed', 'items_expired'):
+        return jsonify({'error': 'invalid order'}), 400
+    sums = _sums(ProductDailyStats)
+    rows = db.session.query(ProductDailyStats.product_id, Product.product_name, *sums) \
+        .outerjoin(Product, Product.product_id == ProductDailyStats.product_id) \
+        .filter(ProductDailyStats.store_id == store_id,
+                ProductDailyStats.day >= start, ProductDailyStats.day <= end) \
+        .group_by(ProductDailyStats.product_id, Product.product_name) \
+        .order_by(db.desc(order), ProductDailyStats.product_id).limit(limit).all()
+    return render({'store_id': store_id, 'from': start.isoformat(), 'to': end.isoformat(), 'products': [
+        {'product_id': row.product_id, 'product_name': row.product_name,
+         **_summary({name: getattr(row, name) for name in COUNTERS})} for row in rows]})
+
+
+@analytics_bp.route('/aggregate', methods=['POST'])
+@read_only
+@admin_required
+def aggregate():
+    """
+    Anonymized totals over all stores for {"from": ..., "to": ...}, with the number of stores
+    that had activity. No per-store figures.
+    """
+    try:
+        start, end = _day_range(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    row = db.session.query(db.func.count(db.distinct(StoreDailyStats.store_id)).label('stores'),
+                           *_sums(StoreDailyStats)) \
+        .filter(StoreDailyStats.day >= start, StoreDailyStats.day <= end).one()
+    return render({'from': start.isoformat(), 'to': end.isoformat(), 'stores': row.stores,
+                   'totals': _summary({name: getattr(row, name) for name in COUNTERS})})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreshReminder analytics rollups")
+    sub = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = sub.add_parser('backfill', help="rebuild the rollups of past days")
+    backfill_parser.add_argument('--from', dest='start', type=date.fromisoformat, required=True)
+    backfill_parser.add_argument('--to', dest='end', type=date.fromisoformat,
+                                 default=utc_today() - timedelta(days=1), help="default yesterday")
+    backfill_parser.add_argument('--chunk-days', type=int, default=31, help="days rebuilt per transaction")
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app(reset_db=False)
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        start = args.start
+        while start <= args.end:
+            end = min(start + timedelta(days=args.chunk_days - 1), args.end)
+            logger.info("Backfilled %s .. %s: %s", start, end, backfill(start, end))
+            start = end + timedelta(days=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,27 @@ from flask import Flask, jsonify
 import os
 from models import db
 from extensions import login_manager
+from search import init_search
+from metrics import init_metrics
+from db_schema import ensure_schema
+from db_routing import database_config
 
 
-def create_app():
+def create_app(reset_db=None):
+    """
+    reset_db drops and recreates all tables. It defaults to on, except with APP_MODE=production,
+    where the schema is checked against schema_version instead (see db_schema.py).
+    """
     app = Flask(__name__)
     app.config.from_mapping(
         SECRET_KEY=os.environ.get('SECRET_KEY', 'dev'),
-        SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', 'sqlite:///freshreminder.db'),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        APP_MODE=os.environ.get('APP_MODE', 'development'),
+        **database_config(),
     )
     login_manager.init_app(app)
     db.init_app(app)
+    init_metrics(app)
 
     from auth import auth_bp
     from products import products_bp
@@ -21,14 +31,16 @@ def create_app():
     from checkout import checkout_bp
     from payment import payment_bp
     from store import store_bp
+    from analytics import analytics_bp
 
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(products_bp, url_prefix='/products')
     app.register_blueprint(cart_bp, url_prefix='/cart')
     app.register_blueprint(fridge_bp, url_prefix='/fridge')
     app.register_blueprint(store_bp, url_prefix='/store')
-    app.register_blueprint(payment_bp, url_prefix='/payment')
     app.register_blueprint(checkout_bp, url_prefix='/checkout')
+    app.register_blueprint(payment_bp, url_prefix='/payment')
+    app.register_blueprint(analytics_bp, url_prefix='/analytics')
 
     @app.route('/')
     def index():
@@ -38,10 +50,13 @@ def create_app():
     def health():
         return jsonify({'service': 'FreshReminder Backend', 'status': 'ok'})
 
+    if reset_db is None:
+        reset_db = app.config['APP_MODE'] != 'production'
+
     # Ensure DB tables exist
     with app.app_context():
-        db.drop_all()  # For development, drop existing tables to reset state
-        db.create_all()
+        ensure_schema(reset=reset_db)  # For development, drop existing tables to reset state
+        init_search()
 
     return app
 
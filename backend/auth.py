@@ -1,7 +1,7 @@
 from flask import Blueprint, request, jsonify
-from models import db, User, seed_default_items_for_user
+from models import db, User, gen_uuid, seed_default_items_for_user
 from werkzeug.security import generate_password_hash
-from extensions import login_manager, login_required, login_user
+from extensions import login_manager, login_required, login_user, bearer_token, resolve_user, invalidate_token
 
 auth_bp = Blueprint('auth', __name__)
 # wtf what is this 
@@ -55,22 +55,30 @@ def verify_2fa():
 
 @auth_bp.route('/refresh-token', methods=['POST'])
 def refresh_token():
-    return jsonify({'access_token': 'refreshed-fake-token'})
+    token = bearer_token(request)
+    user = User.query.filter_by(token=token).first() if token else None
+    if not user:
+        return jsonify({'error': 'invalid token'}), 401
+    user.token = generate_password_hash(user.email + gen_uuid())
+    db.session.commit()
+    invalidate_token(token)
+    return jsonify({'access_token': user.token})
 
 
 @auth_bp.route('/logout', methods=['POST'])
 def logout():
+    token = bearer_token(request)
+    if token:
+        User.query.filter_by(token=token).update({User.token: None}, synchronize_session=False)
+        db.session.commit()
+        invalidate_token(token)
     return jsonify({'logged_out': True})
 
 
 @auth_bp.route('/me', methods=['GET'])
 def me():
     # Simple implementation: read token from header and lookup user
-    auth = request.headers.get('Authorization')
-    if not auth:
-        return jsonify({'user': None})
-    token = auth.replace('Bearer ', '')
-    user = User.query.filter_by(token=token).first()
+    user = resolve_user(bearer_token(request))
     if not user:
         return jsonify({'user': None})
     return jsonify({'user_id': user.user_id, 'email': user.email})
@@ -0,0 +1,86 @@
+"""
+Sweeping abandoned carts: rows reclaimed, total time and the longest single transaction
+(how long locks are held) by chunk size. Exits non-zero if anything unpaid and expired is left
+or the stock held by the swept carts isn't back on its lot.
+
+    python benchmarks/bench_cart_sweep.py --carts 20000 --chunks 100,500,2000
+"""
+import argparse
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event
+
+from common import make_app
+from models import db, Cart, CartItem, CartItemLot, Product, ProductLot, gen_uuid
+import model_functions
+from model_functions import expired_carts, sweep_expired_carts
+
+STOCK = 10 ** 9
+
+
+def seed(carts, lines):
+    db.session.add(Product(product_id='bench-product', store_id='bench', product_name='Milk', price=1.0,
+                           best_before_date=datetime.utcnow() + timedelta(days=7)))
+    db.session.add(ProductLot(lot_id='bench-lot', product_id='bench-product', store_id='bench', lot_number='A',
+                              best_before_date=date.today() + timedelta(days=7), quantity_available=STOCK))
+    expired = datetime.utcnow() - timedelta(hours=1)
+    for start in range(0, carts, 5000):
+        rows = [{'cart_id': gen_uuid(), 'user_id': 'bench-user', 'expires_at': expired, 'payed': False}
+                for _ in range(start, min(start + 5000, carts))]
+        db.session.execute(db.insert(Cart), rows)
+        items = [{'cart_item_id': gen_uuid(), 'cart_id': row['cart_id'], 'product_id': 'bench-product', 'quantity': 1}
+                 for row in rows for _ in range(lines)]
+        db.session.execute(db.insert(CartItem), items)
+        db.session.execute(db.insert(CartItemLot), [
+            {'cart_item_id': item['cart_item_id'], 'lot_id': 'bench-lot', 'quantity': 1} for item in items])
+    # What the carts hold was taken off the lot when they were filled
+    ProductLot.query.filter_by(lot_id='bench-lot').update({ProductLot.quantity_available: STOCK - carts * lines})
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--carts', type=int, default=20000)
+    parser.add_argument('--lines', type=int, default=1, help="items per cart (all on one lot)")
+    parser.add_argument('--chunks', default='100,500,2000')
+    args = parser.parse_args()
+
+    print(f"{'chunk':>6} {'carts':>8} {'items':>8} {'seconds':>8} {'longest tx ms':>14}")
+    ok = True
+    for chunk_size in [int(c) for c in args.chunks.split(',')]:
+        app = make_app()
+        with app.app_context():
+            seed(args.carts, args.lines)
+            transactions = []
+            started = [None]
+
+            def begin(conn):
+                started[0] = time.perf_counter()
+
+            def commit(conn):
+                if started[0] is not None:
+                    transactions.append(time.perf_counter() - started[0])
+                    started[0] = None
+
+            event.listen(db.engine, 'begin', begin)
+            event.listen(db.engine, 'commit', commit)
+            start = time.perf_counter()
+            report = sweep_expired_carts(chunk_size=chunk_size)
+            seconds = time.perf_counter() - start
+            event.remove(db.engine, 'begin', begin)
+            event.remove(db.engine, 'commit', commit)
+
+            left = Cart.query.filter(expired_carts(datetime.utcnow())).count()
+            stock = ProductLot.query.get('bench-lot').quantity_available
+            ok &= left == 0 and stock == STOCK and CartItem.query.count() == 0 and CartItemLot.query.count() == 0
+            print(f"{chunk_size:>6} {report['carts']:>8} {report['items']:>8} {seconds:>8.2f} "
+                  f"{max(transactions) * 1000:>14.1f}")
+    print(f"chunk size in production: CART_SWEEP_CHUNK_SIZE={model_functions.CART_SWEEP_CHUNK_SIZE}")
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
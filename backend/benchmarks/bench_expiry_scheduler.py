@@ -0,0 +1,61 @@
+"""
+Cost of one steady-state expiry scheduler tick as the number of fridge items grows,
+and of the ticks after it on the same day, which only look for items without a notification.
+
+    python benchmarks/bench_expiry_scheduler.py --sizes 10000,100000,1000000
+"""
+import argparse
+import random
+import tracemalloc
+from datetime import date, timedelta
+
+from common import make_app, measure
+from models import db, FridgeItem, SchedulerState, User, gen_uuid
+import scheduler
+
+
+def seed(total, users, today):
+    user_ids = [gen_uuid() for _ in range(users)]
+    db.session.execute(db.insert(User), [
+        {'user_id': u, 'email': f'{u}@bench.local', 'password_hash': 'x'} for u in user_ids
+    ])
+    for start in range(0, total, 10000):
+        db.session.execute(db.insert(FridgeItem), [{
+            'user_id': random.choice(user_ids),
+            'product_name': f'Product {i}',
+            'best_before_date': today + timedelta(days=random.randint(-30, 365)),
+            'status': 'active' if random.random() < 0.8 else 'consumed',
+        } for i in range(start, min(start + 10000, total))])
+    # Yesterday's tick has already run, so this is a normal daily tick
+    db.session.add(SchedulerState(name=scheduler.STATE_NAME, last_run_date=today - timedelta(days=1)))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--items-per-user', type=int, default=50)
+    args = parser.parse_args()
+
+    today = date.today()
+    while today.weekday() != scheduler.SUMMARY_WEEKDAY:  # include the weekly summary in the tick
+        today += timedelta(days=1)
+
+    print(f"{'items':>10} {'seconds':>9} {'statements':>10} {'notifications':>13} {'peak MiB':>9} {'recheck s':>10}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        app = make_app()
+        with app.app_context():
+            seed(size, max(1, size // args.items_per_user), today)
+            tracemalloc.start()
+            with measure() as m:
+                result = scheduler.tick(today)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with measure() as again:
+                scheduler.tick(today)
+            print(f"{size:>10} {m['seconds']:>9.3f} {m['statements']:>10} "
+                  f"{sum(result.values()):>13} {peak / 2**20:>9.1f} {again['seconds']:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
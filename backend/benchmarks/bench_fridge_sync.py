@@ -0,0 +1,103 @@
+"""
+Bytes and SQL statements per app open: paging through the whole fridge (GET /fridge/date)
+against asking for the changes since the previous open (GET /fridge/changes?since=).
+Between opens a few items are added, consumed and removed. Exits non-zero if the synced
+copy ends up different from the fridge.
+
+    python benchmarks/bench_fridge_sync.py --items 500 --opens 20 --changes 3
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from load_test import stub_external_services
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=500)
+    parser.add_argument('--opens', type=int, default=20)
+    parser.add_argument('--changes', type=int, default=3, help="fridge changes between two app opens")
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-sync-'), 'sync.db')
+    stub_external_services()
+
+    from sqlalchemy import event
+    from app import create_app
+    from models import db
+    app = create_app()
+    statements = [0]
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *a: statements.__setitem__(0, statements[0] + 1))
+
+    client = app.test_client()
+    registered = client.post('/auth/register', json={'email': 'sync@bench.local', 'password': 'pw'}).get_json()
+    headers = {'Authorization': f"Bearer {registered['access_token']}"}
+
+    def add_item():
+        bbd = date.today() + timedelta(days=random.randint(0, 30))
+        return client.post('/fridge/add', headers=headers, json={
+            'product_name': f'Item {random.randint(0, 10 ** 6)}', 'best_before_date': bbd.isoformat()}).get_json()['item']
+
+    for _ in range(args.items):
+        add_item()
+
+    def full_fetch():
+        items, cursor, size = {}, None, 0
+        while True:
+            response = client.get('/fridge/date?limit=200' + (f'&cursor={cursor}' if cursor else ''), headers=headers)
+            size += len(response.data)
+            body = response.get_json()
+            items.update((item['fridge_item_id'], item) for item in body['items'])
+            cursor = body['next_cursor']
+            if not cursor:
+                return items, size
+
+    synced, version = {}, None
+
+    def delta_fetch():
+        nonlocal version
+        response = client.get('/fridge/changes' + (f'?since={version}' if version is not None else ''), headers=headers)
+        body = response.get_json()
+        if body['resync']:
+            synced.clear()
+        for item in body['upserts']:
+            if item['status'] == 'active':
+                synced[item['fridge_item_id']] = item
+            else:
+                synced.pop(item['fridge_item_id'], None)
+        for fridge_item_id in body['tombstones']:
+            synced.pop(fridge_item_id, None)
+        version = body['version']
+        return len(response.data)
+
+    delta_fetch()  # the app's first sync is a full one
+    totals = {'full': [0, 0], 'delta': [0, 0]}
+    for _ in range(args.opens):
+        for _ in range(args.changes):
+            ids = list(synced) or [add_item()['fridge_item_id']]
+            action = random.choice(['add', 'consume', 'remove'])
+            if action == 'add':
+                add_item()
+            else:
+                client.post(f'/fridge/{action}/{random.choice(ids)}', headers=headers)
+        for name, fetch in (('full', lambda: full_fetch()[1]), ('delta', delta_fetch)):
+            statements[0] = 0
+            totals[name][0] += fetch()
+            totals[name][1] += statements[0]
+
+    for name, (size, count) in totals.items():
+        print(f"{name:<6} {size / args.opens / 1024:>9.1f} KiB per open {count / args.opens:>7.1f} statements per open")
+    ok = full_fetch()[0] == synced
+    print("OK" if ok else "FAILED: synced copy differs from the fridge")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
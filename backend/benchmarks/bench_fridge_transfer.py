@@ -0,0 +1,54 @@
+"""
+SQL statements and time for moving a paid cart into the fridge, by cart size.
+The statement count should not change with the number of cart lines.
+
+    python benchmarks/bench_fridge_transfer.py --sizes 1,10,60,500
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from common import make_app, measure
+from models import db, Cart, CartItem, FridgeItem, Product, User, gen_uuid
+from model_functions import transfer_cart_to_fridge
+
+
+def seed_cart(lines):
+    user_id, cart_id = gen_uuid(), gen_uuid()
+    db.session.add(User(user_id=user_id, email=f'{user_id}@bench.local', password_hash='x'))
+    db.session.add(Cart(cart_id=cart_id, user_id=user_id))
+    for i in range(lines):
+        product = Product(store_id='bench', product_name=f'Product {i}', price=1.0,
+                          best_before_date=datetime.utcnow() + timedelta(days=i % 30))
+        db.session.add(product)
+        db.session.flush()
+        db.session.add(CartItem(cart_id=cart_id, product_id=product.product_id, quantity=1))
+    db.session.commit()
+    return cart_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1,10,60,500')
+    args = parser.parse_args()
+
+    app = make_app()
+    print(f"{'lines':>6} {'statements':>10} {'ms':>8} {'fridge items':>12}")
+    statements = set()
+    with app.app_context():
+        for size in [int(s) for s in args.sizes.split(',')]:
+            cart_id = seed_cart(size)
+            with measure() as m:
+                moved = transfer_cart_to_fridge(cart_id)
+                db.session.commit()
+            statements.add(m['statements'])
+            print(f"{size:>6} {m['statements']:>10} {m['seconds'] * 1000:>8.2f} {moved:>12}")
+        print(f"total fridge items: {FridgeItem.query.count()}")
+
+    ok = len(statements) == 1
+    print("OK" if ok else "FAILED: statement count depends on the number of cart lines")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
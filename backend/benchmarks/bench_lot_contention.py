@@ -0,0 +1,94 @@
+"""
+Many shoppers adding the same hot product at once. Stock sits in a few lots with different
+expiry dates; every shopper keeps buying one unit per cart until the shelf is empty.
+Checks that exactly the stocked quantity was sold, no lot went negative and every lot was
+sold out, and reports adds per second. Exits non-zero on oversell or undersell.
+
+    python benchmarks/bench_lot_contention.py --shoppers 32 --lots 3 --stock 200
+    DATABASE_URL=postgresql://localhost/freshreminder_bench python benchmarks/bench_lot_contention.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from load_test import stub_external_services
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shoppers', type=int, default=32)
+    parser.add_argument('--lots', type=int, default=3)
+    parser.add_argument('--stock', type=int, default=200, help='units per lot')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-lots-'), 'lots.db')
+    stub_external_services()
+
+    from app import create_app
+    from models import db, CartItem, CartItemLot, Product, ProductLot, User
+    app = create_app()
+    with app.app_context():
+        db.session.add(Product(product_id='hot', store_id='bench-store', product_name='Milk', price=1.0,
+                               best_before_date=datetime.utcnow() + timedelta(days=30)))
+        # Inserted latest expiry first, so FEFO can't just follow insertion order
+        for i in reversed(range(args.lots)):
+            db.session.add(ProductLot(lot_id=f'lot-{i}', product_id='hot', store_id='bench-store', lot_number=str(i),
+                                      best_before_date=date.today() + timedelta(days=2 + i),
+                                      quantity_available=args.stock))
+        for n in range(args.shoppers):
+            db.session.add(User(user_id=f'shopper-{n}', email=f'shopper{n}@bench.local', password_hash='x'))
+        db.session.commit()
+
+    added = Counter()
+    statuses = Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.shoppers)
+
+    def shop(n):
+        client = app.test_client()
+        barrier.wait()
+        while True:
+            # Every shopper buys one unit per visit, so each unit is a fresh FEFO allocation
+            cart_id = client.post('/cart/create', json={'user_id': f'shopper-{n}', 'store_id': 'bench-store'}) \
+                .get_json()['cart_id']
+            response = client.post(f'/cart/{cart_id}/add', json={'product_id': 'hot'})
+            with lock:
+                statuses[response.status_code] += 1
+                if response.status_code < 300:
+                    added[n] += 1
+            if response.status_code >= 300:
+                return
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=shop, args=(n,)) for n in range(args.shoppers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        lots = {lot.lot_id: lot.quantity_available for lot in ProductLot.query.all()}
+        reserved = db.session.query(db.func.coalesce(db.func.sum(CartItem.quantity), 0)).scalar()
+        by_lot = dict(db.session.query(CartItemLot.lot_id, db.func.sum(CartItemLot.quantity)).group_by(CartItemLot.lot_id).all())
+
+    total = args.lots * args.stock
+    adds = sum(added.values())
+    print(f"shoppers: {args.shoppers}, stock: {total} in {args.lots} lots, {elapsed:.2f}s, {adds / elapsed:.0f} adds/s")
+    print(f"responses: {dict(statuses)}")
+    print(f"units in carts: {reserved}, left on lots: {lots}, per lot in carts: {by_lot}")
+    ok = reserved == total and adds == total and all(q == 0 for q in lots.values()) \
+        and all(by_lot.get(f'lot-{i}') == args.stock for i in range(args.lots))
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Mails sent per second against a local SMTP stand-in (aiosmtpd): a new connection per message,
+as send_receipt_email used to do, against the pooled mailer. Also drops the server connection
+halfway through to show the pool reconnecting.
+
+    pip install aiosmtpd
+    python benchmarks/bench_mailer.py --messages 500
+"""
+import argparse
+import smtplib
+import socket
+import time
+from email.mime.text import MIMEText
+
+from aiosmtpd.controller import Controller
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from mailer import SMTPPool
+
+
+class CountingHandler:
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 OK'
+
+
+def make_message(i):
+    msg = MIMEText(f"Receipt {i}")
+    msg['Subject'] = 'Your receipt'
+    msg['From'] = 'shop@example.com'
+    msg['To'] = f'user{i}@example.com'
+    return ('shop@example.com', [f'user{i}@example.com'], msg)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--port', type=int, default=8025)
+    args = parser.parse_args()
+
+    handler = CountingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=args.port)
+    controller.start()
+    messages = [make_message(i) for i in range(args.messages)]
+
+    try:
+        start = time.perf_counter()
+        for from_addr, to_addrs, msg in messages:
+            with smtplib.SMTP('127.0.0.1', args.port) as server:
+                server.sendmail(from_addr, to_addrs, msg.as_string())
+        elapsed = time.perf_counter() - start
+        print(f"{'connection per message':<24} {len(messages) / elapsed:>8.1f} mails/s  connects={len(messages)}")
+
+        pool = SMTPPool(host='127.0.0.1', port=args.port, size=2)
+        start = time.perf_counter()
+        half = len(messages) // 2
+        failures = pool.send_batch(messages[:half])
+        # Simulate the server dropping idle connections between batches
+        for connection in list(pool._idle.queue):
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        failures += pool.send_batch(messages[half:])
+        elapsed = time.perf_counter() - start
+        stats = pool.stats()
+        print(f"{'pooled':<24} {len(messages) / elapsed:>8.1f} mails/s  connects={stats['connects']} "
+              f"sent={stats['sent']} failed={stats['failed']}")
+        pool.close()
+        assert not failures
+        assert handler.received == 2 * len(messages)
+    finally:
+        controller.stop()
+
+
+if __name__ == '__main__':
+    main()
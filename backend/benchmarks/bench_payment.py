@@ -0,0 +1,112 @@
+"""
+Checkout against a slow local Stripe stub (stripe_stub.py): how long a request holds its worker
+on the blocking /checkout path versus POST /payment/<cart_id>/session, how many connections the
+pooled client opens, and how the circuit breaker and timeouts behave when Stripe fails or hangs.
+Exits non-zero if the async sessions don't all become ready.
+
+    python benchmarks/bench_payment.py --requests 32 --delay 0.5
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from load_test import stub_external_services
+from stripe_stub import StripeStub
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--delay', type=float, default=0.5, help="seconds the stub takes per session")
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-pay-'), 'pay.db')
+    stub_external_services()
+
+    import payment
+    from app import create_app
+    from jobs import run_worker
+    from models import db, Cart, CartItem, Employee, Product, Store, User
+    from qr_functions import generate_checkout_token
+
+    stub = StripeStub(delay=args.delay).start()
+    payment.STRIPE_API_BASE = stub.url
+    payment.STRIPE_READ_TIMEOUT = args.delay + 1.0
+    app = create_app()
+
+    counter = iter(range(10 ** 9))
+
+    def make_carts(n):
+        carts = []
+        with app.app_context():
+            for _ in range(n):
+                i = next(counter)
+                db.session.add(Cart(cart_id=f'cart-{i}', user_id='bench-user', price=3.0))
+                db.session.add(CartItem(cart_id=f'cart-{i}', product_id='bench-product', quantity=1))
+                carts.append((f'cart-{i}', generate_checkout_token(f'cart-{i}', 'bench-user')))
+            db.session.commit()
+        return carts
+
+    with app.app_context():
+        db.session.add(Employee(employee_id='bench-employee', store_id='bench-store', email='e@bench.local', password_hash='x'))
+        db.session.add(Store(store_id='bench-store', store_name='Bench', manager_id='bench-employee'))
+        db.session.add(User(user_id='bench-user', email='bench@bench.local', password_hash='x'))
+        db.session.add(Product(product_id='bench-product', store_id='bench-store', product_name='Milk', price=3.0,
+                               best_before_date=datetime.utcnow() + timedelta(days=5)))
+        db.session.commit()
+
+    def timed(send):
+        start = time.perf_counter()
+        response = send()
+        return time.perf_counter() - start, response
+
+    def run(label, carts, send):
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda cart: timed(lambda: send(app.test_client(), *cart)), carts))
+        seconds = sorted(r[0] for r in results)
+        codes = sorted({r[1].status_code for r in results})
+        print(f"{label:<34} p50 {seconds[len(seconds) // 2] * 1000:>8.1f} ms   max {seconds[-1] * 1000:>8.1f} ms   status {codes}")
+        return results
+
+    requests_before = stub.requests
+    run('blocking /checkout', make_carts(args.requests),
+        lambda client, cart_id, token: client.post(f'/checkout/{cart_id}', json={'token': token}))
+    print(f"{'':<34} {stub.requests - requests_before} Stripe calls over {len(stub.connections)} connections")
+
+    results = run('async /payment/<cart>/session', make_carts(args.requests),
+                  lambda client, cart_id, token: client.post(f'/payment/{cart_id}/session', json={'token': token}))
+    start = time.perf_counter()
+    run_worker(app, concurrency=args.concurrency, poll_interval=0.05, once=True)
+    client = app.test_client()
+    statuses = [client.get(f"/payment/sessions/{r[1].get_json()['payment_session_id']}").get_json()['status']
+                for r in results]
+    print(f"{'':<34} worker made {statuses.count('ready')}/{len(statuses)} sessions ready in {time.perf_counter() - start:.2f}s")
+
+    stub.failing = True
+    requests_before = stub.requests
+    run('Stripe failing (500)', make_carts(args.requests),
+        lambda client, cart_id, token: client.post(f'/checkout/{cart_id}', json={'token': token}))
+    print(f"{'':<34} {stub.requests - requests_before} reached Stripe before the circuit opened "
+          f"(threshold {payment.breaker.failures}), breaker {payment.breaker.state}")
+
+    stub.failing = False
+    stub.delay = payment.STRIPE_READ_TIMEOUT + 2
+    payment.breaker.success()  # close it again for the timeout run
+    run('Stripe hanging', make_carts(args.concurrency),
+        lambda client, cart_id, token: client.post(f'/checkout/{cart_id}', json={'token': token}))
+    print(f"{'':<34} read timeout {payment.STRIPE_READ_TIMEOUT:.1f}s, breaker {payment.breaker.state}")
+
+    ok = statuses.count('ready') == len(statuses)
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
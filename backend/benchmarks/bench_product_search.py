@@ -0,0 +1,63 @@
+"""
+Indexed product search against the old load-everything-and-filter approach.
+
+    python benchmarks/bench_product_search.py --products 500000
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from common import make_app, measure
+from models import db, Product
+from search import init_search, search_products
+
+WORDS = ['greek', 'yogurt', 'whole', 'milk', 'organic', 'butter', 'cheddar', 'cheese', 'free', 'range',
+         'eggs', 'sourdough', 'bread', 'smoked', 'salmon', 'fresh', 'basil', 'tomato', 'sauce', 'apple',
+         'juice', 'oat', 'drink', 'chicken', 'breast', 'vanilla', 'ice', 'cream', 'baby', 'spinach']
+QUERIES = ['yog', 'greek yogurt', 'smoked sal', 'choc', 'oat drink']
+
+
+def seed(total, stores):
+    store_ids = [f'store-{i}' for i in range(stores)]
+    bbd = datetime.utcnow() + timedelta(days=7)
+    for start in range(0, total, 20000):
+        db.session.execute(db.insert(Product), [{
+            'store_id': random.choice(store_ids),
+            'product_name': ' '.join(random.sample(WORDS, 3)).title() + f' {i}',
+            'best_before_date': bbd,
+            'price': 1.0,
+        } for i in range(start, min(start + 20000, total))])
+        db.session.commit()
+    return store_ids
+
+
+def load_all_and_filter(q):
+    return [p for p in Product.query.all() if q.lower() in p.product_name.lower()][:50]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=500000)
+    parser.add_argument('--stores', type=int, default=200)
+    args = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        init_search()
+        store_ids = seed(args.products, args.stores)
+
+        print(f"{'query':<14} {'method':<18} {'ms':>9} {'hits':>5}")
+        for q in QUERIES:
+            for name, run in [
+                ('load all + filter', lambda: load_all_and_filter(q)),
+                ('search', lambda: search_products(q, limit=50)),
+                ('search + store', lambda: search_products(q, store_id=store_ids[0], limit=50)),
+            ]:
+                with measure() as m:
+                    hits = run()
+                db.session.expunge_all()
+                print(f"{q:<14} {name:<18} {m['seconds'] * 1000:>9.1f} {len(hits):>5}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+QR alpha token validations per second in one worker, including replay rejection.
+Used token ids are claimed in the database unless REDIS_URL is set.
+
+    python benchmarks/bench_qr_validation.py --tokens 50000 --batch 100
+"""
+import argparse
+import time
+
+from common import make_app
+from qr_functions import generate_checkout_token, validate_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tokens', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    tokens = [generate_checkout_token(f'cart-{i}', f'user-{i % 1000}', 'store-1') for i in range(args.tokens)]
+    batches = [tokens[i:i + args.batch] for i in range(0, len(tokens), args.batch)]
+
+    app = make_app()
+    with app.app_context():
+        for label, expect_valid in [('first use', True), ('replay', False)]:
+            start = time.perf_counter()
+            results = [r for batch in batches for r in validate_tokens(batch, store_id='store-1')]
+            elapsed = time.perf_counter() - start
+            assert all(r['valid'] == expect_valid for r in results)
+            print(f"{label:<10} {len(results) / elapsed:>10.0f} validations/s  ({elapsed * 1e6 / len(results):.1f} us each)")
+
+
+if __name__ == '__main__':
+    main()
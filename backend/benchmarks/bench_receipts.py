@@ -0,0 +1,62 @@
+"""
+Receipts rendered per second: the old per-receipt path (fresh parse, temp file, read back)
+against in-memory rendering with the precompiled template, in one process and on the pool.
+
+    python benchmarks/bench_receipts.py --receipts 200 --items 15
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from receipts import ReceiptRenderer, render_receipt_pdf
+
+
+def old_render(items, total_price):
+    from weasyprint import HTML
+    item_lines = ""
+    for item in items:
+        item_lines += f"{item['name']} {item['quantity']} {item['price']}<br>"
+    pdf_html = "<html><body><h1>Receipt</h1><p>ITEMS</p></body></html>".replace("ITEMS", item_lines)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+        HTML(string=pdf_html).write_pdf(tmp_file.name)
+        path = tmp_file.name
+    with open(path, 'rb') as f:
+        pdf = f.read()
+    os.remove(path)
+    return pdf
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--receipts', type=int, default=200)
+    parser.add_argument('--items', type=int, default=15)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    receipts = []
+    for _ in range(args.receipts):
+        items = [{'name': f'Product {i}', 'quantity': random.randint(1, 3), 'price': round(random.uniform(0.5, 9.5), 2)}
+                 for i in range(args.items)]
+        receipts.append((items, sum(i['quantity'] * i['price'] for i in items)))
+
+    renderer = ReceiptRenderer(workers=args.workers)
+    renderer.render_batch(receipts[:args.workers])  # start and warm up the pool
+
+    for label, run in [
+        ('old (temp file)', lambda: [old_render(*r) for r in receipts]),
+        ('in memory, 1 process', lambda: [render_receipt_pdf(*r) for r in receipts]),
+        (f'pool, {args.workers} processes', lambda: renderer.render_batch(receipts)),
+    ]:
+        start = time.perf_counter()
+        pdfs = run()
+        elapsed = time.perf_counter() - start
+        assert len(pdfs) == len(receipts)
+        print(f"{label:<24} {len(pdfs) / elapsed:>8.1f} receipts/s")
+    renderer.shutdown()
+
+
+if __name__ == '__main__':
+    main()
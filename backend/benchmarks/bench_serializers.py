@@ -0,0 +1,77 @@
+"""
+Building a store catalog body the old way (ORM objects, to_dict, json.dumps) against
+store.build_catalog (column rows in batches, field specs, orjson when installed).
+Reports time and peak Python memory for each; MessagePack too if msgpack is installed.
+
+    python benchmarks/bench_serializers.py --products 100000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from common import make_app
+from models import db, Product
+import serializers
+from serializers import JSON, MSGPACK
+from store import build_catalog
+
+STORE_ID = 'bench-store'
+
+
+def seed(total):
+    bbd = datetime.utcnow() + timedelta(days=7)
+    for start in range(0, total, 20000):
+        db.session.execute(db.insert(Product), [{
+            'store_id': STORE_ID,
+            'product_name': f'Product {i}',
+            'brand': 'Bench',
+            'category': 'dairy',
+            'barcode': f'{i:013d}',
+            'best_before_date': bbd,
+            'price': 1.99,
+        } for i in range(start, min(start + 20000, total))])
+        db.session.commit()
+
+
+def old_catalog():
+    products = Product.query.filter_by(store_id=STORE_ID).all()
+    return json.dumps({'products': [p.to_dict() for p in products]})
+
+
+def run(label, build, repeat):
+    db.session.expunge_all()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = build()
+        seconds.append(time.perf_counter() - start)
+        db.session.expunge_all()
+    tracemalloc.start()
+    build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.expunge_all()
+    print(f"{label:<32} {min(seconds) * 1000:>9.1f} ms   peak {peak / 2 ** 20:>8.1f} MiB   body {len(body) / 2 ** 20:>6.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        seed(args.products)
+        print(f"{args.products} products, orjson {'yes' if serializers.orjson else 'no'}, "
+              f"msgpack {'yes' if serializers.msgpack else 'no'}")
+        run('to_dict + json.dumps', old_catalog, args.repeat)
+        run('build_catalog (JSON)', lambda: build_catalog(STORE_ID, JSON), args.repeat)
+        if serializers.msgpack:
+            run('build_catalog (MessagePack)', lambda: build_catalog(STORE_ID, MSGPACK), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
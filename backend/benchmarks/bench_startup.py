@@ -0,0 +1,67 @@
+"""
+Import time and resident memory of a fresh worker process building the app.
+
+    python benchmarks/bench_startup.py --runs 5
+
+"lazy" is what a worker does today; "eager" also imports the heavy dependencies
+up front, which is what every worker paid before they were made lazy.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, os, sys, time
+def rss_mib():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+start = time.perf_counter()
+if {eager}:
+    import stripe, weasyprint
+import app
+imported = time.perf_counter()
+app.create_app(reset_db={reset})
+built = time.perf_counter()
+print(json.dumps({{'import_s': imported - start, 'create_app_s': built - imported, 'rss_mib': rss_mib()}}))
+"""
+
+
+def probe(eager, reset, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url)
+    out = subprocess.check_output([sys.executable, '-c', PROBE.format(eager=eager, reset=reset)], cwd=BACKEND, env=env, text=True)
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL') or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-startup-'), 'startup.db')
+    probe(False, True, database_url)  # create and stamp the schema once
+
+    print(f"{'mode':<22} {'import ms':>10} {'create_app ms':>14} {'rss MiB':>8}")
+    for name, eager, reset in [('lazy, schema check', False, False),
+                               ('lazy, drop + create', False, True),
+                               ('eager, schema check', True, False)]:
+        try:
+            runs = [probe(eager, reset, database_url) for _ in range(args.runs)]
+        except subprocess.CalledProcessError:
+            print(f"{name:<22} failed (are stripe and weasyprint installed?)")
+            continue
+        print(f"{name:<22} {statistics.median(r['import_s'] for r in runs) * 1000:>10.1f} "
+              f"{statistics.median(r['create_app_s'] for r in runs) * 1000:>14.1f} "
+              f"{statistics.median(r['rss_mib'] for r in runs):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Shared helpers for the scripts in this folder.
+Run them from the backend folder, e.g. `python benchmarks/bench_expiry_scheduler.py`.
+"""
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event
+
+from models import db
+
+
+def make_app(database_url=None):
+    """
+    Bare app with only the database set up, on DATABASE_URL or a fresh SQLite file.
+    """
+    if database_url is None:
+        database_url = os.environ.get('DATABASE_URL') or \
+            'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-bench-'), 'bench.db')
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=database_url, SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db.init_app(app)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+@contextmanager
+def measure():
+    """
+    Yields a dict that is filled with elapsed seconds and SQL statement count on exit.
+    """
+    result = {'statements': 0}
+
+    def count(*args):
+        result['statements'] += 1
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result['seconds'] = time.perf_counter() - start
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def chunked(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
@@ -0,0 +1,207 @@
+"""
+Load test for the hot endpoints, run in-process against app.create_app with Stripe and SMTP stubbed.
+
+    python benchmarks/load_test.py --users 200 --concurrency 8 --out results.json
+    DATABASE_URL=postgresql://localhost/freshreminder_bench python benchmarks/load_test.py
+
+Every virtual user registers, works with the fridge, fills a cart, checks out and gets paid through
+the webhook. Per endpoint it reports throughput, p50/p95/p99 latency and SQL statements per request.
+SQLite serializes writers, so use PostgreSQL to measure real concurrency.
+"""
+import argparse
+import json
+import os
+import random
+import smtplib
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+
+
+class StubSMTP:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def sendmail(self, *args, **kwargs):
+        return {}
+
+
+def stub_external_services():
+    import payment
+    import stripe
+    from stripe_stub import StripeStub
+    # Checkout goes through the real pooled client, against a local stub
+    payment.STRIPE_API_BASE = StripeStub().start().url
+    stripe.Webhook.construct_event = staticmethod(lambda payload, sig, secret: json.loads(payload))
+    smtplib.SMTP = StubSMTP
+
+
+class Recorder:
+    """
+    Collects (endpoint, seconds, statements, status) per request; statements are counted per thread.
+    """
+    def __init__(self, engine):
+        self.samples = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        from sqlalchemy import event
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self._local.statements = getattr(self._local, 'statements', 0) + 1
+
+    def call(self, name, send):
+        self._local.statements = 0
+        start = time.perf_counter()
+        response = send()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples.append((name, elapsed, self._local.statements, response.status_code))
+        return response
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def seed_store(app, products):
+    from models import db, Employee, Product, Store
+    with app.app_context():
+        store = Store(store_name='Bench Store', manager_id='bench-manager')
+        db.session.add(store)
+        db.session.flush()
+        db.session.add(Employee(employee_id='bench-manager', store_id=store.store_id,
+                                email='manager@bench.local', password_hash='x', is_manager=True))
+        product_ids = []
+        for i in range(products):
+            product = Product(store_id=store.store_id, product_name=f'Product {i}', price=round(random.uniform(0.5, 9.5), 2),
+                              best_before_date=datetime.utcnow() + timedelta(days=random.randint(2, 30)))
+            db.session.add(product)
+            db.session.flush()
+            product_ids.append(product.product_id)
+        db.session.commit()
+        return store.store_id, product_ids
+
+
+def virtual_user(n, client, rec, store_id, product_ids, cart_lines):
+    from qr_functions import generate_checkout_token
+
+    r = rec.call('register', lambda: client.post('/auth/register', json={'email': f'user{n}-{time.time_ns()}@bench.local', 'password': 'bench'}))
+    if r.status_code != 201:
+        return
+    user_id, token = r.json['user_id'], r.json['access_token']
+    auth = {'Authorization': f'Bearer {token}'}
+
+    rec.call('fridge_list', lambda: client.get('/fridge/date', headers=auth))
+    r = rec.call('fridge_add', lambda: client.post('/fridge/add', headers=auth, json={
+        'product_name': 'Bench yogurt', 'quantity': 2, 'best_before_date': (datetime.utcnow() + timedelta(days=5)).date().isoformat()}))
+    if r.status_code == 200:
+        item_id = r.json['item']['fridge_item_id']
+        rec.call('fridge_remove', lambda: client.post(f'/fridge/remove/{item_id}', headers=auth))
+    rec.call('fridge_list', lambda: client.get('/fridge/date', headers=auth))
+
+    r = rec.call('cart_create', lambda: client.post('/cart/create', json={'user_id': user_id, 'store_id': store_id}))
+    cart_id = r.json['cart_id']
+    cart_item_id = None
+    for product_id in random.sample(product_ids, min(cart_lines, len(product_ids))):
+        r = rec.call('cart_add', lambda: client.post(f'/cart/{cart_id}/add', json={'product_id': product_id, 'quantity': random.randint(1, 3)}))
+        if r.status_code in (200, 201):
+            cart_item_id = r.json['cart_item_id']
+    if cart_item_id:
+        rec.call('cart_update', lambda: client.put(f'/cart/{cart_id}/update/{cart_item_id}/2'))
+    rec.call('cart_get', lambda: client.get(f'/cart/{cart_id}'))
+
+    qr_token = generate_checkout_token(cart_id, user_id)
+    rec.call('checkout', lambda: client.post(f'/checkout/{cart_id}', json={'token': qr_token}))
+    event = {'type': 'checkout.session.completed',
+             'data': {'object': {'metadata': {'cart_id': cart_id, 'user_id': user_id}}}}
+    rec.call('webhook', lambda: client.post('/checkout/webhook', data=json.dumps(event), headers={'Stripe-Signature': 'bench'}))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100, help="virtual users, each runs the full scenario once")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--cart-lines', type=int, default=10)
+    parser.add_argument('--out', default=None, help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-load-'), 'load.db')
+    stub_external_services()
+
+    from app import create_app
+    from models import db
+    app = create_app()
+    store_id, product_ids = seed_store(app, args.products)
+    with app.app_context():
+        rec = Recorder(db.engine)
+        dialect = db.engine.dialect.name
+
+    def run(n):
+        virtual_user(n, app.test_client(), rec, store_id, product_ids, args.cart_lines)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run, range(args.users)))
+    wall = time.perf_counter() - start
+
+    endpoints = {}
+    for name in sorted({s[0] for s in rec.samples}):
+        samples = [s for s in rec.samples if s[0] == name]
+        latencies = [s[1] * 1000 for s in samples]
+        endpoints[name] = {
+            'requests': len(samples),
+            'errors': sum(1 for s in samples if s[3] >= 400),
+            'throughput_rps': round(len(samples) / wall, 2),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'sql_per_request': round(sum(s[2] for s in samples) / len(samples), 2),
+        }
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'database': dialect,
+        'config': vars(args),
+        'wall_seconds': round(wall, 3),
+        'endpoints': endpoints,
+    }
+
+    print(f"{'endpoint':<14} {'req':>6} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8}")
+    for name, e in endpoints.items():
+        print(f"{name:<14} {e['requests']:>6} {e['errors']:>5} {e['throughput_rps']:>8} {e['p50_ms']:>8} "
+              f"{e['p95_ms']:>8} {e['p99_ms']:>8} {e['sql_per_request']:>8}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
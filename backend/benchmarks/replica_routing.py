@@ -0,0 +1,108 @@
+"""
+Checks read/write routing with two local databases standing in for primary and replica.
+The replica only gets the primary's data when this script copies it over, so a read served
+by the replica is visible as missing data. Exits non-zero if any check fails.
+
+    python benchmarks/replica_routing.py
+    DATABASE_URL=postgresql://localhost/fr_primary DATABASE_REPLICA_URL=postgresql://localhost/fr_replica \\
+        python benchmarks/replica_routing.py --no-copy
+
+With --no-copy the replica must be fed by real replication.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from load_test import stub_external_services
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-copy', action='store_true', help="don't copy primary to replica (real replication)")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='freshreminder-replica-')
+    primary_path = os.path.join(folder, 'primary.db')
+    replica_path = os.path.join(folder, 'replica.db')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{primary_path}')
+    os.environ.setdefault('DATABASE_REPLICA_URL', f'sqlite:///{replica_path}')
+    stub_external_services()
+
+    from flask import g
+    from sqlalchemy import event
+    from app import create_app
+    from models import db, Cart
+    app = create_app()
+
+    statements = Counter()
+    with app.app_context():
+        engines = {'primary': db.engines[None], 'replica': db.engines['replica']}
+        for name, engine in engines.items():
+            event.listen(engine, 'before_cursor_execute', lambda *a, name=name: statements.update([name]))
+        db.metadata.create_all(engines['replica'])
+
+    def replicate():
+        if args.no_copy:
+            time.sleep(1)
+            return
+        source, target = sqlite3.connect(primary_path), sqlite3.connect(replica_path)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    checks = []
+
+    def check(label, ok):
+        checks.append(ok)
+        print(f"{'ok  ' if ok else 'FAIL'} {label}")
+
+    def routed(label, send):
+        statements.clear()
+        response = send()
+        print(f"     {label}: {response.status_code}, statements {dict(statements)}")
+        return response
+
+    client = app.test_client()
+    registered = client.post('/auth/register', json={'email': 'replica@bench.local', 'password': 'pw'}).get_json()
+    user_id = registered['user_id']
+    headers = {'Authorization': f"Bearer {registered['access_token']}"}
+
+    # Before replication: the user exists only on the primary
+    response = routed('list_fridge before replication', lambda: client.get('/fridge/date', headers=headers))
+    check("list_fridge authenticates against the primary", response.status_code == 200)
+    check("list_fridge reads items from the replica", response.get_json()['items'] == [])
+
+    cart_id = client.post('/cart/create', json={'user_id': user_id, 'store_id': 's'}).get_json()['cart_id']
+    check("get_cart misses on the lagging replica", routed('get_cart before', lambda: client.get(f'/cart/{cart_id}')).status_code == 404)
+
+    replicate()
+    response = routed('list_fridge after replication', lambda: client.get('/fridge/date', headers=headers))
+    check("list_fridge sees replicated items", len(response.get_json()['items']) == 3)
+    check("get_cart reads the replica", routed('get_cart after', lambda: client.get(f'/cart/{cart_id}')).status_code == 200)
+
+    statements.clear()
+    routed('fridge add (write endpoint)', lambda: client.post('/fridge/add', headers=headers,
+                                                              json={'product_name': 'Jam', 'best_before_date': '2030-01-01'}))
+    check("write endpoints never touch the replica", statements['replica'] == 0)
+
+    # Read-after-write inside one read-only request
+    with app.test_request_context():
+        g.db_read_only = True
+        before = Cart.query.get(cart_id).price
+        Cart.query.filter_by(cart_id=cart_id).update({Cart.price: 42.0}, synchronize_session=False)
+        db.session.expire_all()
+        after = Cart.query.get(cart_id).price
+        db.session.rollback()
+    check(f"a read-only view reads its own write (price {before} -> {after})", after == 42.0)
+
+    print("OK" if all(checks) else "FAILED")
+    sys.exit(0 if all(checks) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Minimal local stand-in for the Stripe API: answers POST /v1/checkout/sessions after an
+optional delay, or with a 500 while failing. Point the app at it with STRIPE_API_BASE.
+
+    python benchmarks/stripe_stub.py --port 12111 --delay 0.5
+    STRIPE_API_BASE=http://127.0.0.1:12111 python app.py
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StripeStub:
+    def __init__(self, port=0, delay=0.0):
+        self.delay = delay
+        self.failing = False
+        self.requests = 0
+        self.connections = set()
+        self.idempotent = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse is visible
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.requests += 1
+                stub.connections.add(self.client_address)
+                time.sleep(stub.delay)
+                if stub.failing:
+                    return self._reply(500, {'error': {'type': 'api_error', 'message': 'stub failing'}})
+                if self.path != '/v1/checkout/sessions':
+                    return self._reply(404, {'error': {'type': 'invalid_request_error', 'message': 'unknown path'}})
+                key = self.headers.get('Idempotency-Key')
+                session_id = stub.idempotent.setdefault(key, f'cs_test_{uuid.uuid4().hex}') if key \
+                    else f'cs_test_{uuid.uuid4().hex}'
+                self._reply(200, {'id': session_id, 'object': 'checkout.session',
+                                  'url': f'https://checkout.stripe.invalid/pay/{session_id}'})
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+    stub = StripeStub(args.port, args.delay)
+    print(f"Stripe stub on {stub.url}")
+    stub.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
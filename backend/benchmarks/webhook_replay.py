@@ -0,0 +1,81 @@
+"""
+Replays one checkout.session.completed event from many threads at once and checks that the
+cart is paid, moved to the fridge and sent a receipt exactly once. Exits non-zero otherwise.
+
+    python benchmarks/webhook_replay.py --threads 32
+    DATABASE_URL=postgresql://localhost/freshreminder_bench python benchmarks/webhook_replay.py
+
+Also replays a second event id for the same cart, as Stripe does for a re-sent session.
+"""
+import argparse
+import json
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import common  # noqa: F401  (puts the backend folder on sys.path)
+from load_test import stub_external_services
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--lines', type=int, default=5)
+    args = parser.parse_args()
+
+    import os
+    import tempfile
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='freshreminder-replay-'), 'replay.db')
+    stub_external_services()
+
+    from app import create_app
+    from models import db, Cart, CartItem, FridgeItem, Job, ProcessedStripeEvent, Product, User
+    app = create_app()
+    with app.app_context():
+        db.session.add(User(user_id='replay-user', email='replay@bench.local', password_hash='x'))
+        db.session.add(Cart(cart_id='replay-cart', user_id='replay-user', price=args.lines * 2.0))
+        for i in range(args.lines):
+            db.session.add(Product(product_id=f'replay-{i}', store_id='replay-store', product_name=f'Product {i}',
+                                   price=2.0, best_before_date=datetime.utcnow() + timedelta(days=5)))
+            db.session.add(CartItem(cart_id='replay-cart', product_id=f'replay-{i}', quantity=1))
+        db.session.commit()
+
+    def event(event_id):
+        return json.dumps({'id': event_id, 'type': 'checkout.session.completed',
+                           'data': {'object': {'metadata': {'cart_id': 'replay-cart', 'user_id': 'replay-user'}}}})
+
+    statuses = []
+    barrier = threading.Barrier(args.threads)
+
+    def deliver(n):
+        client = app.test_client()
+        barrier.wait()
+        # Mostly the same event id, plus a few distinct ids for the same cart
+        response = client.post('/checkout/webhook', data=event('evt_replay' if n % 8 else f'evt_other_{n}'))
+        statuses.append((response.status_code, response.get_data(as_text=True)))
+
+    threads = [threading.Thread(target=deliver, args=(n,)) for n in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with app.app_context():
+        fridge_items = FridgeItem.query.filter_by(user_id='replay-user').count()
+        receipts = Job.query.filter_by(kind='send_receipt').count()
+        events = ProcessedStripeEvent.query.count()
+        payed = Cart.query.get('replay-cart').payed
+
+    processed = sum(1 for status, body in statuses if body == 'Success')
+    print(f"deliveries: {len(statuses)}, processed: {processed}, "
+          f"acknowledged as duplicates: {sum(1 for _, body in statuses if body == 'Already processed')}, "
+          f"errors: {sum(1 for status, _ in statuses if status >= 400)}")
+    print(f"payed: {payed}, fridge items: {fridge_items} (expected {args.lines}), receipt jobs: {receipts}, event ids: {events}")
+    ok = payed and processed == 1 and fridge_items == args.lines and receipts == 1
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,34 @@
 from flask import Blueprint, request, jsonify
+import logging
 import uuid
+from datetime import datetime
 from qr_functions import create_qr_beta
-from models import db, Cart, CartItem, Product
+from models import db, Cart, CartItem, Product, dialect_insert
+from db_routing import read_only
+from model_functions import adjust_cart_price, check_cart_price, reserve_stock, hold_stock, release_line, line_lots, \
+    OutOfStock, delete_carts, sweep_expired_carts, CART_TTL
+from jobs import job_handler
+
+logger = logging.getLogger(__name__)
 
 cart_bp = Blueprint('cart', __name__)
 
+MAX_CART_BATCH = 500
+
+
+def parse_quantity(value):
+    """
+    A quantity from a JSON body or URL as a positive int, or None if it isn't one.
+    """
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        quantity = int(value)
+    except (TypeError, ValueError):
+        return None
+    return quantity if quantity >= 1 else None
+
+
 @cart_bp.route('/create', methods=['POST'])
 def create_cart():
     data = request.get_json()
@@ -18,7 +42,8 @@ def create_cart():
         'status': 'active',
         'items': []
     }
-    db.session.add(Cart(cart_id=cart_id, user_id=data.get('user_id'), payed=False, price=0.0))
+    db.session.add(Cart(cart_id=cart_id, user_id=data.get('user_id'), payed=False, price=0.0,
+                        expires_at=datetime.utcnow() + CART_TTL))
     db.session.commit()
     return jsonify(cart), 201
 
@@ -26,13 +51,18 @@ def create_cart():
 def remove_cart(cart_id):
     if not cart_id:
         return jsonify({'error': 'cart_id is required'}), 400
-    if not Cart.query.filter_by(cart_id=cart_id).first():
+    cart = Cart.query.filter_by(cart_id=cart_id).first()
+    if not cart:
         return jsonify({'error': 'Cart not found'}), 404
-    Cart.query.filter_by(cart_id=cart_id).delete()
+    if cart.payed:
+        return jsonify({'error': 'Cart already payed'}), 400
+    # Items go too, and the stock they held goes back on the shelf
+    delete_carts([cart_id])
     db.session.commit()
     return jsonify({'message': 'Cart removed'}), 200
 
 @cart_bp.route('/<cart_id>', methods=['GET'])
+@read_only
 def get_cart(cart_id):
     cart = Cart.query.filter_by(cart_id=cart_id).first()
     if not cart:
@@ -42,8 +72,16 @@ def get_cart(cart_id):
         'user_id': cart.user_id,
         'payed': cart.payed,
         'price': cart.price,
-        'created_at': cart.created_at
+        'created_at': cart.created_at,
+        'expires_at': cart.expires_at
     })
+@cart_bp.route('/<cart_id>/price/check', methods=['GET'])
+def check_price(cart_id):
+    result = check_cart_price(cart_id)
+    if result is None:
+        return jsonify({'error': 'Cart not found'}), 404
+    return jsonify(result), 200
+
 @cart_bp.route('/<cart_id>/add', methods=['POST'])
 def add_item(cart_id):
     cart = Cart.query.filter_by(cart_id=cart_id).first()
@@ -52,35 +90,115 @@ def add_item(cart_id):
     data = request.get_json()
     if not data or 'product_id' not in data:
         return jsonify({'error': 'product_id is required'}), 400
+    quantity = parse_quantity(data.get('quantity', 1))
+    if quantity is None:
+        return jsonify({'error': 'quantity must be a positive integer'}), 400
     #check if product exists in the store
-    if not Product.query.filter_by(product_id=data.get('product_id')).first():
+    product = Product.query.filter_by(product_id=data.get('product_id')).first()
+    if not product:
         return jsonify({'error': 'Product not found in store'}), 404
     # check if product is already in cart
     existing_item = CartItem.query.filter_by(cart_id=cart_id, product_id=data.get('product_id')).first()
+    try:
+        taken = reserve_stock(product, quantity)
+    except OutOfStock:
+        db.session.rollback()
+        return jsonify({'error': 'Not enough stock', 'product_id': product.product_id}), 409
     if existing_item:
-        existing_item.quantity += data.get('quantity', 1)
-        db.session.commit()
-        return jsonify({
-            'cart_item_id': existing_item.cart_item_id,
-            'product_id': data.get('product_id'),
-            'quantity': existing_item.quantity
-        }), 200
+        cart_item = existing_item
+        cart_item.quantity += quantity
     else:
-        cart_item_id = str(uuid.uuid4())
-        cart_item = CartItem(cart_id=cart_id, cart_item_id=cart_item_id, product_id=data.get('product_id'), quantity=1)
+        cart_item = CartItem(cart_id=cart_id, cart_item_id=str(uuid.uuid4()), product_id=data.get('product_id'),
+                             quantity=quantity)
         db.session.add(cart_item)
-        db.session.commit()
-        return jsonify({
-            'cart_item_id': cart_item_id,
-            'product_id': data.get('product_id'),
-            'quantity': data.get('quantity', 1)
-        }), 201
+        db.session.flush()
+    hold_stock(cart_item.cart_item_id, taken)
+    adjust_cart_price(cart_id, quantity * product.price)
+    db.session.commit()
+    return jsonify({
+        'cart_item_id': cart_item.cart_item_id,
+        'product_id': data.get('product_id'),
+        'lots': line_lots([cart_item.cart_item_id])[cart_item.cart_item_id],
+        'quantity': cart_item.quantity
+    }), 200 if existing_item else 201
+
+@cart_bp.route('/<cart_id>/add/batch', methods=['POST'])
+def add_items(cart_id):
+    """
+    Adds many products at once, e.g. a basket scanned offline.
+    Body: {"items": [{"product_id": ..., "quantity": ...}, ...]}. Either all items are added or none.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('items'), list) or not data['items']:
+        return jsonify({'error': 'items is required'}), 400
+    if len(data['items']) > MAX_CART_BATCH:
+        return jsonify({'error': f'at most {MAX_CART_BATCH} items per request'}), 400
+    quantities = {}
+    try:
+        for entry in data['items']:
+            quantity = parse_quantity(entry.get('quantity', 1))
+            if quantity is None:
+                raise ValueError
+            quantities[entry['product_id']] = quantities.get(entry['product_id'], 0) + quantity
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return jsonify({'error': 'every item needs a product_id and a positive quantity'}), 400
+
+    if not Cart.query.filter_by(cart_id=cart_id).first():
+        return jsonify({'error': 'Cart not found'}), 404
+    products = {product.product_id: product for product in Product.query.filter(Product.product_id.in_(quantities))}
+    missing = [product_id for product_id in quantities if product_id not in products]
+    if missing:
+        return jsonify({'error': 'Product not found in store', 'product_ids': missing}), 404
+
+    taken = {}
+    try:
+        # Sorted, so concurrent batches lock lots in the same order
+        for product_id in sorted(quantities):
+            taken[product_id] = reserve_stock(products[product_id], quantities[product_id])
+    except OutOfStock as e:
+        db.session.rollback()
+        return jsonify({'error': 'Not enough stock', 'product_ids': [e.product_id]}), 409
+
+    statement = dialect_insert(CartItem)
+    statement = statement.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={'quantity': CartItem.quantity + statement.excluded.quantity},
+    )
+    db.session.execute(statement, [
+        {'cart_item_id': str(uuid.uuid4()), 'cart_id': cart_id, 'product_id': product_id, 'quantity': quantity}
+        for product_id, quantity in quantities.items()
+    ])
+    # Read back, a line that already existed keeps its id
+    line_ids = dict(db.session.query(CartItem.product_id, CartItem.cart_item_id)
+                    .filter(CartItem.cart_id == cart_id, CartItem.product_id.in_(quantities)))
+    for product_id, lots in taken.items():
+        hold_stock(line_ids[product_id], lots)
+    adjust_cart_price(cart_id, sum(quantity * products[product_id].price for product_id, quantity in quantities.items()))
+    db.session.commit()
+
+    cart = Cart.query.get(cart_id)
+    items = CartItem.query.filter_by(cart_id=cart_id).all()
+    lots = line_lots([item.cart_item_id for item in items])
+    return jsonify({
+        'cart_id': cart_id,
+        'price': cart.price,
+        'items': [{
+            'cart_item_id': item.cart_item_id,
+            'product_id': item.product_id,
+            'lots': lots[item.cart_item_id],
+            'quantity': item.quantity
+        } for item in items]
+    }), 200
 
 @cart_bp.route('/<cart_id>/remove/<cart_item_id>', methods=['DELETE'])
 def remove_item(cart_id, cart_item_id):
     cart_item = CartItem.query.filter_by(cart_id=cart_id, cart_item_id=cart_item_id).first()
     if not cart_item:
         return jsonify({'error': 'Cart item not found'}), 404
+    product = Product.query.get(cart_item.product_id)
+    if product:
+        adjust_cart_price(cart_id, -cart_item.quantity * product.price)
+    release_line(cart_item.cart_item_id)
     db.session.delete(cart_item)
     db.session.commit()
     return jsonify({'message': 'Cart item removed'}), 200
@@ -93,11 +211,27 @@ def update_item(cart_id, cart_item_id, quantity):
     cart_item = CartItem.query.filter_by(cart_id=cart_id, cart_item_id=cart_item_id).first()
     if not cart_item:
         return jsonify({'error': 'Cart item not found'}), 404
-    cart_item.quantity = int(quantity)
+    quantity = parse_quantity(quantity)
+    if quantity is None:
+        return jsonify({'error': 'quantity must be a positive integer, remove the item instead'}), 400
+    product = Product.query.get(cart_item.product_id)
+    delta = quantity - cart_item.quantity
+    if delta > 0:
+        try:
+            hold_stock(cart_item.cart_item_id, reserve_stock(product, delta))
+        except OutOfStock:
+            db.session.rollback()
+            return jsonify({'error': 'Not enough stock', 'product_id': cart_item.product_id}), 409
+    elif delta < 0:
+        release_line(cart_item.cart_item_id, -delta)
+    if product:
+        adjust_cart_price(cart_id, delta * product.price)
+    cart_item.quantity = quantity
     db.session.commit()
     return jsonify({
         'cart_item_id': cart_item.cart_item_id,
         'product_id': cart_item.product_id,
+        'lots': line_lots([cart_item.cart_item_id])[cart_item.cart_item_id],
         'quantity': cart_item.quantity
     }), 200
 
@@ -108,4 +242,9 @@ def checkout(cart_id):
         return jsonify({'error': 'Cart not found'}), 404
     if cart.payed:
         return jsonify({'error': 'Cart already payed'}), 400
-    create_qr_beta(cart)
\ No newline at end of file
+    create_qr_beta(cart)
+
+
+@job_handler('sweep_expired_carts')
+def sweep_expired_carts_job(payload):
+    logger.info("Cart sweep reclaimed %s", sweep_expired_carts())
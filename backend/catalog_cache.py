@@ -0,0 +1,132 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import Response, request
+
+from models import db, Store
+from serializers import MSGPACK, response_type
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", 300))    # seconds a cached catalog body lives
+STORE_TOKEN_TTL = int(os.getenv("STORE_TOKEN_CACHE_TTL", 60))    # seconds a cached store token lives
+MEMORY_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", 1000))
+
+
+class MemoryBackend:
+    """
+    Per-process fallback when Redis isn't configured. Bodies are keyed by the catalog version
+    from the database, so every worker agrees on it and only the bodies are per process.
+    """
+    def __init__(self, maxsize=MEMORY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl, only_if_missing=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if only_if_missing and entry is not None and entry[0] >= time.monotonic():
+                return False
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            return True
+
+
+class RedisBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl, only_if_missing=False):
+        return bool(self.client.set(key, value, ex=ttl, nx=only_if_missing))
+
+
+def _make_backend():
+    url = os.getenv("REDIS_URL")
+    if url:
+        try:
+            import redis
+            client = redis.Redis.from_url(url)
+            client.ping()
+            return RedisBackend(client)
+        except Exception:
+            logger.warning("Redis at REDIS_URL not reachable, using the in-memory catalog cache")
+    return MemoryBackend()
+
+
+backend = _make_backend()
+
+
+def _as_text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def catalog_version(store_id):
+    """
+    Current catalog version of a store, a counter on its row. It only changes when the catalog
+    does, so ETags stay valid across workers and cache expiry.
+    """
+    version = db.session.query(Store.catalog_version).filter_by(store_id=store_id).scalar()
+    return str(version or 0)
+
+
+def bump_catalog_version(store_id):
+    # Called when products of a store are created, changed or deleted, in the same transaction. Does not commit.
+    Store.query.filter_by(store_id=store_id).update(
+        {Store.catalog_version: Store.catalog_version + 1}, synchronize_session=False)
+
+
+def store_token(store_id, load):
+    """
+    The store's API token, from the cache or from load() (which returns None for unknown stores).
+    """
+    key = f'store:token:{store_id}'
+    token = backend.get(key)
+    if token is None:
+        token = load()
+        if token is None:
+            return None
+        backend.set(key, token, STORE_TOKEN_TTL)
+    return _as_text(token)
+
+
+def catalog_response(store_id, build):
+    """
+    Catalog response for a store with an ETag, as JSON or MessagePack depending on Accept.
+    Answers 304 when the client's copy is current, otherwise serves the cached body,
+    calling build(mimetype) only on a miss. Each format is cached and tagged separately.
+    """
+    mimetype = response_type()
+    version = catalog_version(store_id)
+    suffix = '-msgpack' if mimetype == MSGPACK else ''
+    etag = f'{store_id}-{version}{suffix}'
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        key = f'catalog:body:{store_id}:{version}{suffix}'
+        body = backend.get(key)
+        if body is None:
+            body = build(mimetype)
+            backend.set(key, body, CATALOG_CACHE_TTL)
+        response = Response(body, status=200, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, the 304 is cheap
+    return response
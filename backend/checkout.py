@@ -1,8 +1,12 @@
-from flask import Blueprint, request, jsonify, abort
-import stripe, os
-from models import db, Cart, User, CartItem, Product, FridgeItem
-from model_functions import compute_cart_price, send_receipt_email, get_store_from_cart_id
-from qr_functions import verify_token
+from flask import Blueprint, request, jsonify
+import os
+from models import db, Cart, User, CartItem, Product, ProcessedStripeEvent, dialect_insert
+from datetime import datetime
+from model_functions import send_receipt_email, send_receipt_emails, transfer_cart_to_fridge, cart_lines, \
+    extend_cart, PAYMENT_HOLD
+from payment import checkout_target, create_stripe_session, unavailable_response, PaymentUnavailable
+from jobs import enqueue, job_handler
+from analytics import record_sale
 
 OWN_EMAIL = ""
 
@@ -10,53 +14,18 @@ checkout_bp = Blueprint('checkout', __name__)
 
 @checkout_bp.route('/<cart_id>', methods=['POST'])
 def checkout_cart(cart_id):
-
-    token = request.json.get("token")
-    if not token:
-        abort(400, "Missing token")
-
-    payload = verify_token(token)
-    if not payload:
-        abort(403, "Invalid or expired token")
-
-    if str(payload["cart_id"]) != str(cart_id):
-        abort(403, "Cart ID mismatch")
-
-    user_id = payload.get("user_id")
-    if not user_id:
-        abort(403, "Missing user_id")
-
-    cart = Cart.query.get(cart_id)
-    if not cart or cart.user_id != user_id:
-        abort(403, "Cart does not belong to user")
-
-    store_id = get_store_from_cart_id(cart_id).store_id
-
-    price = compute_cart_price(cart_id)
-
-    if price <= 0:
-        abort(400, "Cart total must be greater than 0")
-
-    session = stripe.checkout.Session.create(
-        payment_method_types=["card"],
-        mode="payment",
-        line_items=[{
-            "price_data": {
-                "currency": "usd",
-                "product_data": {
-                    "name": f"Store {store_id} - Cart {cart_id}",
-                },
-                "unit_amount": int(price * 100),
-            },
-            "quantity": 1,
-        }],
-        success_url="http://localhost:3000/success",
-        cancel_url="http://localhost:3000/cancel",
-        metadata={
-            "cart_id": cart_id,
-            "user_id": user_id
-        }
-    )
+    """
+    Creates the Stripe session while the request waits, bounded by the client timeouts.
+    POST /payment/<cart_id>/session does the same without holding the worker.
+    """
+    cart, store_id = checkout_target(cart_id, (request.get_json(silent=True) or {}).get("token"))
+    # Not swept while the Stripe session can still be paid; committed before Stripe is called
+    extend_cart(cart_id, PAYMENT_HOLD)
+    db.session.commit()
+    try:
+        session = create_stripe_session(cart_id, cart.user_id, store_id, cart.price)
+    except PaymentUnavailable:
+        return unavailable_response()
 
     return jsonify({
         "checkout_url": session.url
@@ -69,6 +38,7 @@ def stripe_webhook():
 
     endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
 
+    import stripe
     try:
         event = stripe.Webhook.construct_event(
             payload, sig_header, endpoint_secret
@@ -82,32 +52,75 @@ def stripe_webhook():
         cart_id = session['metadata']['cart_id']
         user_id = session['metadata']['user_id']
 
-        cart = Cart.query.get(cart_id)
-        if not cart:
-            return "Cart not found", 400
-
-        if not cart.payed:
-            cart.payed = True
+        # Stripe delivers at least once: an event id seen before is acknowledged without doing anything.
+        # The row is only committed with the work below, so a failed attempt can be retried.
+        if event.get('id'):
+            recorded = db.session.execute(
+                dialect_insert(ProcessedStripeEvent)
+                .values(event_id=event['id'], event_type=event['type'])
+                .on_conflict_do_nothing()
+            ).rowcount
+            if not recorded:
+                db.session.rollback()
+                return "Already processed", 200
+
+        # Claim the cart with one conditional UPDATE; only one delivery can flip payed
+        payed_at = datetime.utcnow()
+        claimed = Cart.query.filter_by(cart_id=cart_id, payed=False) \
+            .update({Cart.payed: True, Cart.payed_at: payed_at}, synchronize_session=False)
+        if not claimed:
+            if not db.session.query(Cart.cart_id).filter_by(cart_id=cart_id).first():
+                db.session.rollback()
+                return "Cart not found", 400
             db.session.commit()
-
-            # send receipt
-            user = User.query.get(user_id)
-            cart_items = CartItem.query.filter_by(cart_id=cart_id).all()
-
-            items = []
-            for item in cart_items:
-                product = Product.query.get(item.product_id)
-                items.append({
-                    "name": product.name,
-                    "quantity": item.quantity,
-                    "price": product.price
-                })
-
-            price = compute_cart_price(cart_id)
-            send_receipt_email(user.email, OWN_EMAIL, items, price)
-
-            # move to fridge
-            for item in cart_items:
-                FridgeItem.from_cart_item(item)
-
-    return "Success", 200
\ No newline at end of file
+            return "Already processed", 200
+
+        # Fridge transfer and the sales rollup commit together with the payment flag
+        lines = cart_lines(cart_id)
+        transfer_cart_to_fridge(cart_id, lines)
+        record_sale(lines, payed_at.date())
+        # Receipt runs on a worker (see jobs.py) so Stripe gets its answer right away
+        enqueue('send_receipt', {'cart_id': cart_id, 'user_id': user_id})
+        db.session.commit()
+
+    return "Success", 200
+
+
+@job_handler('send_receipt')
+def send_receipt_job(payload):
+    cart = Cart.query.get(payload['cart_id'])
+    user = User.query.get(payload['user_id'])
+    if not cart or not user:
+        return
+    lines = db.session.query(Product.product_name, CartItem.quantity, Product.price) \
+        .join(Product, Product.product_id == CartItem.product_id) \
+        .filter(CartItem.cart_id == cart.cart_id).all()
+
+    items = [{
+        "name": name,
+        "quantity": quantity,
+        "price": price
+    } for name, quantity, price in lines]
+
+    send_receipt_email(user.email, OWN_EMAIL, items, cart.price)
+
+
+@job_handler('resend_receipts')
+def resend_receipts_job(payload):
+    """
+    Re-sends the receipts of many paid carts: {"cart_ids": [...]}.
+    """
+    carts = db.session.query(Cart.cart_id, Cart.price, User.email) \
+        .join(User, User.user_id == Cart.user_id) \
+        .filter(Cart.cart_id.in_(payload['cart_ids']), Cart.payed == True).all()
+    lines = db.session.query(CartItem.cart_id, Product.product_name, CartItem.quantity, Product.price) \
+        .join(Product, Product.product_id == CartItem.product_id) \
+        .filter(CartItem.cart_id.in_([cart.cart_id for cart in carts])).all()
+
+    items = {}
+    for cart_id, name, quantity, price in lines:
+        items.setdefault(cart_id, []).append({"name": name, "quantity": quantity, "price": price})
+    failed = send_receipt_emails([(email, items.get(cart_id, []), price) for cart_id, price, email in carts], OWN_EMAIL)
+    if failed:
+        # Only the carts that failed go back on the queue, the rest must not get a second mail
+        enqueue('resend_receipts', {'cart_ids': [carts[i].cart_id for i in failed]}, delay=60)
@@ -0,0 +1,89 @@
+"""
+Database configuration from the environment, and a session that sends the SELECTs of
+read-only endpoints to a replica (DATABASE_REPLICA_URL) while everything else uses the primary.
+"""
+import os
+from contextlib import contextmanager
+from functools import wraps
+
+import sqlalchemy as sa
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND = 'replica'
+
+
+def engine_options(url):
+    options = {
+        'pool_pre_ping': os.getenv("DB_POOL_PRE_PING", "1") != "0",    # drop connections the server closed
+        'pool_recycle': int(os.getenv("DB_POOL_RECYCLE", 1800)),       # seconds, below server/proxy idle timeouts
+    }
+    if not url.startswith('sqlite'):
+        options.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", 5)),               # per process, so per gunicorn worker
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),     # seconds to wait for a free connection
+        )
+    return options
+
+
+def database_config():
+    url = os.environ.get('DATABASE_URL', 'sqlite:///freshreminder.db')
+    config = {
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options(url),
+    }
+    replica_url = os.environ.get('DATABASE_REPLICA_URL')
+    if replica_url:
+        config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: {'url': replica_url, **engine_options(replica_url)}}
+    return config
+
+
+class RoutingSession(Session):
+    """
+    Inside a @read_only view, plain SELECTs go to the replica bind if one is configured.
+    Once the session has written anything, it stays on the primary for the rest of the
+    request, so a view always reads its own writes.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or isinstance(clause, sa.sql.dml.UpdateBase):
+                self.info['wrote'] = True
+            elif self._use_replica(clause):
+                return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _use_replica(self, clause):
+        return (isinstance(clause, sa.Select)
+                and not self.info.get('wrote')
+                and has_request_context()
+                and g.get('db_read_only', False)
+                and not g.get('db_primary', 0)
+                and REPLICA_BIND in self._db.engines)
+
+
+def read_only(f):
+    """
+    Marks a view as safe to serve from the replica.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return decorated
+
+
+@contextmanager
+def primary():
+    """
+    Reads inside this block use the primary even in a @read_only view, for lookups that
+    must see the latest write (e.g. a token issued by the previous request).
+    """
+    if not has_request_context():
+        yield
+        return
+    g.db_primary = g.get('db_primary', 0) + 1
+    try:
+        yield
+    finally:
+        g.db_primary -= 1
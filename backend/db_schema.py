@@ -0,0 +1,48 @@
+import logging
+
+from models import db, SchemaVersion, SCHEMA_VERSION
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaMismatch(RuntimeError):
+    pass
+
+
+def current_version():
+    if not db.inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return None
+    return db.session.query(db.func.max(SchemaVersion.version)).scalar()
+
+
+def stamp():
+    db.session.add(SchemaVersion(version=SCHEMA_VERSION))
+    db.session.commit()
+
+
+def ensure_schema(reset=False):
+    """
+    reset=True drops and recreates every table (development).
+    Otherwise the schema is only created on an empty database; an existing one must carry
+    SCHEMA_VERSION in the schema_version table, or SchemaMismatch is raised instead of touching it.
+    """
+    if reset:
+        db.drop_all()
+        db.create_all()
+        stamp()
+        return
+
+    version = current_version()
+    if version == SCHEMA_VERSION:
+        return
+    if version is None:
+        existing = set(db.inspect(db.engine).get_table_names())
+        if existing & set(db.metadata.tables):
+            raise SchemaMismatch(
+                "Database has tables but no schema_version; migrate it and insert "
+                f"version {SCHEMA_VERSION} into schema_version")
+        logger.info("Empty database, creating schema version %s", SCHEMA_VERSION)
+        db.create_all()
+        stamp()
+        return
+    raise SchemaMismatch(f"Database schema is at version {version}, this code expects {SCHEMA_VERSION}")
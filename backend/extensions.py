@@ -1,14 +1,158 @@
 from flask_login import LoginManager, login_required, login_user
-from models import User
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import logging
+import os
+import time
+from models import db, User
+from db_routing import primary
 login_manager = LoginManager()
+logger = logging.getLogger(__name__)
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", 300)) # seconds, when revocations are shared through Redis
+TOKEN_CACHE_LOCAL_TTL = float(os.getenv("TOKEN_CACHE_LOCAL_TTL", 5)) # seconds, without Redis
 
-@login_manager.request_loader
-def load_user_from_request(request):
-    token = request.args.get('token')
-    if token:
-        user = User.query.filter_by(api_key=token).first()
-        if user:
-            return user
 
+class AuthenticatedUser:
+    """
+    Detached snapshot of the columns the request handlers need from a User.
+    Safe to share between requests, unlike a session-bound User instance.
+    """
+    __slots__ = ('user_id', 'email')
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, user_id, email):
+        self.user_id = user_id
+        self.email = email
+
+    def get_id(self):
+        return str(self.user_id)
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of token -> AuthenticatedUser with a per-entry TTL.
+    """
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, token, user):
+        with self._lock:
+            self._entries[token] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class RedisRevocations:
+    """
+    Tokens revoked by any worker. An entry only has to outlive the cache entries it
+    overrides, so it expires after TOKEN_CACHE_TTL.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _key(token):
+        return 'auth:revoked:' + hashlib.sha256(token.encode()).hexdigest()
+
+    def revoke(self, token):
+        self.client.set(self._key(token), 1, ex=int(TOKEN_CACHE_TTL) + 1)
+
+    def is_revoked(self, token):
+        return bool(self.client.exists(self._key(token)))
+
+
+def _make_revocations():
+    url = os.getenv("REDIS_URL")
+    if url:
+        try:
+            import redis
+            client = redis.Redis.from_url(url)
+            client.ping()
+            return RedisRevocations(client)
+        except Exception:
+            logger.warning("Redis at REDIS_URL not reachable, cached tokens expire after TOKEN_CACHE_LOCAL_TTL")
     return None
+
+
+revocations = _make_revocations()
+# Without shared revocations a logout only reaches the other workers when their entry expires
+token_cache = TokenCache(ttl=TOKEN_CACHE_TTL if revocations else TOKEN_CACHE_LOCAL_TTL)
+
+
+def bearer_token(request):
+    auth = request.headers.get('Authorization')
+    if not auth or not auth.startswith('Bearer '):
+        return None
+    return auth.replace('Bearer ', '')
+
+
+def resolve_user(token):
+    """
+    Returns the AuthenticatedUser for a token, or None if the token is unknown.
+    Served from token_cache when possible; misses do one indexed lookup on users.token.
+    """
+    if not token:
+        return None
+    user = token_cache.get(token)
+    if user is not None:
+        if revocations is None or not revocations.is_revoked(token):
+            return user
+        token_cache.invalidate(token)
+    with primary():  # a token issued by the previous request may not have reached the replica yet
+        row = db.session.query(User.user_id, User.email).filter(User.token == token).first()
+    if not row:
+        return None
+    user = AuthenticatedUser(row.user_id, row.email)
+    token_cache.set(token, user)
+    return user
+
+
+def invalidate_token(token):
+    """
+    Called after a token was cleared or replaced in the database. With Redis every worker
+    sees the revocation on its next cache hit; without it other workers keep serving the
+    token for at most TOKEN_CACHE_LOCAL_TTL.
+    """
+    token_cache.invalidate(token)
+    if revocations is not None:
+        revocations.revoke(token)
+
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    return resolve_user(request.args.get('token'))
@@ -1,17 +1,24 @@
 from flask import Blueprint, request, jsonify, g
-from models import User, FridgeItem, Product, db
-from datetime import datetime
+from models import FridgeItem, Product, db
+from datetime import date, datetime
 from functools import wraps
+import base64
+import json
+from extensions import bearer_token, resolve_user
+from fridge_summary import get_summary, record_change
+from fridge_sync import next_version, record_removed, changes_since
+from analytics import record_consumed
+from db_routing import read_only
+from serializers import FRIDGE_ITEM, FRIDGE_SUMMARY, render, render_list
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.headers.get('Authorization')
-        if not auth or not auth.startswith('Bearer '):
+        token = bearer_token(request)
+        if not token:
             return jsonify({'error': 'missing authorization'}), 401
 
-        token = auth.replace('Bearer ', '')
-        user = User.query.filter_by(token=token).first()
+        user = resolve_user(token)
         if not user:
             return jsonify({'error': 'invalid token'}), 401
 
@@ -24,22 +31,121 @@ def token_required(f):
 fridge_bp = Blueprint('fridge', __name__)
 
 
+# order_method -> (column, descending, parse cursor value)
+SORT_ORDERS = {
+    'date': (FridgeItem.best_before_date, True, date.fromisoformat),
+    'added': (FridgeItem.added_at, True, datetime.fromisoformat),
+    'name': (FridgeItem.product_name, False, str),
+    'quantity': (FridgeItem.quantity, True, int),
+}
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(value, fridge_item_id):
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, fridge_item_id]).encode()).decode()
+
+
+def decode_cursor(cursor, parse):
+    value, fridge_item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return parse(value), fridge_item_id
+
+
 @fridge_bp.route('/<order_method>', defaults={'order_method': 'date'}, methods=['GET'])
+@read_only
 @token_required
 def list_fridge(order_method):
+    """
+    One page of the user's fridge. Pass the returned next_cursor as ?cursor= to get the next page.
+    ?status= filters on item status (default active, 'all' for everything), ?limit= sets the page size.
+    """
     user = g.current_user
+    column, descending, parse = SORT_ORDERS.get(order_method, SORT_ORDERS['date'])
 
-    if order_method == 'date':
-        items = FridgeItem.query.filter_by(user_id=user.user_id).order_by(FridgeItem.best_before_date.desc()).all()
-    elif order_method == 'added':
-        items = FridgeItem.query.filter_by(user_id=user.user_id).order_by(FridgeItem.added_at.desc()).all()
-    elif order_method == 'name':
-        items = FridgeItem.query.filter_by(user_id=user.user_id).order_by(FridgeItem.product_name.asc()).all()
-    elif order_method == 'quantity':
-        items = FridgeItem.query.filter_by(user_id=user.user_id).order_by(FridgeItem.quantity.desc()).all()
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'invalid limit'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
+    status = request.args.get('status', 'active')
+
+    query = FridgeItem.query.filter_by(user_id=user.user_id)
+    if status != 'all':
+        query = query.filter_by(status=status)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            last = decode_cursor(cursor, parse)
+        except Exception:
+            return jsonify({'error': 'invalid cursor'}), 400
+        # fridge_item_id breaks ties so rows with equal sort values are neither skipped nor repeated
+        key = db.tuple_(column, FridgeItem.fridge_item_id)
+        query = query.filter(key < last if descending else key > last)
+
+    if descending:
+        query = query.order_by(column.desc(), FridgeItem.fridge_item_id.desc())
     else:
-        items = FridgeItem.query.filter_by(user_id=user.user_id).order_by(FridgeItem.best_before_date.desc()).all()
-    return jsonify({'items': [it.as_dict() for it in items]})
+        query = query.order_by(column.asc(), FridgeItem.fridge_item_id.asc())
+
+    items = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(getattr(items[-1], column.key), items[-1].fridge_item_id)
+    return render_list('items', items, FRIDGE_ITEM, {'next_cursor': next_cursor})
+
+
+@fridge_bp.route('/summary', methods=['GET'])
+@token_required
+def fridge_summary():
+    """
+    Counts for the home screen: active items, expired, expiring today / within 3 days / within a week,
+    and the next best before date.
+    """
+    return render(FRIDGE_SUMMARY.dump(get_summary(g.current_user.user_id)))
+
+
+@fridge_bp.route('/changes', methods=['GET'])
+@token_required
+def fridge_changes():
+    """
+    What changed since ?since=<version> (the version of the previous response): changed items
+    as upserts, ids of removed items as tombstones. Without since, or when the client is too far
+    behind, resync is true and upserts is the whole fridge. Reads the primary, a lagging replica
+    would hand out an older version than the client already has.
+    """
+    since = request.args.get('since')
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        return jsonify({'error': 'invalid since'}), 400
+    changes = changes_since(g.current_user.user_id, since)
+    changes['upserts'] = [FRIDGE_ITEM.dump(item) for item in changes['upserts']]
+    return render(changes)
+
+
+@fridge_bp.route('/consume/<string:id>', methods=['POST'])
+@token_required
+def consume_fridge_item(id):
+    user = g.current_user
+    it = FridgeItem.query.filter_by(fridge_item_id=id, user_id=user.user_id).first()
+    if not it:
+        return jsonify({'error': 'not found'}), 404
+    # Conditional, so consuming twice only counts once in the summary
+    consumed = FridgeItem.query.filter_by(fridge_item_id=id, status='active') \
+        .update({FridgeItem.status: 'consumed', FridgeItem.consumed_at: datetime.utcnow()}, synchronize_session=False)
+    if consumed:
+        # Versioned only once it changed, a repeated consume doesn't bump the user's version
+        FridgeItem.query.filter_by(fridge_item_id=id) \
+            .update({FridgeItem.version: next_version(user.user_id)}, synchronize_session=False)
+        record_change(user.user_id, it.best_before_date, -1)
+        record_consumed(it)
+    db.session.commit()
+    return jsonify({'status': 'consumed'}), 200
 
 
 @fridge_bp.route('/remove/<string:id>', methods=['POST'])
@@ -54,7 +160,11 @@ def remove_fridge_item(id):
 
     try:
 
+        was_active = it.status == 'active'
         db.session.delete(it)
+        if was_active:
+            record_change(user.user_id, it.best_before_date, -1)
+        record_removed(user.user_id, [it.fridge_item_id], next_version(user.user_id))
         db.session.commit()
         return jsonify({'status': 'removed'}), 200
     except Exception as e:
@@ -78,14 +188,17 @@ def add_fridge_item(id):
                 days = 7
             from datetime import datetime, timedelta
             bbd = (datetime.utcnow().date() + timedelta(days=days))
-            fi = FridgeItem(user_id=user.user_id, product_name=product.product_name, quantity=1, best_before_date=bbd)
+            fi = FridgeItem(user_id=user.user_id, product_name=product.product_name, quantity=1, best_before_date=bbd,
+                            version=next_version(user.user_id))
         else:
             # treat id as plain name
             from datetime import datetime, timedelta
             bbd = (datetime.utcnow().date() + timedelta(days=7))
-            fi = FridgeItem(user_id=user.user_id, product_name=id, quantity=1, best_before_date=bbd)
+            fi = FridgeItem(user_id=user.user_id, product_name=id, quantity=1, best_before_date=bbd,
+                            version=next_version(user.user_id))
 
         db.session.add(fi)
+        record_change(user.user_id, bbd, 1)
         db.session.commit()
         return jsonify({'status': 'added', 'item': fi.as_dict()}), 200
     except Exception as e:
@@ -94,11 +207,10 @@ def add_fridge_item(id):
 
 @fridge_bp.route('/add', methods=['POST'])
 def add_fridge_item_body():
-    auth = request.headers.get('Authorization')
-    if not auth or not auth.startswith('Bearer '):
+    token = bearer_token(request)
+    if not token:
         return jsonify({'error': 'missing authorization'}), 401
-    token = auth.replace('Bearer ', '')
-    user = User.query.filter_by(token=token).first()
+    user = resolve_user(token)
     if not user:
         return jsonify({'error': 'invalid token'}), 401
 
@@ -116,8 +228,10 @@ def add_fridge_item_body():
         except Exception:
             return jsonify({'error': 'invalid date format'}), 400
 
-        fi = FridgeItem(user_id=user.user_id, product_name=name, quantity=int(quantity), best_before_date=bbd_date)
+        fi = FridgeItem(user_id=user.user_id, product_name=name, quantity=int(quantity), best_before_date=bbd_date,
+                        version=next_version(user.user_id))
         db.session.add(fi)
+        record_change(user.user_id, bbd_date, 1)
         db.session.commit()
         return jsonify({'status': 'added', 'item': fi.as_dict()}), 200
     except Exception as e:
@@ -0,0 +1,240 @@
+import logging
+import os
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, utc_today, FridgeItem, FridgeSummary
+from jobs import job_handler
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_CHUNK_SIZE = int(os.getenv("FRIDGE_SUMMARY_CHUNK_SIZE", 1000))
+
+# counter -> (first, last) day, relative to as_of, a best_before_date has to fall in. None is open-ended.
+BUCKETS = {
+    'expired': (None, -1),
+    'expiring_today': (0, 0),
+    'expiring_3d': (0, 2),
+    'expiring_week': (0, 6),
+}
+COUNTERS = ('total_items',) + tuple(BUCKETS)
+
+
+def buckets_for(bbd, as_of):
+    offset = (bbd - as_of).days
+    return {name for name, (first, last) in BUCKETS.items() if (first is None or offset >= first) and offset <= last}
+
+
+def _summary_in_bucket(name, bbd):
+    # The row's own as_of decides, so a change never has to read the summary first
+    first, last = BUCKETS[name]
+    condition = FridgeSummary.as_of >= bbd - timedelta(days=last)
+    if first is not None:
+        condition = db.and_(condition, FridgeSummary.as_of <= bbd - timedelta(days=first))
+    return condition
+
+
+def _item_in_bucket(name, as_of):
+    first, last = BUCKETS[name]
+    condition = FridgeItem.best_before_date <= as_of + timedelta(days=last)
+    if first is not None:
+        condition = db.and_(condition, FridgeItem.best_before_date >= as_of + timedelta(days=first))
+    return condition
+
+
+def _next_expiry(since):
+    # Walks idx_fridge_user_status_bbd, so it's one index lookup per summary
+    return db.select(db.func.min(FridgeItem.best_before_date)).where(
+        FridgeItem.user_id == FridgeSummary.user_id,
+        FridgeItem.status == 'active',
+        FridgeItem.best_before_date >= since,
+    ).scalar_subquery()
+
+
+def record_changes(user_id, deltas):
+    """
+    Shifts the summary of user_id by {best_before_date: change in active items}, negative
+    for items removed or consumed, in a single UPDATE. Users without a summary are skipped,
+    theirs is built on first read. Does not commit.
+    """
+    deltas = {bbd: delta for bbd, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    values = {FridgeSummary.total_items: FridgeSummary.total_items + sum(deltas.values())}
+    for name in BUCKETS:
+        column = getattr(FridgeSummary, name)
+        values[column] = column + sum(db.case((_summary_in_bucket(name, bbd), delta), else_=0)
+                                      for bbd, delta in deltas.items())
+
+    removed = [bbd for bbd, delta in deltas.items() if delta < 0]
+    if removed:
+        db.session.flush()  # removed items must no longer count for the next expiry
+        values[FridgeSummary.next_expiry] = db.case(
+            (FridgeSummary.next_expiry.in_(removed), _next_expiry(FridgeSummary.as_of)),
+            else_=FridgeSummary.next_expiry)
+    else:
+        # Earliest added date that isn't before the row's as_of
+        added = sorted(deltas)
+        earliest = db.case(*[(FridgeSummary.as_of <= bbd, bbd) for bbd in added])
+        values[FridgeSummary.next_expiry] = db.case(
+            (db.and_(FridgeSummary.as_of <= added[-1],
+                     db.or_(FridgeSummary.next_expiry.is_(None), FridgeSummary.next_expiry > earliest)), earliest),
+            else_=FridgeSummary.next_expiry)
+    FridgeSummary.query.filter_by(user_id=user_id).update(values, synchronize_session=False)
+
+
+def record_change(user_id, bbd, delta):
+    record_changes(user_id, {bbd: delta})
+
+
+def record_added(user_id, bbds):
+    """
+    Counts many new active items of one user, e.g. a paid cart moved into the fridge.
+    """
+    record_changes(user_id, Counter(bbds))
+
+
+def compute(as_of, user_ids):
+    """
+    Summaries built from scratch from the fridge items, as {user_id: {column: value}}.
+    """
+    columns = [db.func.count(FridgeItem.fridge_item_id)]
+    for name in BUCKETS:
+        columns.append(db.func.coalesce(db.func.sum(db.case((_item_in_bucket(name, as_of), 1), else_=0)), 0))
+    columns.append(db.func.min(db.case((FridgeItem.best_before_date >= as_of, FridgeItem.best_before_date))))
+    rows = db.session.query(FridgeItem.user_id, *columns) \
+        .filter(FridgeItem.user_id.in_(user_ids), FridgeItem.status == 'active') \
+        .group_by(FridgeItem.user_id).all()
+
+    result = {user_id: dict(dict.fromkeys(COUNTERS, 0), next_expiry=None) for user_id in user_ids}
+    for user_id, *values in rows:
+        result[user_id] = dict(zip(COUNTERS + ('next_expiry',), values))
+    return result
+
+
+def rebuild(user_id, as_of):
+    """
+    Replaces the summary of one user with a fresh count. Does not commit.
+    """
+    values = compute(as_of, [user_id])[user_id]
+    summary = FridgeSummary.query.get(user_id)
+    if summary is None:
+        summary = FridgeSummary(user_id=user_id)
+        db.session.add(summary)
+    summary.as_of = as_of
+    for column, value in values.items():
+        setattr(summary, column, value)
+    return summary
+
+
+def roll_forward(today, user_id=None):
+    """
+    Moves summaries with as_of before today to today. Only items expiring on a day whose
+    buckets differ between the old and the new as_of are read, grouped per user and day.
+    Does not commit. Returns the number of summaries moved.
+    """
+    summaries = db.session.query(FridgeSummary.as_of).filter(FridgeSummary.as_of < today)
+    if user_id is not None:
+        summaries = summaries.filter(FridgeSummary.user_id == user_id)
+    rolled = 0
+    for (as_of,) in summaries.distinct().all():
+        # Items before as_of were expired and stay so, items after today + 6 days are in no bucket either way
+        days = [as_of + timedelta(days=n) for n in range((today - as_of).days + max(last for _, last in BUCKETS.values()) + 1)]
+        days = [day for day in days if buckets_for(day, as_of) != buckets_for(day, today)]
+
+        query = db.session.query(FridgeItem.user_id, FridgeItem.best_before_date, db.func.count(FridgeItem.fridge_item_id)) \
+            .join(FridgeSummary, FridgeSummary.user_id == FridgeItem.user_id) \
+            .filter(FridgeSummary.as_of == as_of, FridgeItem.status == 'active', FridgeItem.best_before_date.in_(days))
+        if user_id is not None:
+            query = query.filter(FridgeItem.user_id == user_id)
+
+        deltas = defaultdict(Counter)
+        for item_user_id, bbd, count in query.group_by(FridgeItem.user_id, FridgeItem.best_before_date).all():
+            before, after = buckets_for(bbd, as_of), buckets_for(bbd, today)
+            for name in after - before:
+                deltas[item_user_id][name] += count
+            for name in before - after:
+                deltas[item_user_id][name] -= count
+        for item_user_id, delta in deltas.items():
+            FridgeSummary.query.filter_by(user_id=item_user_id, as_of=as_of).update(
+                {getattr(FridgeSummary, name): getattr(FridgeSummary, name) + value for name, value in delta.items()},
+                synchronize_session=False)
+
+        moved = FridgeSummary.query.filter(FridgeSummary.as_of == as_of)
+        if user_id is not None:
+            moved = moved.filter(FridgeSummary.user_id == user_id)
+        rolled += moved.update({
+            FridgeSummary.as_of: today,
+            FridgeSummary.next_expiry: db.case(
+                (FridgeSummary.next_expiry < today, _next_expiry(today)), else_=FridgeSummary.next_expiry),
+        }, synchronize_session=False)
+    return rolled
+
+
+def get_summary(user_id, today=None):
+    """
+    The user's summary, normally a single primary key read. Built on first use and brought
+    up to date if the scheduler hasn't rolled it over to today yet.
+    """
+    today = today or utc_today()
+    summary = FridgeSummary.query.get(user_id)
+    if summary is None:
+        rebuild(user_id, today)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Built by a concurrent request in the meantime
+            db.session.rollback()
+        summary = FridgeSummary.query.get(user_id)
+    elif summary.as_of < today:
+        roll_forward(today, user_id)
+        db.session.commit()
+        summary = FridgeSummary.query.get(user_id)
+    return summary
+
+
+def reconcile(today=None):
+    """
+    Recounts every stored summary from the fridge items in user_id order, fixes the ones that
+    drifted and reports them.
+    """
+    today = today or utc_today()
+    roll_forward(today)
+    db.session.commit()
+
+    report = {'checked': 0, 'drifted': 0, 'examples': []}
+    last = None
+    while True:
+        query = FridgeSummary.query.filter(FridgeSummary.as_of == today)
+        if last is not None:
+            query = query.filter(FridgeSummary.user_id > last)
+        chunk = query.order_by(FridgeSummary.user_id).limit(RECONCILE_CHUNK_SIZE).all()
+        if not chunk:
+            return report
+
+        fresh = compute(today, [summary.user_id for summary in chunk])
+        for summary in chunk:
+            expected = fresh[summary.user_id]
+            drift = {column: {'stored': getattr(summary, column), 'actual': value}
+                     for column, value in expected.items() if getattr(summary, column) != value}
+            if drift:
+                report['drifted'] += 1
+                if len(report['examples']) < 10:
+                    report['examples'].append({'user_id': summary.user_id, 'drift': drift})
+                for column, value in expected.items():
+                    setattr(summary, column, value)
+        report['checked'] += len(chunk)
+        db.session.commit()
+        last = chunk[-1].user_id
+
+
+@job_handler('reconcile_fridge_summaries')
+def reconcile_job(payload):
+    report = reconcile()
+    if report['drifted']:
+        logger.warning("Fridge summaries drifted for %d of %d users, e.g. %s",
+                       report['drifted'], report['checked'], report['examples'][:3])
+    else:
+        logger.info("Fridge summaries consistent for %d users", report['checked'])
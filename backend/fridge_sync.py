@@ -0,0 +1,89 @@
+"""
+Delta sync for the mobile app. Every change to a user's fridge takes the next value of the
+user's version counter: added or changed items carry it in fridge_items.version, removed ones
+leave a tombstone with it. GET /fridge/changes?since=<version> returns what changed after that.
+Tombstones are compacted away after FRIDGE_TOMBSTONE_RETENTION_DAYS; a client asking for a
+version from before the compaction gets a full resync instead.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from models import db, FridgeItem, FridgeSync, FridgeTombstone, dialect_insert
+from jobs import job_handler
+
+logger = logging.getLogger(__name__)
+
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("FRIDGE_TOMBSTONE_RETENTION_DAYS", 30))
+COMPACT_CHUNK_SIZE = int(os.getenv("FRIDGE_COMPACT_CHUNK_SIZE", 1000))    # users per compaction transaction
+
+
+def next_version(user_id):
+    """
+    Increments the user's fridge version and returns it, in one statement. The counter row
+    stays locked until the caller commits, so one user's changes become visible in version order.
+    Does not commit.
+    """
+    stmt = dialect_insert(FridgeSync).values(user_id=user_id, version=1) \
+        .on_conflict_do_update(index_elements=[FridgeSync.user_id], set_={'version': FridgeSync.version + 1}) \
+        .returning(FridgeSync.version)
+    return db.session.execute(stmt).scalar_one()
+
+
+def record_removed(user_id, fridge_item_ids, version):
+    """
+    Leaves tombstones for deleted items. Does not commit.
+    """
+    if fridge_item_ids:
+        db.session.execute(db.insert(FridgeTombstone), [
+            {'fridge_item_id': fridge_item_id, 'user_id': user_id, 'version': version}
+            for fridge_item_id in fridge_item_ids])
+
+
+def changes_since(user_id, since):
+    """
+    {'version', 'resync', 'upserts', 'tombstones'} for a client that has seen everything up to
+    version since. upserts are items changed after it in any status (consumed ones included),
+    tombstones the ids of items removed after it. With since None, behind the compaction or
+    ahead of the server, resync is true and upserts holds every active item instead.
+    """
+    # The version is read first: whatever commits while the rest is read shows up again next time
+    state = FridgeSync.query.get(user_id)
+    version = state.version if state else 0
+    compacted_through = state.compacted_through if state else 0
+    if since is None or since < compacted_through or since > version:
+        items = FridgeItem.query.filter_by(user_id=user_id, status='active').all()
+        return {'version': version, 'resync': True, 'upserts': items, 'tombstones': []}
+
+    tombstones = db.session.query(FridgeTombstone.fridge_item_id) \
+        .filter(FridgeTombstone.user_id == user_id, FridgeTombstone.version > since).all()
+    items = FridgeItem.query.filter(FridgeItem.user_id == user_id, FridgeItem.version > since).all()
+    return {'version': version, 'resync': False, 'upserts': items,
+            'tombstones': [row.fridge_item_id for row in tombstones]}
+
+
+def compact(now=None):
+    """
+    Drops tombstones older than the retention period and moves each affected user's
+    compacted_through up to the newest one dropped. Returns the number of tombstones removed.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    removed = 0
+    while True:
+        chunk = db.session.query(FridgeTombstone.user_id, db.func.max(FridgeTombstone.version)) \
+            .filter(FridgeTombstone.removed_at < cutoff) \
+            .group_by(FridgeTombstone.user_id).order_by(FridgeTombstone.user_id).limit(COMPACT_CHUNK_SIZE).all()
+        if not chunk:
+            return removed
+        for user_id, through in chunk:
+            FridgeSync.query.filter(FridgeSync.user_id == user_id, FridgeSync.compacted_through < through) \
+                .update({FridgeSync.compacted_through: through}, synchronize_session=False)
+            removed += FridgeTombstone.query.filter(FridgeTombstone.user_id == user_id,
+                                                    FridgeTombstone.version <= through) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+
+
+@job_handler('compact_fridge_tombstones')
+def compact_job(payload):
+    logger.info("Compacted %d fridge tombstones", compact())
@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('BACKEND_PORT', 8080)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Build the app once in the master, workers are forked from it
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared by the forked workers
+    from wsgi import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,207 @@
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = float(os.getenv("JOBS_BACKOFF_BASE", 5))    # seconds before the first retry
+BACKOFF_MAX = float(os.getenv("JOBS_BACKOFF_MAX", 600))    # upper bound for a single retry delay
+STALE_AFTER = float(os.getenv("JOBS_STALE_AFTER", 300))    # running jobs not heard from for this long are requeued
+HEARTBEAT_INTERVAL = float(os.getenv("JOBS_HEARTBEAT_INTERVAL", STALE_AFTER / 5))    # how often a running job touches updated_at
+
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """
+    Registers a function as the handler for jobs of the given kind.
+    The handler is called with the decoded payload inside an app context.
+    """
+    def register(f):
+        HANDLERS[kind] = f
+        return f
+    return register
+
+
+def enqueue(kind, payload=None, max_attempts=5, delay=0):
+    """
+    Adds a job to the current session. Nothing is queued until the caller commits,
+    so the job is only visible to workers if the surrounding transaction succeeds.
+    """
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    return job
+
+
+def queue_depth():
+    rows = db.session.query(Job.status, db.func.count(Job.job_id)).group_by(Job.status).all()
+    depth = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+    depth.update({status: count for status, count in rows})
+    return depth
+
+
+def backoff_delay(attempts):
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim_jobs(limit):
+    """
+    Marks up to limit due jobs as running and returns their ids.
+    Each claim is a conditional UPDATE, so two workers never get the same job.
+    """
+    now = datetime.utcnow()
+    candidates = db.session.query(Job.job_id) \
+        .filter(Job.status == 'queued', Job.run_at <= now) \
+        .order_by(Job.run_at).limit(limit).all()
+    claimed = []
+    for (job_id,) in candidates:
+        updated = Job.query.filter_by(job_id=job_id, status='queued') \
+            .update({Job.status: 'running', Job.updated_at: now}, synchronize_session=False)
+        if updated:
+            claimed.append(job_id)
+    db.session.commit()
+    return claimed
+
+
+def requeue_stale():
+    """
+    Puts jobs back in the queue whose worker died while running them. The lost run counts
+    as an attempt, so a job that keeps killing its worker ends up failed instead of looping.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=STALE_AFTER)
+    stale = (Job.status == 'running', Job.updated_at < cutoff)
+    failed = Job.query.filter(*stale, Job.attempts + 1 >= Job.max_attempts) \
+        .update({Job.status: 'failed', Job.attempts: Job.attempts + 1, Job.updated_at: now,
+                 Job.last_error: 'Worker stopped while running the job'}, synchronize_session=False)
+    count = Job.query.filter(*stale) \
+        .update({Job.status: 'queued', Job.attempts: Job.attempts + 1, Job.updated_at: now},
+                synchronize_session=False)
+    db.session.commit()
+    if failed:
+        logger.warning("%d stale jobs ran out of attempts", failed)
+    return count
+
+
+def heartbeat(app, job_id, stop):
+    """
+    Touches updated_at of a running job every HEARTBEAT_INTERVAL until stop is set,
+    so a long job isn't mistaken for one whose worker died.
+    """
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        with app.app_context():
+            try:
+                Job.query.filter_by(job_id=job_id, status='running') \
+                    .update({Job.updated_at: datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                logger.exception("Heartbeat for job %s failed", job_id)
+
+
+def run_job(job_id):
+    job = Job.query.get(job_id)
+    if not job:
+        return
+    handler = HANDLERS.get(job.kind)
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for job kind '{job.kind}'")
+        handler(json.loads(job.payload))
+        db.session.commit()
+        job.status = 'done'
+        job.last_error = None
+    except Exception as e:
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        logger.exception("Job %s (%s) failed", job_id, job.kind)
+        job.last_error = str(e)
+        if job.attempts + 1 >= job.max_attempts:
+            job.status = 'failed'
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=backoff_delay(job.attempts + 1))
+    job.attempts += 1
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+def run_worker(app, concurrency=4, poll_interval=1.0, once=False):
+    """
+    Polls the jobs table and runs due jobs on a pool of at most `concurrency` threads.
+    With once=True it drains what is currently due and returns.
+    """
+    def run_in_context(job_id):
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(app, job_id, stop), daemon=True)
+        beat.start()
+        try:
+            with app.app_context():
+                run_job(job_id)
+        finally:
+            stop.set()
+            beat.join()
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            in_flight = {f for f in in_flight if not f.done()}
+            free = concurrency - len(in_flight)
+            job_ids = []
+            if free > 0:
+                with app.app_context():
+                    requeue_stale()
+                    job_ids = claim_jobs(free)
+                for job_id in job_ids:
+                    in_flight.add(pool.submit(run_in_context, job_id))
+            if once and not job_ids and not in_flight:
+                return
+            if not job_ids:
+                time.sleep(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreshReminder background jobs")
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help="run a worker process")
+    worker.add_argument('--concurrency', type=int, default=int(os.getenv("JOBS_CONCURRENCY", 4)))
+    worker.add_argument('--poll-interval', type=float, default=1.0)
+    worker.add_argument('--once', action='store_true', help="drain due jobs and exit")
+    sub.add_parser('depth', help="print the number of jobs per status")
+    add = sub.add_parser('enqueue', help="queue a job, e.g. reconcile_fridge_summaries")
+    add.add_argument('kind')
+    add.add_argument('--payload', default='{}', help="JSON payload")
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app(reset_db=False)
+
+    if args.command == 'worker':
+        logging.basicConfig(level=logging.INFO)
+        run_worker(app, concurrency=args.concurrency, poll_interval=args.poll_interval, once=args.once)
+    elif args.command == 'depth':
+        with app.app_context():
+            print(json.dumps(queue_depth()))
+    elif args.command == 'enqueue':
+        with app.app_context():
+            job = enqueue(args.kind, json.loads(args.payload))
+            db.session.commit()
+            print(job.job_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import logging
+import os
+import queue
+import smtplib
+from threading import BoundedSemaphore, Lock
+
+logger = logging.getLogger(__name__)
+
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 25))
+MAILER_POOL_SIZE = int(os.getenv("MAILER_POOL_SIZE", 4))
+MAILER_TIMEOUT = float(os.getenv("MAILER_TIMEOUT", 10))    # seconds, for connecting and for each SMTP command
+
+
+def is_connection_error(error):
+    """
+    True if the connection can't be trusted any more. SMTPException is itself an OSError,
+    so a rejection by the server (e.g. bad recipient) has to be told apart from a socket error.
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class MailerUnavailable(RuntimeError):
+    pass
+
+
+class SMTPPool:
+    """
+    Keeps up to `size` SMTP connections open and reuses them between messages.
+    A connection that fails is dropped and the message retried once on a fresh one.
+    """
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, size=MAILER_POOL_SIZE, timeout=MAILER_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = BoundedSemaphore(size)
+        self._lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.connects = 0
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        with self._lock:
+            self.connects += 1
+        return connection
+
+    def _acquire(self):
+        # An idle connection, or None when a new one has to be opened by the caller
+        if not self._slots.acquire(timeout=self.timeout):
+            raise MailerUnavailable("all SMTP connections are busy")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _release(self, connection):
+        if connection is not None:
+            self._idle.put(connection)
+        self._slots.release()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _count(self, sent=0, failed=0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+
+    def send_batch(self, messages):
+        """
+        Sends (from_addr, to_addrs, msg) tuples over one pooled connection.
+        Returns the messages that could not be sent; they are also counted as failures.
+        """
+        failures = []
+        connection = self._acquire()
+        try:
+            for from_addr, to_addrs, msg in messages:
+                body = msg if isinstance(msg, (str, bytes)) else msg.as_string()
+                for attempt in (1, 2):
+                    try:
+                        if connection is None:
+                            connection = self._connect()
+                        connection.sendmail(from_addr, to_addrs, body)
+                        self._count(sent=1)
+                        break
+                    except OSError as e:
+                        if not is_connection_error(e):
+                            # Rejected by the server, the connection itself is fine
+                            logger.warning("Mail to %s rejected: %s", to_addrs, e)
+                            failures.append((from_addr, to_addrs, msg))
+                            self._count(failed=1)
+                            break
+                        if connection is not None:
+                            self._close(connection)
+                        connection = None
+                        if attempt == 2:
+                            logger.exception("Could not send mail to %s", to_addrs)
+                            failures.append((from_addr, to_addrs, msg))
+                            self._count(failed=1)
+        finally:
+            self._release(connection)
+        return failures
+
+    def send(self, from_addr, to_addrs, msg):
+        failures = self.send_batch([(from_addr, to_addrs, msg)])
+        if failures:
+            raise smtplib.SMTPException(f"Could not send mail to {to_addrs}")
+
+    def stats(self):
+        with self._lock:
+            return {'sent': self.sent, 'failed': self.failed, 'connects': self.connects}
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                connection.quit()
+            except Exception:
+                self._close(connection)
+
+
+mailer = SMTPPool()
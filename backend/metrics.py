@@ -0,0 +1,172 @@
+import logging
+import os
+import time
+from collections import Counter, defaultdict
+from threading import Lock
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+QUERY_THRESHOLD = int(os.getenv("METRICS_QUERY_THRESHOLD", 20))    # more statements than this flags a request
+REPEAT_THRESHOLD = int(os.getenv("METRICS_REPEAT_THRESHOLD", 5))   # same statement this often hints at N+1
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.total}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.total}'
+
+
+class Registry:
+    """
+    Process-local metrics. With several workers, each one exposes its own numbers.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = Counter()                 # (endpoint, method, status) -> count
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self.sql_seconds = defaultdict(float)
+        self.flagged = Counter()                  # (endpoint, reason) -> count
+
+    def record(self, endpoint, method, status, seconds, statements, sql_seconds, flags):
+        with self.lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.latency[endpoint].observe(seconds)
+            self.statements[endpoint].observe(statements)
+            self.sql_seconds[endpoint] += sql_seconds
+            for reason in flags:
+                self.flagged[(endpoint, reason)] += 1
+
+    def render(self):
+        out = []
+        with self.lock:
+            out.append('# TYPE freshreminder_requests_total counter')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                out.append(f'freshreminder_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            out.append('# TYPE freshreminder_request_duration_seconds histogram')
+            for endpoint, histogram in sorted(self.latency.items()):
+                out.extend(histogram.lines('freshreminder_request_duration_seconds', f'endpoint="{endpoint}"'))
+            out.append('# TYPE freshreminder_request_sql_statements histogram')
+            for endpoint, histogram in sorted(self.statements.items()):
+                out.extend(histogram.lines('freshreminder_request_sql_statements', f'endpoint="{endpoint}"'))
+            out.append('# TYPE freshreminder_request_sql_seconds_total counter')
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                out.append(f'freshreminder_request_sql_seconds_total{{endpoint="{endpoint}"}} {seconds}')
+            out.append('# TYPE freshreminder_flagged_requests_total counter')
+            for (endpoint, reason), count in sorted(self.flagged.items()):
+                out.append(f'freshreminder_flagged_requests_total{{endpoint="{endpoint}",reason="{reason}"}} {count}')
+        return '\n'.join(out) + '\n'
+
+
+registry = Registry()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or not conn.info.get('metrics_start'):
+        return
+    elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+    if 'metrics_statements' in g:
+        g.metrics_statements[statement] += 1
+        g.metrics_sql_seconds += elapsed
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_statements = Counter()
+    g.metrics_sql_seconds = 0.0
+
+
+def _finish_request(response):
+    if 'metrics_start' not in g:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    if endpoint == 'metrics':
+        return response
+    # A streamed body runs its queries after this hook, so it is recorded once the body is sent
+    # Nothing here may refer to response, or the callback would keep it in a reference cycle
+    state = g._get_current_object()
+    method, path, status = request.method, request.path, response.status_code
+
+    def record():
+        seconds = time.perf_counter() - state.metrics_start
+        statements = sum(state.metrics_statements.values())
+
+        flags = []
+        if statements > QUERY_THRESHOLD:
+            flags.append('query_threshold')
+            logger.warning("%s %s ran %d SQL statements (threshold %d)", method, path, statements, QUERY_THRESHOLD)
+        if state.metrics_statements:
+            statement, repeats = state.metrics_statements.most_common(1)[0]
+            if repeats >= REPEAT_THRESHOLD:
+                flags.append('n_plus_one')
+                logger.warning("%s %s ran the same statement %d times, likely N+1: %s",
+                               method, path, repeats, ' '.join(statement.split())[:200])
+
+        registry.record(endpoint, method, status, seconds, statements, state.metrics_sql_seconds, flags)
+
+    if response.is_streamed:
+        response.call_on_close(record)
+    else:
+        record()
+    return response
+
+
+def render_metrics():
+    text = registry.render()
+    from extensions import token_cache
+    stats = token_cache.stats()
+    text += '# TYPE freshreminder_token_cache_hits_total counter\n'
+    text += f'freshreminder_token_cache_hits_total {stats["hits"]}\n'
+    text += '# TYPE freshreminder_token_cache_misses_total counter\n'
+    text += f'freshreminder_token_cache_misses_total {stats["misses"]}\n'
+    from mailer import mailer
+    stats = mailer.stats()
+    for name in ('sent', 'failed', 'connects'):
+        text += f'# TYPE freshreminder_mail_{name}_total counter\n'
+        text += f'freshreminder_mail_{name}_total {stats[name]}\n'
+    from payment import breaker
+    text += '# TYPE freshreminder_stripe_circuit_open gauge\n'
+    text += f'freshreminder_stripe_circuit_open {int(breaker.state == "open")}\n'
+    return text
+
+
+def init_metrics(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
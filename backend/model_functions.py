@@ -1,95 +1,352 @@
-from models import db, Cart, CartItem, Product, Store
-import smtplib
-import smtplib
+import os
+from collections import Counter
+from itertools import groupby
+from models import db, utc_today, Cart, CartItem, CartItemLot, Product, ProductLot, Store, FridgeItem, PaymentSession, dialect_insert
+from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-from weasyprint import HTML
-import tempfile
-import os
+from receipts import renderer, render_email_body
+from mailer import mailer
+from fridge_summary import record_added
+from fridge_sync import next_version
+
+CART_TTL = timedelta(hours=float(os.getenv("CART_TTL_HOURS", 24)))                # unpaid carts untouched this long are swept
+PAYMENT_HOLD = timedelta(hours=float(os.getenv("CART_PAYMENT_HOLD_HOURS", 25)))   # Stripe checkout sessions live 24 hours
+CART_SWEEP_CHUNK_SIZE = int(os.getenv("CART_SWEEP_CHUNK_SIZE", 500))               # carts deleted per transaction
 
 def compute_cart_price(cart_id):
-    total_price = 0
+    # One joined aggregate instead of a Product lookup per cart line
+    total_price = db.session.query(
+        db.func.coalesce(db.func.sum(CartItem.quantity * Product.price), 0.0)
+    ).join(Product, Product.product_id == CartItem.product_id) \
+     .filter(CartItem.cart_id == cart_id).scalar()
+    return total_price
+
 
+def adjust_cart_price(cart_id, delta):
+    """
+    Shifts the stored running total of a cart by delta, and keeps the cart alive for another CART_TTL.
+    Done as a single UPDATE so concurrent edits of the same cart don't overwrite each other.
+    """
+    Cart.query.filter_by(cart_id=cart_id).update(
+        {Cart.price: Cart.price + delta, Cart.expires_at: _not_before(datetime.utcnow() + CART_TTL)},
+        synchronize_session=False
+    )
+
+
+def extend_cart(cart_id, ttl=CART_TTL):
+    """
+    Moves the cart's expiry to at least ttl from now, e.g. PAYMENT_HOLD once checkout has started. Does not commit.
+    """
+    Cart.query.filter_by(cart_id=cart_id).update(
+        {Cart.expires_at: _not_before(datetime.utcnow() + ttl)}, synchronize_session=False
+    )
+
+
+def _not_before(expires_at):
+    # Never shortens an expiry, so a cart edited during checkout keeps its payment hold
+    return db.case((Cart.expires_at > expires_at, Cart.expires_at), else_=expires_at)
+
+
+def expired_carts(now):
+    return db.and_(Cart.payed == False, db.or_(
+        Cart.expires_at < now,
+        db.and_(Cart.expires_at.is_(None), Cart.created_at < now - CART_TTL),  # carts from before expires_at existed
+    ))
+
+
+def delete_carts(cart_ids, condition=None):
+    """
+    Deletes unpaid carts with their items and payment sessions, and puts the stock they held
+    back on its lots. Paid carts are left alone, they are the order history. With condition
+    only the carts still matching it are touched. Returns the rows reclaimed, does not commit.
+    """
+    eligible = db.select(Cart.cart_id).where(Cart.cart_id.in_(cart_ids), Cart.payed == False)
+    if condition is not None:
+        eligible = eligible.where(condition)
+    lines = db.select(CartItem.cart_item_id).where(CartItem.cart_id.in_(eligible))
+    held = db.session.query(CartItemLot.lot_id, db.func.sum(CartItemLot.quantity)) \
+        .join(CartItem, CartItem.cart_item_id == CartItemLot.cart_item_id) \
+        .filter(CartItem.cart_id.in_(eligible)) \
+        .group_by(CartItemLot.lot_id).all()
+    release_stocks(dict(held))
+    CartItemLot.query.filter(CartItemLot.cart_item_id.in_(lines)).delete(synchronize_session=False)
+    return {
+        'units_released': sum(quantity for _, quantity in held),
+        'items': CartItem.query.filter(CartItem.cart_id.in_(eligible)).delete(synchronize_session=False),
+        'payment_sessions': PaymentSession.query.filter(PaymentSession.cart_id.in_(eligible)).delete(synchronize_session=False),
+        'carts': Cart.query.filter(Cart.cart_id.in_(eligible)).delete(synchronize_session=False),
+    }
+
+
+def sweep_expired_carts(now=None, chunk_size=CART_SWEEP_CHUNK_SIZE):
+    """
+    Deletes unpaid carts past their expiry, chunk_size carts per transaction so locks are only
+    held briefly. Carts a request has locked right now are left for the next run.
+    Returns the rows reclaimed.
+    """
+    now = now or datetime.utcnow()
+    report = Counter(chunks=0, carts=0, items=0, payment_sessions=0, units_released=0)
+    while True:
+        cart_ids = [cart_id for (cart_id,) in db.session.query(Cart.cart_id).filter(expired_carts(now))
+                    .limit(chunk_size).with_for_update(skip_locked=True).all()]
+        if not cart_ids:
+            break
+        # Checked again while deleting: a cart paid or edited since the read stays
+        report.update(delete_carts(cart_ids, expired_carts(now)))
+        report['chunks'] += 1
+        db.session.commit()
+        if len(cart_ids) < chunk_size:
+            break
+    db.session.commit()
+    return dict(report)
+
+
+def check_cart_price(cart_id):
+    """
+    Compares the running total stored on the cart against a full recompute.
+    """
     cart = Cart.query.get(cart_id)
     if not cart:
-        return 0
+        return None
+    computed = compute_cart_price(cart_id)
+    return {
+        'cart_id': cart_id,
+        'stored_price': cart.price,
+        'computed_price': computed,
+        'consistent': abs(cart.price - computed) < 0.005,
+    }
 
-    cart_items = CartItem.query.filter_by(cart_id=cart_id).all()
 
-    for item in cart_items:
-        product = Product.query.get(item.product_id)
-        if product:
-            total_price += item.quantity * product.price
-    return total_price
+class OutOfStock(Exception):
+    def __init__(self, product_id):
+        super().__init__(f"Not enough stock for product {product_id}")
+        self.product_id = product_id
 
 
+def _take_from_lot(lot_id, quantity):
+    # Conditional decrement: succeeds only while the lot still holds enough, no read-modify-write
+    return ProductLot.query.filter(
+        ProductLot.lot_id == lot_id, ProductLot.quantity_available >= quantity
+    ).update({ProductLot.quantity_available: ProductLot.quantity_available - quantity},
+             synchronize_session=False) == 1
 
 
-def send_receipt_email(to_email, from_email, items, total_price):
-    # ---- 1. Create HTML email body ----
-    html_body = f"""
-    <html>
-        <body>
-            <h2>Thank you for using our services!</h2>
-            <p>We truly appreciate your purchase.</p>
-            <p><strong>Total Price:</strong> ${total_price}</p>
-            <p>Please find your detailed receipt attached as a PDF.</p>
-        </body>
-    </html>
-    """
-
-    # ---- 2. Create PDF from HTML template ----
-    pdf_template = """
-    <html>
-        <body>
-            <h1>Receipt</h1>
-            <p>ITEMS</p>
-        </body>
-    </html>
-    """
-
-    item_lines = ""
-    for item in items:
-        item_lines += f"{item['name']} {item['quantity']} {item['price']}<br>"
-
-    pdf_html = pdf_template.replace("ITEMS", item_lines)
-
-    # Generate PDF in temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        HTML(string=pdf_html).write_pdf(tmp_file.name)
-        tmp_file_path = tmp_file.name
-
-    # ---- 3. Build Email ----
+def reserve_stock(product, quantity):
+    """
+    Takes quantity units of a product off the shelf and returns {lot_id: units} they come from.
+    Lots are used in expiry order (first-expired, first-out), so a line may span several lots.
+    Returns {} for products whose stock isn't tracked in lots, raises OutOfStock when the
+    unexpired lots together hold too little. Does not commit; on OutOfStock the caller rolls back.
+    """
+    taken = {}
+    needed = quantity
+    while needed:
+        candidates = db.session.query(ProductLot.lot_id, ProductLot.quantity_available).filter(
+            ProductLot.store_id == product.store_id,
+            ProductLot.product_id == product.product_id,
+            ProductLot.best_before_date >= utc_today(),
+            ProductLot.quantity_available > 0,
+        ).order_by(ProductLot.best_before_date, ProductLot.lot_id).limit(5).all()
+        if not candidates:
+            break
+        for candidate, available in candidates:
+            units = min(available, needed)
+            if _take_from_lot(candidate, units):
+                taken[candidate] = taken.get(candidate, 0) + units
+                needed -= units
+                if not needed:
+                    break
+        # A lot was drained by a concurrent shopper since the read, look again
+
+    if not needed:
+        return taken
+    tracked = taken or db.session.query(
+        ProductLot.query.filter_by(store_id=product.store_id, product_id=product.product_id).exists()).scalar()
+    if tracked:
+        raise OutOfStock(product.product_id)
+    return {}
+
+
+def hold_stock(cart_item_id, taken):
+    """
+    Books {lot_id: units} from reserve_stock on a cart line. Does not commit.
+    """
+    if not taken:
+        return
+    statement = dialect_insert(CartItemLot)
+    statement = statement.on_conflict_do_update(
+        index_elements=['cart_item_id', 'lot_id'],
+        set_={'quantity': CartItemLot.quantity + statement.excluded.quantity},
+    )
+    db.session.execute(statement, [{'cart_item_id': cart_item_id, 'lot_id': lot_id, 'quantity': units}
+                                   for lot_id, units in taken.items()])
+
+
+def release_line(cart_item_id, quantity=None):
+    """
+    Puts quantity units of a cart line (all of them by default) back on their lots. The
+    latest-expiring units go back first, so the line keeps the stock that has to leave soonest.
+    Does not commit.
+    """
+    held = db.session.query(CartItemLot.lot_id, CartItemLot.quantity) \
+        .join(ProductLot, ProductLot.lot_id == CartItemLot.lot_id) \
+        .filter(CartItemLot.cart_item_id == cart_item_id) \
+        .order_by(ProductLot.best_before_date.desc(), ProductLot.lot_id.desc()).all()
+    remaining = sum(units for _, units in held) if quantity is None else quantity
+    released = {}
+    for lot_id, units in held:
+        if remaining <= 0:
+            break
+        released[lot_id] = min(units, remaining)
+        remaining -= released[lot_id]
+        row = CartItemLot.query.filter_by(cart_item_id=cart_item_id, lot_id=lot_id)
+        if released[lot_id] == units:
+            row.delete(synchronize_session=False)
+        else:
+            row.update({CartItemLot.quantity: CartItemLot.quantity - released[lot_id]}, synchronize_session=False)
+    release_stocks(released)
+
+
+def line_lots(cart_item_ids):
+    """
+    {cart_item_id: [{'lot_id', 'quantity'}, ...]} in expiry order, for cart responses.
+    """
+    lots = {cart_item_id: [] for cart_item_id in cart_item_ids}
+    rows = db.session.query(CartItemLot.cart_item_id, CartItemLot.lot_id, CartItemLot.quantity) \
+        .join(ProductLot, ProductLot.lot_id == CartItemLot.lot_id) \
+        .filter(CartItemLot.cart_item_id.in_(cart_item_ids)) \
+        .order_by(ProductLot.best_before_date, ProductLot.lot_id).all()
+    for cart_item_id, lot_id, quantity in rows:
+        lots[cart_item_id].append({'lot_id': lot_id, 'quantity': quantity})
+    return lots
+
+
+def release_stocks(quantities):
+    """
+    Puts {lot_id: quantity} back on many lots with a single UPDATE. Does not commit.
+    """
+    quantities = {lot_id: quantity for lot_id, quantity in quantities.items() if lot_id is not None and quantity > 0}
+    if not quantities:
+        return
+    ProductLot.query.filter(ProductLot.lot_id.in_(quantities)).update(
+        {ProductLot.quantity_available: ProductLot.quantity_available
+         + db.case(quantities, value=ProductLot.lot_id, else_=0)}, synchronize_session=False
+    )
+
+
+def split_by_lot(rows):
+    """
+    Turns rows of (cart_item_id, line quantity, lot quantity, *fields, lot_id, lot date, product date),
+    one per lot of a line and ordered by line, into (*fields, quantity, lot_id, best_before_date)
+    per lot. The lot carries the exact expiry of what was sold, the product date is only a
+    fallback, e.g. for units added before the product's stock was tracked in lots.
+    """
+    for _, parts in groupby(rows, key=lambda row: row[0]):
+        unallocated = None
+        for _, line_quantity, lot_quantity, *fields, lot_id, lot_bbd, product_bbd in parts:
+            if unallocated is None:
+                unallocated = line_quantity
+            quantity = lot_quantity if lot_id is not None else line_quantity
+            unallocated -= quantity
+            yield (*fields, quantity, lot_id, _as_date(lot_bbd or product_bbd))
+        if unallocated > 0:
+            yield (*fields, unallocated, None, _as_date(product_bbd))
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def cart_lines(cart_id):
+    """
+    The lines of a cart with their product, in one joined read, as
+    (user_id, product_id, store_id, product_name, price, quantity, lot_id, best_before_date) rows,
+    one per lot a line was reserved from.
+    """
+    rows = db.session.query(CartItem.cart_item_id, CartItem.quantity, CartItemLot.quantity,
+                            Cart.user_id, Product.product_id, Product.store_id, Product.product_name, Product.price,
+                            CartItemLot.lot_id, ProductLot.best_before_date, Product.best_before_date) \
+        .join(CartItem, CartItem.cart_id == Cart.cart_id) \
+        .join(Product, Product.product_id == CartItem.product_id) \
+        .outerjoin(CartItemLot, CartItemLot.cart_item_id == CartItem.cart_item_id) \
+        .outerjoin(ProductLot, ProductLot.lot_id == CartItemLot.lot_id) \
+        .filter(Cart.cart_id == cart_id) \
+        .order_by(CartItem.cart_item_id, ProductLot.best_before_date).all()
+    return list(split_by_lot(rows))
+
+
+def transfer_cart_to_fridge(cart_id, lines=None):
+    """
+    Copies every line of a cart into its owner's fridge with one joined read and one bulk insert.
+    Pass lines when the caller already has cart_lines(cart_id).
+    Does not commit, so it becomes part of the caller's transaction.
+    """
+    fridge_items = [{
+        'user_id': user_id,
+        'product_id': product_id,
+        'store_id': store_id,
+        'product_name': product_name,
+        'lot_id': lot_id,
+        'quantity': quantity,
+        'best_before_date': bbd,
+    } for user_id, product_id, store_id, product_name, price, quantity, lot_id, bbd in
+        (cart_lines(cart_id) if lines is None else lines)]
+    if fridge_items:
+        # The whole cart arrives as one change
+        version = next_version(fridge_items[0]['user_id'])
+        for item in fridge_items:
+            item['version'] = version
+        db.session.execute(db.insert(FridgeItem), fridge_items)
+        record_added(fridge_items[0]['user_id'], [item['best_before_date'] for item in fridge_items])
+    return len(fridge_items)
+
+
+def build_receipt_message(to_email, from_email, total_price, pdf):
     msg = MIMEMultipart()
     msg["Subject"] = "Receipt for your purchase"
     msg["From"] = from_email
     msg["To"] = to_email
 
     # Attach HTML body
-    msg.attach(MIMEText(html_body, "html"))
+    msg.attach(MIMEText(render_email_body(total_price), "html"))
 
     # Attach PDF
-    with open(tmp_file_path, "rb") as f:
-        pdf_attachment = MIMEApplication(f.read(), _subtype="pdf")
-        pdf_attachment.add_header(
-            "Content-Disposition",
-            "attachment",
-            filename="receipt.pdf",
-        )
-        msg.attach(pdf_attachment)
+    pdf_attachment = MIMEApplication(pdf, _subtype="pdf")
+    pdf_attachment.add_header(
+        "Content-Disposition",
+        "attachment",
+        filename="receipt.pdf",
+    )
+    msg.attach(pdf_attachment)
+    return msg
+
 
-    # ---- 4. Send Email ----
-    with smtplib.SMTP("localhost") as server:
-        server.sendmail(from_email, [to_email], msg.as_string())
+def send_receipt_email(to_email, from_email, items, total_price):
+    # PDF is rendered in memory on the receipt process pool, see receipts.py
+    pdf = renderer.render(items, total_price)
+    msg = build_receipt_message(to_email, from_email, total_price, pdf)
 
-    # Cleanup
-    os.remove(tmp_file_path)
+    mailer.send(from_email, [to_email], msg)
+
+
+def send_receipt_emails(receipts, from_email):
+    """
+    Sends many receipts at once, e.g. when re-sending. receipts: list of (to_email, items, total_price).
+    All PDFs are rendered in parallel first, then sent as one batch over a pooled connection.
+    Returns the positions in `receipts` that could not be sent.
+    """
+    pdfs = renderer.render_batch((items, total_price) for _, items, total_price in receipts)
+    messages = [
+        (from_email, [to_email], build_receipt_message(to_email, from_email, total_price, pdf))
+        for (to_email, _, total_price), pdf in zip(receipts, pdfs)
+    ]
+    failures = {id(msg) for _, _, msg in mailer.send_batch(messages)}
+    return [i for i, (_, _, msg) in enumerate(messages) if id(msg) in failures]
 
 
 def get_store_from_cart_id(cart_id):
-    cart = Cart.query.get(cart_id)
-    item = CartItem.query.filter_by(cart_id=cart_id).first()
-    if len(item) < 1:
-        return None
-    return Store.query.get(Product.query.get(item.product_id).store_id)
+    return Store.query.join(Product, Product.store_id == Store.store_id) \
+        .join(CartItem, CartItem.product_id == Product.product_id) \
+        .filter(CartItem.cart_id == cart_id).first()
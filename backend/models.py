@@ -2,20 +2,30 @@ from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 import uuid
+from db_routing import RoutingSession
+from serializers import PRODUCT, PRODUCT_LOT, FRIDGE_ITEM, FRIDGE_SUMMARY, EMPLOYEE
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Bump whenever a model change needs the database to be migrated, see db_schema.py
+SCHEMA_VERSION = 13
 
 
 def gen_uuid():
     return str(uuid.uuid4())
 
 
+def utc_today():
+    # Timestamps are stored in UTC, so days (expiry, rollups, rollover) are UTC days too
+    return datetime.utcnow().date()
+
+
 class User(db.Model):
     __tablename__ = 'users'
     user_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
     email = db.Column(db.String(255), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
-    token = db.Column(db.String(255), nullable=True)
+    token = db.Column(db.String(255), nullable=True, index=True)
     is_authenticated = db.Column(db.BOOLEAN, default = False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -34,6 +44,7 @@ class Store(db.Model):
     store_name = db.Column(db.String(255), nullable=False)
     token = db.Column(db.String(255), nullable=True, default=gen_uuid)
     manager_id = db.Column(db.String(36), db.ForeignKey('employees.employee_id'), nullable=False)
+    catalog_version = db.Column(db.Integer, nullable=False, default=0) # bumped with every product change, see catalog_cache
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Employee(db.Model):
@@ -45,22 +56,69 @@ class Employee(db.Model):
     is_manager = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    def to_dict(self): # without password_hash
+        return EMPLOYEE.dump(self)
+
 class Product(db.Model): #In store
     __tablename__ = 'products'
     store_id = db.Column(db.String(36), db.ForeignKey('stores.store_id'), nullable=False)
     product_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
+    barcode = db.Column(db.String(50), nullable=True)
     product_name = db.Column(db.String(255), nullable=False)
+    brand = db.Column(db.String(255), nullable=True)
+    category = db.Column(db.String(100), nullable=True)
+    default_shelf_life_days = db.Column(db.Integer, nullable=True)
     best_before_date = db.Column(db.DateTime, nullable=False)
     price = db.Column(db.Float, nullable=False)
+    search_rowid = db.Column(db.Integer, nullable=True) # SQLite full-text index key, set by a trigger, see search.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # POS connectors upsert by barcode, see product_import.py
+        db.UniqueConstraint('store_id', 'barcode', name='uq_products_store_barcode'),
+        db.Index('idx_products_search_rowid', 'search_rowid', unique=True),
+    )
+
+    def to_dict(self):
+        return PRODUCT.dump(self)
+
+class ProductLot(db.Model): # Delivered batch of a product, each with its own expiry
+    __tablename__ = 'product_lots'
+    lot_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
+    product_id = db.Column(db.String(36), db.ForeignKey('products.product_id', ondelete='CASCADE'), nullable=False)
+    store_id = db.Column(db.String(36), db.ForeignKey('stores.store_id'), nullable=False)
+    lot_number = db.Column(db.String(100), nullable=False)
+    best_before_date = db.Column(db.Date, nullable=False)
+    quantity_available = db.Column(db.Integer, nullable=False, default=0) # only changed by conditional UPDATEs, see model_functions.reserve_stock
+    qr_beta_data = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'lot_number', 'store_id', name='uq_product_lots_product_lot_store'),
+        # First-expired, first-out: the lots of a product in expiry order
+        db.Index('idx_product_lots_fefo', 'store_id', 'product_id', 'best_before_date'),
+        db.CheckConstraint('quantity_available >= 0', name='ck_product_lots_quantity_available'),
+    )
+
+    def to_dict(self):
+        return PRODUCT_LOT.dump(self)
+
 class Cart(db.Model): #User's Cart
     __tablename__ = 'carts'
     cart_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
     user_id = db.Column(db.String(36), db.ForeignKey('users.user_id'), nullable=False)
     # store_id = db.Column() #!Important to check if all products are from the same store
     payed = db.Column(db.Boolean, default=False)
+    payed_at = db.Column(db.DateTime, nullable=True) # set by the Stripe webhook, the day the sale counts for in analytics
+    price = db.Column(db.Float, nullable=False, default=0.0) # running total, kept in step by the cart endpoints
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True) # pushed out by every edit, unpaid carts past it are swept
+
+    __table_args__ = (
+        # Only unpaid carts expire, see model_functions.sweep_expired_carts
+        db.Index('idx_carts_unpaid_expiry', 'expires_at',
+                 postgresql_where=db.text("payed = false"), sqlite_where=db.text("payed = 0")),
+    )
     
 class CartItem(db.Model): #In Cart
     __tablename__ = 'cart_items'
@@ -68,9 +126,24 @@ class CartItem(db.Model): #In Cart
     cart_item_id = db.Column(db.String(36), unique=True, nullable=False, primary_key=True, default=gen_uuid)
     #user_id = db.Column(db.String(36), db.ForeignKey('users.user_id'), nullable=False) # Not needed since we can get user_id from Cart_id
     product_id = db.Column(db.String(36), db.ForeignKey('products.product_id'), nullable=False)
-    quantity = db.Column(db.Integer, default=1)
+    quantity = db.Column(db.Integer, default=1) # all units of the line, the lots they come from are in cart_item_lots
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # One line per product, repeated adds raise the quantity (upserted by cart.add_items)
+        db.UniqueConstraint('cart_id', 'product_id', name='uq_cart_items_cart_product'),
+    )
+
+class CartItemLot(db.Model): # Units of a cart line reserved from one lot, see model_functions.reserve_stock
+    __tablename__ = 'cart_item_lots'
+    cart_item_id = db.Column(db.String(36), db.ForeignKey('cart_items.cart_item_id', ondelete='CASCADE'), primary_key=True)
+    lot_id = db.Column(db.String(36), db.ForeignKey('product_lots.lot_id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('idx_cart_item_lots_lot', 'lot_id'),
+    )
+
 #class Fridge(db.Model):
 #    __tablename__ = 'fridge_items'
 #    fridge_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
@@ -81,29 +154,175 @@ class FridgeItem(db.Model): #In Fridge
     fridge_item_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
     user_id = db.Column(db.String(36), db.ForeignKey('users.user_id'), nullable=False)
     product_name = db.Column(db.String(255), nullable=False)
+    # Where a bought item came from, None for items added by hand; used by analytics.py
+    product_id = db.Column(db.String(36), db.ForeignKey('products.product_id', ondelete='SET NULL'), nullable=True)
+    store_id = db.Column(db.String(36), db.ForeignKey('stores.store_id'), nullable=True)
+    lot_id = db.Column(db.String(36), db.ForeignKey('product_lots.lot_id', ondelete='SET NULL'), nullable=True)
     quantity = db.Column(db.Integer, default=1)
     best_before_date = db.Column(db.Date, nullable=False)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
     consumed_at = db.Column(db.DateTime, nullable=True, default=None)
     status = db.Column(db.String(20), default='active')
+    version = db.Column(db.Integer, nullable=False, default=0) # user's fridge version of the last change, see fridge_sync.py
+
+    __table_args__ = (
+        db.Index('idx_fridge_user_status', 'user_id', 'status'),
+        db.Index('idx_fridge_user_version', 'user_id', 'version'),
+        # One per sort order of fridge.list_fridge, so every page is a single index range scan
+        db.Index('idx_fridge_user_status_bbd', 'user_id', 'status', 'best_before_date', 'fridge_item_id'),
+        db.Index('idx_fridge_user_status_added', 'user_id', 'status', 'added_at', 'fridge_item_id'),
+        db.Index('idx_fridge_user_status_name', 'user_id', 'status', 'product_name', 'fridge_item_id'),
+        db.Index('idx_fridge_user_status_quantity', 'user_id', 'status', 'quantity', 'fridge_item_id'),
+        # Only active items take part in expiry reminders, see scheduler.py
+        db.Index('idx_fridge_expiry', 'best_before_date', 'fridge_item_id',
+                 postgresql_where=db.text("status = 'active'"), sqlite_where=db.text("status = 'active'")),
+    )
 
     def as_dict(self):
-        """Not finished"""
-        return {
-            'fridge_item_id': self.fridge_item_id,
-            'user_id': self.user_id,
-            'product_name': self.product_name,
-            'quantity': self.quantity,
-            'best_before_date': self.best_before_date.isoformat(),
-            'status': self.status,
-        }
-    
-    @classmethod
-    def from_cart_item(cls, item: CartItem):
-        user_id = Cart.query.filter_by(cart_id=item.cart_id).first().user_id
-        product = Product.query.filter_by(product_id = item.product_id).first()
-        quantity = item.quantity
-        return cls(user_id = user_id, product_name = product.product_name, quantity = quantity, best_before_date = product.best_before_date)
+        return FRIDGE_ITEM.dump(self)
+
+class FridgeSummary(db.Model): # Home screen counts per user, kept in step by fridge_summary.py
+    __tablename__ = 'fridge_summaries'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    as_of = db.Column(db.Date, nullable=False) # day the expiry counts are relative to
+    total_items = db.Column(db.Integer, nullable=False, default=0) # active items
+    expired = db.Column(db.Integer, nullable=False, default=0)
+    expiring_today = db.Column(db.Integer, nullable=False, default=0)
+    expiring_3d = db.Column(db.Integer, nullable=False, default=0) # today and the next two days
+    expiring_week = db.Column(db.Integer, nullable=False, default=0) # today and the next six days
+    next_expiry = db.Column(db.Date, nullable=True) # earliest best_before_date not before as_of
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_fridge_summaries_as_of', 'as_of'),
+    )
+
+    def as_dict(self):
+        return FRIDGE_SUMMARY.dump(self)
+
+class FridgeSync(db.Model): # Per-user change counter for delta sync, see fridge_sync.py
+    __tablename__ = 'fridge_sync'
+    user_id = db.Column(db.String(36), db.ForeignKey('users.user_id', ondelete='CASCADE'), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0) # last version handed out
+    compacted_through = db.Column(db.Integer, nullable=False, default=0) # tombstones up to here were dropped
+
+class FridgeTombstone(db.Model): # Removed fridge item, kept until compaction so clients can sync the removal
+    __tablename__ = 'fridge_tombstones'
+    fridge_item_id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.String(36), db.ForeignKey('users.user_id', ondelete='CASCADE'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    removed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_fridge_tombstones_user_version', 'user_id', 'version'),
+        db.Index('idx_fridge_tombstones_removed_at', 'removed_at'),
+    )
+
+class StoreDailyStats(db.Model): # Per-store daily rollup, kept up to date by analytics.py
+    __tablename__ = 'store_daily_stats'
+    store_id = db.Column(db.String(36), db.ForeignKey('stores.store_id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    expiry_days_total = db.Column(db.Integer, nullable=False, default=0) # days to expiry at purchase summed over units sold
+    items_consumed = db.Column(db.Integer, nullable=False, default=0) # units eaten by their best before date
+    items_expired = db.Column(db.Integer, nullable=False, default=0) # units still in a fridge when their best before date passed
+
+class ProductDailyStats(db.Model): # Per-product daily rollup, same counters as StoreDailyStats
+    __tablename__ = 'product_daily_stats'
+    product_id = db.Column(db.String(36), primary_key=True) # no foreign key, the history outlives the product
+    day = db.Column(db.Date, primary_key=True)
+    store_id = db.Column(db.String(36), db.ForeignKey('stores.store_id', ondelete='CASCADE'), nullable=False)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units_sold = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    expiry_days_total = db.Column(db.Integer, nullable=False, default=0)
+    items_consumed = db.Column(db.Integer, nullable=False, default=0)
+    items_expired = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('idx_product_daily_stats_store_day', 'store_id', 'day'),
+    )
+
+class PaymentSession(db.Model): # Stripe checkout session created in the background, see payment.py
+    __tablename__ = 'payment_sessions'
+    payment_session_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
+    cart_id = db.Column(db.String(36), db.ForeignKey('carts.cart_id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.String(36), db.ForeignKey('users.user_id'), nullable=False)
+    job_id = db.Column(db.String(36), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, ready, failed
+    stripe_session_id = db.Column(db.String(255), nullable=True)
+    checkout_url = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ProcessedStripeEvent(db.Model): # Stripe event ids already handled by checkout.stripe_webhook
+    __tablename__ = 'processed_stripe_events'
+    event_id = db.Column(db.String(255), primary_key=True)
+    event_type = db.Column(db.String(100), nullable=False)
+    processed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UsedQrToken(db.Model): # QR alpha token ids already accepted by qr_functions.validate_tokens
+    __tablename__ = 'used_qr_tokens'
+    jti = db.Column(db.String(64), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False) # the row can go once the token itself has expired
+
+    __table_args__ = (
+        db.Index('idx_used_qr_tokens_expires_at', 'expires_at'),
+    )
+
+class Notification(db.Model):
+    __tablename__ = 'notifications'
+    notification_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
+    user_id = db.Column(db.String(36), db.ForeignKey('users.user_id'), nullable=False)
+    notification_type = db.Column(db.String(50), nullable=False) # expiry_warning, expiry_critical, weekly_summary
+    fridge_item_id = db.Column(db.String(36), db.ForeignKey('fridge_items.fridge_item_id', ondelete='CASCADE'), nullable=True)
+    message = db.Column(db.Text, nullable=True)
+    dedupe_key = db.Column(db.String(120), unique=True, nullable=False) # makes re-running a scheduler tick a no-op
+    sent_at = db.Column(db.DateTime, nullable=True)
+    read_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchedulerState(db.Model): # Last day a periodic task has fully processed
+    __tablename__ = 'scheduler_state'
+    name = db.Column(db.String(50), primary_key=True)
+    last_run_date = db.Column(db.Date, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model): # Background work, picked up by jobs.py workers
+    __tablename__ = 'jobs'
+    job_id = db.Column(db.String(36), primary_key=True, default=gen_uuid)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}') # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('idx_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+def dialect_insert(model):
+    """
+    INSERT construct of the current database dialect, which supports
+    on_conflict_do_nothing / on_conflict_do_update on PostgreSQL and SQLite.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
 
 def seed_default_items_for_user(db_session, user_id):
     # Create three default test items with future expiry dates
@@ -0,0 +1,269 @@
+import logging
+import os
+import time
+from threading import Lock
+
+from flask import Blueprint, request, jsonify, abort
+
+from models import db, Cart, Job, PaymentSession
+from model_functions import get_store_from_cart_id, extend_cart, PAYMENT_HOLD
+from qr_functions import verify_token
+from jobs import enqueue, job_handler
+
+logger = logging.getLogger(__name__)
+
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")    # e.g. a local stripe-mock; Stripe itself when unset
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", 3))
+STRIPE_READ_TIMEOUT = float(os.getenv("STRIPE_READ_TIMEOUT", 10))
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", 10))              # keep-alive connections to Stripe
+BREAKER_FAILURES = int(os.getenv("STRIPE_BREAKER_FAILURES", 5))        # consecutive failures that open the circuit
+BREAKER_RESET_AFTER = float(os.getenv("STRIPE_BREAKER_RESET_AFTER", 30))  # seconds before a trial call is let through
+
+SUCCESS_URL = os.getenv("CHECKOUT_SUCCESS_URL", "http://localhost:3000/success")
+CANCEL_URL = os.getenv("CHECKOUT_CANCEL_URL", "http://localhost:3000/cancel")
+
+payment_bp = Blueprint('payment', __name__)
+
+
+class PaymentUnavailable(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails fast once the provider keeps failing, instead of tying up a worker per request
+    until the timeout. After reset_after seconds one trial call decides whether to close again.
+    """
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET_AFTER):
+        self.failures = failures
+        self.reset_after = reset_after
+        self._lock = Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_after:
+                return 'half_open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._consecutive >= self.failures:
+                self._opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+_client = None
+_client_lock = Lock()
+
+
+def stripe_client():
+    """
+    One StripeClient per process on a shared requests session, so calls reuse keep-alive
+    connections and every request is bounded by the connect and read timeouts.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import requests
+            import stripe  # loaded on first checkout instead of at worker start
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _client = stripe.StripeClient(
+                os.getenv("STRIPE_SECRET_KEY", ""),
+                http_client=stripe.RequestsClient(timeout=(STRIPE_CONNECT_TIMEOUT, STRIPE_READ_TIMEOUT), session=session),
+                base_addresses={'api': STRIPE_API_BASE} if STRIPE_API_BASE else None,
+                max_network_retries=0,  # retries are the job queue's business, not the request's
+            )
+        return _client
+
+
+def create_stripe_session(cart_id, user_id, store_id, price, idempotency_key=None):
+    """
+    Creates a Stripe checkout session and returns it.
+    Raises PaymentUnavailable when the circuit is open or Stripe can't be reached in time.
+    """
+    import stripe
+    if not breaker.allow():
+        raise PaymentUnavailable("payment provider unavailable")
+    params = {
+        "payment_method_types": ["card"],
+        "mode": "payment",
+        "line_items": [{
+            "price_data": {
+                "currency": "usd",
+                "product_data": {
+                    "name": f"Store {store_id} - Cart {cart_id}",
+                },
+                "unit_amount": int(round(price * 100)),
+            },
+            "quantity": 1,
+        }],
+        "success_url": SUCCESS_URL,
+        "cancel_url": CANCEL_URL,
+        "metadata": {
+            "cart_id": cart_id,
+            "user_id": user_id
+        },
+    }
+    try:
+        session = stripe_client().v1.checkout.sessions.create(
+            params, options={'idempotency_key': idempotency_key} if idempotency_key else None)
+    except (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError) as e:
+        # Timeouts, network errors, 429 and 5xx say something about Stripe's health
+        breaker.failure()
+        raise PaymentUnavailable(str(e)) from e
+    except stripe.StripeError:
+        # A rejected request (bad parameters, auth) is our problem, the provider answered fine
+        breaker.success()
+        raise
+    breaker.success()
+    return session
+
+
+def checkout_target(cart_id, token):
+    """
+    Validates a QR checkout token for cart_id and returns (cart, store_id), aborting otherwise.
+    """
+    if not token:
+        abort(400, "Missing token")
+
+    payload = verify_token(token)
+    if not payload:
+        abort(403, "Invalid or expired token")
+
+    if str(payload["cart_id"]) != str(cart_id):
+        abort(403, "Cart ID mismatch")
+
+    user_id = payload.get("user_id")
+    if not user_id:
+        abort(403, "Missing user_id")
+
+    cart = Cart.query.get(cart_id)
+    if not cart or cart.user_id != user_id:
+        abort(403, "Cart does not belong to user")
+    if cart.payed:
+        abort(400, "Cart already payed")
+
+    store = get_store_from_cart_id(cart_id)
+    if not store:
+        abort(400, "Cart is empty")
+
+    # running total is kept up to date by the cart endpoints
+    if cart.price <= 0:
+        abort(400, "Cart total must be greater than 0")
+    return cart, store.store_id
+
+
+def unavailable_response():
+    response = jsonify({'error': 'payment provider unavailable, try again shortly'})
+    response.headers['Retry-After'] = str(int(BREAKER_RESET_AFTER))
+    return response, 503
+
+
+@payment_bp.route('/<cart_id>/session', methods=['POST'])
+def request_session(cart_id):
+    """
+    Asks for a Stripe checkout session without waiting for Stripe: a job creates it and
+    the client polls GET /payment/sessions/<payment_session_id> for the checkout_url.
+    Asking again for the same cart returns the session already under way.
+    """
+    cart, store_id = checkout_target(cart_id, (request.get_json(silent=True) or {}).get("token"))
+    existing = PaymentSession.query.filter(
+        PaymentSession.cart_id == cart_id, PaymentSession.status != 'failed'
+    ).order_by(PaymentSession.created_at.desc()).first()
+    if existing:
+        return session_response(existing)
+
+    if breaker.state == 'open':
+        return unavailable_response()
+    extend_cart(cart_id, PAYMENT_HOLD)  # not swept while the Stripe session can still be paid
+    payment_session = PaymentSession(cart_id=cart_id, user_id=cart.user_id)
+    db.session.add(payment_session)
+    db.session.flush()
+    job = enqueue('create_checkout_session', {'payment_session_id': payment_session.payment_session_id,
+                                              'store_id': store_id}, max_attempts=3)
+    db.session.flush()
+    payment_session.job_id = job.job_id
+    db.session.commit()
+    return session_response(payment_session)
+
+
+@payment_bp.route('/sessions/<payment_session_id>', methods=['GET'])
+def get_session(payment_session_id):
+    payment_session = PaymentSession.query.get(payment_session_id)
+    if not payment_session:
+        return jsonify({'error': 'not found'}), 404
+    if payment_session.status == 'pending' and payment_session.job_id:
+        job = Job.query.get(payment_session.job_id)
+        if job and job.status == 'failed':
+            # Retries ran out while Stripe was unavailable
+            payment_session.status = 'failed'
+            payment_session.error = job.last_error
+            db.session.commit()
+    return session_response(payment_session)
+
+
+def session_response(payment_session):
+    body = {
+        'payment_session_id': payment_session.payment_session_id,
+        'cart_id': payment_session.cart_id,
+        'status': payment_session.status,
+        'checkout_url': payment_session.checkout_url,
+    }
+    if payment_session.status == 'pending':
+        response = jsonify(body)
+        response.headers['Retry-After'] = '1'
+        return response, 202
+    if payment_session.status == 'failed':
+        body['error'] = payment_session.error
+    return jsonify(body), 200
+
+
+@job_handler('create_checkout_session')
+def create_checkout_session_job(payload):
+    import stripe
+    payment_session = PaymentSession.query.get(payload['payment_session_id'])
+    if not payment_session or payment_session.status != 'pending':
+        return
+    cart = Cart.query.get(payment_session.cart_id)
+    if not cart or cart.payed:
+        payment_session.status = 'failed'
+        payment_session.error = 'cart no longer payable'
+        return
+    try:
+        # The id is the idempotency key, so a retried job never creates a second Stripe session
+        session = create_stripe_session(cart.cart_id, cart.user_id, payload['store_id'], cart.price,
+                                        idempotency_key=payment_session.payment_session_id)
+    except stripe.StripeError as e:
+        payment_session.status = 'failed'
+        payment_session.error = str(e)
+        return
+    # PaymentUnavailable propagates, so the job is retried with backoff
+    payment_session.status = 'ready'
+    payment_session.stripe_session_id = session.id
+    payment_session.checkout_url = session.url
@@ -0,0 +1,125 @@
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from models import db, Product, dialect_insert
+
+CHUNK_SIZE = int(os.getenv("PRODUCT_IMPORT_CHUNK_SIZE", 1000))
+MAX_REPORTED_ERRORS = 1000
+
+UPDATED_COLUMNS = ['product_name', 'brand', 'category', 'default_shelf_life_days', 'best_before_date', 'price']
+
+
+def iter_rows(stream, content_type):
+    """
+    Yields one record per row from an NDJSON or CSV request body without reading it all into memory.
+    NDJSON lines are yielded undecoded so a broken line only fails that row.
+    """
+    text = io.TextIOWrapper(io.BufferedReader(stream), encoding='utf-8', newline='')
+    if 'csv' in (content_type or ''):
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def parse_row(store_id, row):
+    """
+    Turns one input record into a products row, raising ValueError with a readable message.
+    """
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except json.JSONDecodeError:
+            raise ValueError('invalid JSON')
+    barcode = (row.get('barcode') or '').strip()
+    name = (row.get('product_name') or '').strip()
+    if not barcode or not name:
+        raise ValueError('barcode and product_name are required')
+    try:
+        price = float(row.get('price'))
+    except (TypeError, ValueError):
+        raise ValueError('price must be a number')
+
+    shelf_life = row.get('default_shelf_life_days')
+    shelf_life = int(shelf_life) if shelf_life not in (None, '') else None
+    if row.get('best_before_date'):
+        bbd = datetime.fromisoformat(row['best_before_date'])
+    elif shelf_life is not None:
+        bbd = datetime.utcnow() + timedelta(days=shelf_life)
+    else:
+        raise ValueError('best_before_date or default_shelf_life_days is required')
+
+    return {
+        'store_id': store_id,
+        'barcode': barcode,
+        'product_name': name,
+        'brand': row.get('brand') or None,
+        'category': row.get('category') or None,
+        'default_shelf_life_days': shelf_life,
+        'best_before_date': bbd,
+        'price': price,
+    }
+
+
+def _upsert(rows):
+    statement = dialect_insert(Product)
+    statement = statement.on_conflict_do_update(
+        index_elements=['store_id', 'barcode'],
+        set_={column: statement.excluded[column] for column in UPDATED_COLUMNS},
+    )
+    db.session.execute(statement, rows)
+    db.session.commit()
+
+
+def import_products(store_id, records):
+    """
+    Upserts products by (store_id, barcode), one transaction per CHUNK_SIZE rows.
+    Returns a report with counts, per-row errors (the first MAX_REPORTED_ERRORS) and throughput.
+    """
+    start = time.perf_counter()
+    report = {'rows': 0, 'upserted': 0, 'error_count': 0, 'errors': []}
+
+    def fail(row_numbers, message):
+        report['error_count'] += len(row_numbers)
+        for n in row_numbers[:MAX_REPORTED_ERRORS - len(report['errors'])]:
+            report['errors'].append({'row': n, 'error': message})
+
+    def flush(chunk):
+        # Later rows win when a barcode repeats inside one chunk
+        rows = list(chunk.values())
+        try:
+            _upsert([row for _, row in rows])
+            report['upserted'] += len(rows)
+        except Exception as e:
+            db.session.rollback()
+            fail([n for n, _ in rows], f'chunk failed: {e.__class__.__name__}')
+
+    chunk = {}
+    try:
+        for n, record in enumerate(records, start=1):
+            report['rows'] = n
+            try:
+                row = parse_row(store_id, record)
+            except (ValueError, TypeError, AttributeError) as e:
+                fail([n], str(e))
+                continue
+            chunk[row['barcode']] = (n, row)
+            if len(chunk) >= CHUNK_SIZE:
+                flush(chunk)
+                chunk = {}
+    except (ValueError, csv.Error) as e:
+        # Malformed body: keep what was imported so far and report where it stopped
+        fail([report['rows'] + 1], f'unreadable input: {e}')
+    if chunk:
+        flush(chunk)
+
+    elapsed = time.perf_counter() - start
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['rows'] / elapsed, 1) if elapsed > 0 else None
+    return report
@@ -2,7 +2,11 @@ from flask import Blueprint, request, jsonify
 import uuid
 from models import Product, db, Store
 from functools import wraps
-from store import store_employee_required
+from store import store_employee_required, build_catalog
+from catalog_cache import catalog_response
+from search import search_products
+from db_routing import read_only
+from serializers import PRODUCT, render, render_list
 
 def admin_required(f):
     @wraps(f)
@@ -26,24 +30,40 @@ products_bp = Blueprint('products', __name__)
 @products_bp.route('/', methods=['GET'])
 @admin_required
 def list_products():
+    """
+    ?q= searches product names (prefix match per word, best matches first),
+    ?store_id= restricts to one store, ?limit= / ?offset= page through the results.
+    """
     q = request.args.get('q')
-    items = Product.query.all()
+    store_id = request.args.get('store_id')
+    try:
+        limit = min(int(request.args.get('limit', 50)), 200)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({'error': 'invalid limit or offset'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
     if q:
-        items = [p for p in items if q.lower() in p.product_name.lower()]
-    return jsonify({'products': [p.to_dict() for p in items]})
+        items = search_products(q, store_id=store_id, limit=limit, offset=offset)
+    else:
+        query = Product.query
+        if store_id:
+            query = query.filter_by(store_id=store_id)
+        items = query.order_by(Product.product_name, Product.product_id).offset(offset).limit(limit).all()
+    return render_list('products', items, PRODUCT, {'limit': limit, 'offset': offset})
 
 @products_bp.route('/<product_id>', methods=['GET'])
+@read_only
 def get_product(product_id):
     p = Product.query.get(product_id)
     if not p:
         return jsonify({'error': 'not found'}), 404
-    return jsonify(p.to_dict())
+    return render(PRODUCT.dump(p))
 
-@products_bp.route('/store/<store_id>', methods=['DELETE'])
+@products_bp.route('/store/<store_id>', methods=['GET'])
 @store_employee_required
 def display_products_in_store(store_id):
-    products = Product.query.filter_by(store_id=store_id).all()
-    return jsonify({'products': [p.to_dict() for p in products]}), 200
+    return catalog_response(store_id, lambda mimetype: build_catalog(store_id, mimetype))
 
 
 @products_bp.route('/', methods=['POST'])
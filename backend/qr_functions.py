@@ -1,16 +1,26 @@
 import time
 import jwt
 import os
+import uuid
+import logging
+from datetime import datetime
 from dotenv import load_dotenv
+from models import db, UsedQrToken, dialect_insert
+
+logger = logging.getLogger(__name__)
 
 SECRET_KEY = os.getenv("SECRET_KEY", "secret_key_standart")
+TOKEN_LIFETIME = 300  # seconds
 
-def generate_checkout_token(cart_id, user_id):
+def generate_checkout_token(cart_id, user_id, store_id=None):
     payload = {
         "cart_id": cart_id,
         "user_id": user_id,
-        "exp": int(time.time()) + 300  # expires in 5 minutes
+        "jti": uuid.uuid4().hex,  # lets the POS reject a second use, see validate_tokens
+        "exp": int(time.time()) + TOKEN_LIFETIME  # expires in 5 minutes
     }
+    if store_id:
+        payload["store_id"] = store_id
 
     token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
 
@@ -18,7 +28,8 @@ def generate_checkout_token(cart_id, user_id):
 
 def verify_token(token):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+        # A token without exp or jti could never be expired or claimed, so it is invalid
+        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"], options={"require": ["exp", "jti"]})
         return payload
     except jwt.ExpiredSignatureError:
         return None
@@ -27,7 +38,80 @@ def verify_token(token):
     except Exception:
         return None
 
+
+class DbUsedTokens:
+    """
+    Token ids claimed in the used_qr_tokens table, shared by every worker. The row is
+    inserted with ON CONFLICT DO NOTHING and committed by validate_tokens; a concurrent
+    claim of the same id waits for that commit and then finds the row.
+    """
+    def claim(self, jti, exp):
+        return bool(db.session.execute(
+            dialect_insert(UsedQrToken)
+            .values(jti=jti, expires_at=datetime.utcfromtimestamp(exp))
+            .on_conflict_do_nothing()
+        ).rowcount)
+
+
+class RedisUsedTokens:
+    def __init__(self, client):
+        self.client = client
+
+    def claim(self, jti, exp):
+        ttl = max(int(exp - time.time()), 1)
+        return bool(self.client.set(f'qr_alpha:used:{jti}', 1, ex=ttl, nx=True))
+
+
+def _make_used_tokens():
+    url = os.getenv("REDIS_URL")
+    if url:
+        try:
+            import redis
+            client = redis.Redis.from_url(url)
+            client.ping()
+            return RedisUsedTokens(client)
+        except Exception:
+            logger.warning("Redis at REDIS_URL not reachable, claiming QR tokens in the database")
+    return DbUsedTokens()
+
+
+used_tokens = _make_used_tokens()
+
+
+def validate_tokens(tokens, store_id=None):
+    """
+    Validates QR alpha tokens for a POS and marks them used. Every token is accepted at most once.
+    Returns one result per token, in order.
+    """
+    results = []
+    for token in tokens:
+        payload = verify_token(token) if isinstance(token, str) else None
+        if not payload:
+            results.append({"valid": False, "reason": "invalid_or_expired"})
+            continue
+        if store_id and payload.get("store_id") and payload["store_id"] != store_id:
+            results.append({"valid": False, "reason": "wrong_store"})
+            continue
+        claimed = used_tokens.claim(payload["jti"], payload["exp"])
+        if not claimed:
+            results.append({"valid": False, "reason": "already_used"})
+        else:
+            results.append({"valid": True, "cart_id": payload["cart_id"], "user_id": payload["user_id"]})
+    db.session.commit()
+    return results
+
+
+def purge_used_tokens(now=None):
+    """
+    Deletes claimed token ids whose tokens have expired; those fail verification anyway.
+    Returns the number of rows removed.
+    """
+    removed = UsedQrToken.query.filter(UsedQrToken.expires_at < (now or datetime.utcnow())) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
 def create_qr_beta(cart):
     # Generate a QR code for the cart
     # This is a placeholder function
-    print(f"Generating QR code for cart: {cart.cart_id}")
\ No newline at end of file
+    print(f"Generating QR code for cart: {cart.cart_id}")
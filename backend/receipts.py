@@ -0,0 +1,133 @@
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from jinja2 import Environment
+
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", os.cpu_count() or 1))
+
+_env = Environment(autoescape=True)
+
+# Compiled once at import; rendering only fills in the values
+EMAIL_TEMPLATE = _env.from_string("""
+<html>
+    <body>
+        <h2>Thank you for using our services!</h2>
+        <p>We truly appreciate your purchase.</p>
+        <p><strong>Total Price:</strong> ${{ '%.2f' % total_price }}</p>
+        <p>Please find your detailed receipt attached as a PDF.</p>
+    </body>
+</html>
+""")
+
+PDF_TEMPLATE = _env.from_string("""
+<html>
+    <body>
+        <h1>Receipt</h1>
+        <table>
+            {% for item in items %}
+            <tr><td>{{ item.name }}</td><td class="num">{{ item.quantity }}</td><td class="num">{{ '%.2f' % item.price }}</td></tr>
+            {% endfor %}
+            <tr class="total"><td>Total</td><td></td><td class="num">{{ '%.2f' % total_price }}</td></tr>
+        </table>
+    </body>
+</html>
+""")
+
+STYLESHEET = """
+@page { size: A5; margin: 1.5cm; }
+body { font-family: sans-serif; font-size: 10pt; }
+table { width: 100%; border-collapse: collapse; }
+td.num { text-align: right; }
+tr.total td { border-top: 1px solid #000; font-weight: bold; }
+"""
+
+# Parsed stylesheet and font setup, built once per process on first render
+_weasy = None
+
+
+def _weasyprint():
+    global _weasy
+    if _weasy is None:
+        from weasyprint import CSS, HTML
+        from weasyprint.text.fonts import FontConfiguration
+        font_config = FontConfiguration()
+        _weasy = (HTML, CSS(string=STYLESHEET, font_config=font_config), font_config)
+    return _weasy
+
+
+def render_email_body(total_price):
+    return EMAIL_TEMPLATE.render(total_price=total_price)
+
+
+def render_receipt_pdf(items, total_price):
+    """
+    PDF receipt as bytes, rendered in this process straight into memory.
+    """
+    HTML, stylesheet, font_config = _weasyprint()
+    html = PDF_TEMPLATE.render(items=items, total_price=total_price)
+    return HTML(string=html).write_pdf(stylesheets=[stylesheet], font_config=font_config)
+
+
+def _render_job(job):
+    return render_receipt_pdf(*job)
+
+
+class ReceiptRenderer:
+    """
+    Renders receipts on a pool of RECEIPT_WORKERS processes, so PDF layout runs on all cores
+    instead of holding the GIL of the calling worker. The pool is started on first use.
+    """
+    def __init__(self, workers=RECEIPT_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: callers are often multi-threaded (job worker, web server)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_weasyprint,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # A crashed worker breaks the whole pool; drop it so the next call (e.g. a job retry) starts fresh
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def render(self, items, total_price):
+        pool = self._get_pool()
+        try:
+            return pool.submit(render_receipt_pdf, items, total_price).result()
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise
+
+    def render_batch(self, receipts):
+        """
+        receipts: iterable of (items, total_price). Returns the PDFs in the same order.
+        """
+        receipts = list(receipts)
+        chunksize = max(1, len(receipts) // (self.workers * 4))
+        pool = self._get_pool()
+        try:
+            return list(pool.map(_render_job, receipts, chunksize=chunksize))
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+renderer = ReceiptRenderer()
+atexit.register(renderer.shutdown)
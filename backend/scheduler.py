@@ -0,0 +1,160 @@
+import argparse
+import logging
+import os
+import time
+from datetime import timedelta
+
+from models import db, utc_today, FridgeItem, Notification, SchedulerState, dialect_insert
+from fridge_summary import roll_forward
+from analytics import record_expired
+from model_functions import sweep_expired_carts
+from qr_functions import purge_used_tokens
+from jobs import enqueue
+
+logger = logging.getLogger(__name__)
+
+WARNING_DAYS = int(os.getenv("EXPIRY_WARNING_DAYS", 3))    # expiry_warning this many days ahead
+CRITICAL_DAYS = int(os.getenv("EXPIRY_CRITICAL_DAYS", 1))  # expiry_critical this many days ahead
+SUMMARY_WEEKDAY = 0                                        # weekly_summary goes out on Mondays
+CHUNK_SIZE = int(os.getenv("SCHEDULER_CHUNK_SIZE", 5000))
+
+STATE_NAME = 'expiry_reminders'
+
+
+def _insert_notifications(rows):
+    if rows:
+        db.session.execute(dialect_insert(Notification).on_conflict_do_nothing(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def notify_expiring(notification_type, start, end):
+    """
+    Writes one notification per active item with start <= best_before_date <= end that
+    doesn't have one of this type yet, looked up by dedupe_key. Items added after an earlier
+    tick are picked up as long as their window is still open.
+    Walks idx_fridge_expiry in keyset order, so only CHUNK_SIZE rows are held at a time.
+    """
+    written = 0
+    last = None
+    notified = db.session.query(Notification.notification_id) \
+        .filter(Notification.dedupe_key == db.literal(f"{notification_type}:") + FridgeItem.fridge_item_id)
+    while True:
+        query = db.session.query(
+            FridgeItem.fridge_item_id, FridgeItem.user_id, FridgeItem.product_name, FridgeItem.best_before_date
+        ).filter(
+            FridgeItem.status == 'active',
+            FridgeItem.best_before_date >= start,
+            FridgeItem.best_before_date <= end,
+            ~notified.exists(),
+        )
+        if last is not None:
+            query = query.filter(db.tuple_(FridgeItem.best_before_date, FridgeItem.fridge_item_id) > last)
+        chunk = query.order_by(FridgeItem.best_before_date, FridgeItem.fridge_item_id).limit(CHUNK_SIZE).all()
+        if not chunk:
+            return written
+
+        written += _insert_notifications([{
+            'user_id': user_id,
+            'notification_type': notification_type,
+            'fridge_item_id': item_id,
+            'message': f"{name} expires on {bbd.isoformat()}",
+            'dedupe_key': f"{notification_type}:{item_id}",
+        } for item_id, user_id, name, bbd in chunk])
+        last = (chunk[-1].best_before_date, chunk[-1].fridge_item_id)
+
+
+def notify_weekly_summary(today):
+    """
+    One weekly_summary per user with active items expiring in the coming week,
+    walking users in user_id order CHUNK_SIZE at a time.
+    """
+    end = today + timedelta(days=6)
+    week = today.isocalendar()
+    written = 0
+    last_user = None
+    while True:
+        query = db.session.query(FridgeItem.user_id, db.func.count(FridgeItem.fridge_item_id)).filter(
+            FridgeItem.status == 'active',
+            FridgeItem.best_before_date >= today,
+            FridgeItem.best_before_date <= end,
+        )
+        if last_user is not None:
+            query = query.filter(FridgeItem.user_id > last_user)
+        chunk = query.group_by(FridgeItem.user_id).order_by(FridgeItem.user_id).limit(CHUNK_SIZE).all()
+        if not chunk:
+            return written
+
+        written += _insert_notifications([{
+            'user_id': user_id,
+            'notification_type': 'weekly_summary',
+            'message': f"{count} items in your fridge expire this week",
+            'dedupe_key': f"weekly_summary:{user_id}:{week[0]}-W{week[1]:02d}",
+        } for user_id, count in chunk])
+        last_user = chunk[-1].user_id
+
+
+def tick(today=None):
+    """
+    Sends the expiry notifications due today: every active item inside its window that
+    hasn't had one yet, so it is cheap to call often and items added since the last call
+    are caught. The once-a-day work (weekly summary, summaries, expiry counts) covers every
+    day since the last completed day, up to and including today. Re-running a tick
+    (e.g. after a crash) is harmless because notifications are deduplicated.
+    """
+    today = today or utc_today()
+    result = {
+        'warning': notify_expiring('expiry_warning', today + timedelta(days=CRITICAL_DAYS + 1),
+                                   today + timedelta(days=WARNING_DAYS)),
+        'critical': notify_expiring('expiry_critical', today, today + timedelta(days=CRITICAL_DAYS)),
+        'weekly_summary': 0,
+        'summaries_rolled': 0,
+        'units_expired': 0,
+    }
+    state = SchedulerState.query.get(STATE_NAME)
+    if state and state.last_run_date >= today:
+        return result
+    # First run: catch up as far back as the warning window reaches
+    last = state.last_run_date if state else today - timedelta(days=WARNING_DAYS + 1)
+
+    result['summaries_rolled'] = roll_forward(today)
+    if any((last + timedelta(days=n)).weekday() == SUMMARY_WEEKDAY for n in range(1, (today - last).days + 1)):
+        result['weekly_summary'] = notify_weekly_summary(today)
+        enqueue('reconcile_fridge_summaries', max_attempts=1)
+        enqueue('compact_fridge_tombstones', max_attempts=1)
+
+    # Same transaction as the state below, so a day's expired items are counted exactly once
+    result['units_expired'] = record_expired(last, today)
+
+    if state:
+        state.last_run_date = today
+    else:
+        db.session.add(SchedulerState(name=STATE_NAME, last_run_date=today))
+    db.session.commit()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FreshReminder expiry reminder scheduler")
+    parser.add_argument('--once', action='store_true', help="run a single tick and exit")
+    parser.add_argument('--interval', type=float, default=3600, help="seconds between ticks")
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app(reset_db=False)
+    logging.basicConfig(level=logging.INFO)
+
+    while True:
+        with app.app_context():
+            # Notifications are checked every interval, the daily work only runs once a day
+            logger.info("Scheduler tick: %s", tick())
+            # Every iteration, not once a day like tick(), so abandoned carts don't pile up
+            logger.info("Cart sweep: %s", sweep_expired_carts())
+            logger.info("Expired QR token ids purged: %d", purge_used_tokens())
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
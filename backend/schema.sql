@@ -47,6 +47,8 @@ CREATE TABLE IF NOT EXISTS product_lots (
     UNIQUE(product_id, lot_number, store_id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_product_lots_fefo ON product_lots(store_id, product_id, best_before_date);
+
 -- Carts
 CREATE TABLE IF NOT EXISTS carts (
     cart_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
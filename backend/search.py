@@ -0,0 +1,108 @@
+import logging
+import re
+
+from models import db, Product
+
+logger = logging.getLogger(__name__)
+
+# SQLite: external-content FTS5 table over products.product_name, kept in sync by triggers.
+# It is keyed on products.search_rowid rather than the implicit rowid, which VACUUM may renumber
+# because the primary key isn't an INTEGER. New products get the next search_rowid on insert.
+SQLITE_SETUP = [
+    """CREATE VIRTUAL TABLE products_fts USING fts5(
+        product_name, content='products', content_rowid='search_rowid', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        UPDATE products SET search_rowid = (SELECT coalesce(max(search_rowid), 0) + 1 FROM products)
+            WHERE rowid = new.rowid;
+        INSERT INTO products_fts(rowid, product_name)
+            SELECT search_rowid, product_name FROM products WHERE rowid = new.rowid;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, product_name) VALUES ('delete', old.search_rowid, old.product_name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF product_name ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, product_name) VALUES ('delete', old.search_rowid, old.product_name);
+        INSERT INTO products_fts(rowid, product_name) VALUES (new.search_rowid, new.product_name);
+    END""",
+    # Key and index whatever was already in the table
+    """UPDATE products SET search_rowid = (SELECT coalesce(max(search_rowid), 0) FROM products) + rowid
+        WHERE search_rowid IS NULL""",
+    "INSERT INTO products_fts(products_fts) VALUES ('rebuild')",
+]
+
+# PostgreSQL: trigram GIN index, serves ILIKE '%term%' and similarity ranking
+POSTGRES_SETUP = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS idx_products_name_trgm ON products USING gin (product_name gin_trgm_ops)",
+]
+
+# Whether similarity() can be used for ranking, set by init_search
+trigram = False
+
+
+def init_search():
+    """
+    Creates the name index for the current database if it is missing. Safe to call on every start.
+    """
+    global trigram
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        with db.engine.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+            ).first()
+            if not exists:
+                for statement in SQLITE_SETUP:
+                    conn.exec_driver_sql(statement)
+    elif dialect == 'postgresql':
+        try:
+            with db.engine.begin() as conn:
+                for statement in POSTGRES_SETUP:
+                    conn.exec_driver_sql(statement)
+        except Exception:
+            logger.warning("Could not set up pg_trgm, product search falls back to an unranked ILIKE scan")
+        # The extension may exist even if creating the index failed, and similarity() needs only that
+        with db.engine.connect() as conn:
+            trigram = conn.exec_driver_sql("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").first() is not None
+
+
+@db.event.listens_for(Product.__table__, 'before_drop')
+def drop_search_index(target, connection, **kw):
+    # The FTS table isn't part of the metadata, so drop_all would leave it behind with stale rows
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql("DROP TABLE IF EXISTS products_fts")
+
+
+def _fts_query(q):
+    # Every word must match as a prefix: "gre yog" -> "gre"* "yog"*
+    words = re.findall(r'\w+', q, re.UNICODE)
+    return ' '.join(f'"{w}"*' for w in words)
+
+
+def search_products(q, store_id=None, limit=50, offset=0):
+    """
+    Products whose name matches q, best matches first.
+    """
+    dialect = db.engine.dialect.name
+    query = Product.query
+    if store_id:
+        query = query.filter(Product.store_id == store_id)
+
+    if dialect == 'sqlite':
+        match = _fts_query(q)
+        if not match:
+            return []
+        fts = db.table('products_fts', db.column('rowid'), db.column('rank'))
+        query = query.join(fts, fts.c.rowid == Product.search_rowid) \
+            .filter(db.text("products_fts MATCH :match").bindparams(match=match)) \
+            .order_by(fts.c.rank)
+    else:
+        escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Product.product_name.ilike('%' + escaped + '%'))
+        if dialect == 'postgresql':
+            ranking = [Product.product_name.ilike(escaped + '%').desc()]
+            if trigram:
+                ranking.append(db.func.similarity(Product.product_name, q).desc())
+            query = query.order_by(*ranking)
+    return query.order_by(Product.product_id).offset(offset).limit(limit).all()
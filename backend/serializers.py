@@ -0,0 +1,139 @@
+"""
+One place that turns rows into response bodies. Every model has a field spec, compiled once
+into a single attrgetter, and list endpoints stream their JSON in chunks instead of building
+the whole body first. orjson and msgpack are used when installed; without them responses are
+stdlib JSON, and clients asking for MessagePack get JSON.
+"""
+import json
+import os
+from operator import attrgetter
+
+from flask import Response, request, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", 500))    # rows encoded per streamed chunk
+
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class FieldSpec:
+    """
+    The fields of a model in response order. A field is an attribute name, or a
+    (name, convert) pair whose value is passed through convert, e.g. dates to ISO strings.
+    Works on ORM objects and on result rows selected with columns().
+    """
+    def __init__(self, *fields):
+        self.names = tuple(f if isinstance(f, str) else f[0] for f in fields)
+        self._converters = tuple((i, f[1]) for i, f in enumerate(fields) if not isinstance(f, str))
+        getter = attrgetter(*self.names)
+        self._get = getter if len(self.names) > 1 else lambda obj: (getter(obj),)
+
+    def dump(self, obj):
+        values = self._get(obj)
+        if self._converters:
+            values = list(values)
+            for i, convert in self._converters:
+                values[i] = convert(values[i])
+        return dict(zip(self.names, values))
+
+    def columns(self, model):
+        # For select(*SPEC.columns(Model)): plain rows, no ORM objects to build
+        return [getattr(model, name) for name in self.names]
+
+
+PRODUCT = FieldSpec('product_id', 'store_id', 'barcode', 'product_name', 'brand', 'category',
+                    'default_shelf_life_days', ('best_before_date', isoformat), 'price')
+PRODUCT_LOT = FieldSpec('lot_id', 'product_id', 'store_id', 'lot_number',
+                        ('best_before_date', isoformat), 'quantity_available')
+FRIDGE_ITEM = FieldSpec('fridge_item_id', 'user_id', 'product_name', 'quantity',
+                        ('best_before_date', isoformat), 'status')
+FRIDGE_SUMMARY = FieldSpec('total_items', 'expired', 'expiring_today', 'expiring_3d', 'expiring_week',
+                           ('next_expiry', isoformat), ('as_of', isoformat))
+EMPLOYEE = FieldSpec('employee_id', 'store_id', 'email', 'is_manager', ('created_at', isoformat))
+
+
+if orjson is not None:
+    dumps = orjson.dumps
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def response_type():
+    """
+    MSGPACK if the client prefers it (Accept: application/msgpack) and msgpack is installed, else JSON.
+    """
+    if msgpack is not None and request.accept_mimetypes.best_match([JSON, MSGPACK]) == MSGPACK:
+        return MSGPACK
+    return JSON
+
+
+def iter_json(key, rows, spec, extra=None):
+    """
+    Yields {key: [rows...], **extra} as JSON, STREAM_CHUNK_ROWS rows per chunk.
+    rows can be any iterable, e.g. a result with yield_per, so it is never all in memory.
+    """
+    yield b'{' + dumps(key) + b':['
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(dumps(spec.dump(row)))
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            yield (b'' if first else b',') + b','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    tail = [b']']
+    for name, value in (extra or {}).items():
+        tail.append(b',' + dumps(name) + b':' + dumps(value))
+    tail.append(b'}')
+    yield b''.join(tail)
+
+
+def encode_list(key, rows, spec, mimetype, extra=None):
+    """
+    The whole body of a list response as bytes, for bodies that get cached.
+    """
+    if mimetype == MSGPACK:
+        return msgpack.packb({key: [spec.dump(row) for row in rows], **(extra or {})})
+    return b''.join(iter_json(key, rows, spec, extra))
+
+
+def render(payload, status=200):
+    """
+    A single object in the format the client asked for.
+    """
+    mimetype = response_type()
+    body = msgpack.packb(payload) if mimetype == MSGPACK else dumps(payload)
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+
+def render_list(key, rows, spec, extra=None, status=200):
+    """
+    {key: [rows...], **extra} in the format the client asked for. JSON is streamed as a
+    chunked response; MessagePack needs the array length up front, so it is packed whole.
+    """
+    mimetype = response_type()
+    if mimetype == MSGPACK:
+        body = encode_list(key, rows, spec, MSGPACK, extra)
+    else:
+        body = stream_with_context(iter_json(key, rows, spec, extra))
+    response = Response(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
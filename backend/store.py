@@ -1,7 +1,15 @@
 from flask import Blueprint, request, jsonify
 import uuid
-from models import Product, db, Store, Employee
+from datetime import date, datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from models import Product, ProductLot, db, Store, Employee, dialect_insert
 from functools import wraps
+from product_import import import_products, iter_rows
+from catalog_cache import catalog_response, bump_catalog_version, store_token
+from qr_functions import validate_tokens
+from serializers import PRODUCT, PRODUCT_LOT, EMPLOYEE, encode_list, render_list
+
+MAX_QR_BATCH = 500
 
 def store_employee_required(f):
     @wraps(f)
@@ -12,10 +20,11 @@ def store_employee_required(f):
             return jsonify({'error': 'missing authorization'}), 401
 
         token = auth.replace('Bearer ', '')
-        store_token = Store.query.filter_by(store_id=store_id).first().token
-        if not store_token or token != store_token:
-            return jsonify({'error': 'invalid token'}), 401
-        if token == store_token:
+        # Cached, so a conditional catalog GET can be answered without any query
+        expected = store_token(store_id, lambda: db.session.query(Store.token).filter_by(store_id=store_id).scalar())
+        if expected is None:
+            return jsonify({'error': 'store not found'}), 404
+        if token != expected:
             return jsonify({'error': 'invalid token'}), 401
 
         return f(*args, **kwargs)
@@ -33,8 +42,31 @@ store_bp = Blueprint('store', __name__)
 @store_bp.route('/<store_id>/products', methods=['GET'])
 @store_employee_required
 def list_products(store_id): # same as /products/store/<store_id>
-    products = Product.query.filter_by(store_id=store_id).all()
-    return jsonify({'products': [p.to_dict() for p in products]}), 200
+    # Not @read_only: the body is cached per catalog version, so it must be built from the primary,
+    # a lagging replica would pin an old catalog to the new version (and its ETag)
+    return catalog_response(store_id, lambda mimetype: build_catalog(store_id, mimetype))
+
+
+def build_catalog(store_id, mimetype):
+    # Plain column rows fetched in batches, encoded as they come, no ORM objects in between
+    rows = db.session.execute(
+        db.select(*PRODUCT.columns(Product)).filter_by(store_id=store_id).execution_options(yield_per=1000))
+    return encode_list('products', rows, PRODUCT, mimetype)
+
+@store_bp.route('/<store_id>/qr/validate', methods=['POST'])
+@store_employee_required
+def validate_qr_tokens(store_id):
+    """
+    Validates a batch of QR alpha tokens scanned at the POS: {"tokens": [...]}.
+    A token is valid once; presenting it again within its lifetime is rejected.
+    """
+    data = request.get_json(silent=True) or {}
+    tokens = data.get('tokens')
+    if not isinstance(tokens, list) or not tokens:
+        return jsonify({'error': 'tokens is required'}), 400
+    if len(tokens) > MAX_QR_BATCH:
+        return jsonify({'error': f'at most {MAX_QR_BATCH} tokens per request'}), 400
+    return jsonify({'results': validate_tokens(tokens, store_id=store_id)}), 200
 
 @store_bp.route('/<store_id>/employees', methods=['GET'])
 @store_employee_required
@@ -42,13 +74,34 @@ def display_employees(store_id):
     store = Store.query.filter_by(store_id=store_id).first()
     if not store:
         return jsonify({'error': 'store not found'}), 404
-    employees = Employee.query.filter_by(store_id=store_id).all()
-    return jsonify({'employees': [e.to_dict() for e in employees]}), 200
+    employees = Employee.query.filter_by(store_id=store_id).order_by(Employee.email)
+    return render_list('employees', employees, EMPLOYEE)
 
 @store_bp.route('/<store_id>/products', methods=['POST'])
 @store_employee_required
 def create_product(store_id): # needs to be adapted to what frontend can provide
-    data = request.get_json() or {}
+    """
+    Same rules as a bulk import row: product_name and a numeric price are required, and
+    best_before_date may be left out if default_shelf_life_days is given.
+    """
+    data = request.get_json(silent=True) or {}
+    if not data.get('product_name'):
+        return jsonify({'error': 'product_name is required'}), 400
+    try:
+        price = float(data.get('price'))
+        shelf_life = data.get('default_shelf_life_days')
+        shelf_life = int(shelf_life) if shelf_life not in (None, '') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'price and default_shelf_life_days must be numbers'}), 400
+    try:
+        if data.get('best_before_date'):
+            bbd = datetime.fromisoformat(data['best_before_date'])
+        elif shelf_life is not None:
+            bbd = datetime.utcnow() + timedelta(days=shelf_life)
+        else:
+            return jsonify({'error': 'best_before_date or default_shelf_life_days is required'}), 400
+    except (TypeError, ValueError):
+        return jsonify({'error': 'best_before_date must be YYYY-MM-DD'}), 400
     product_id = str(uuid.uuid4())
     product = {
         'product_id': product_id,
@@ -57,12 +110,33 @@ def create_product(store_id): # needs to be adapted to what frontend can provide
         'product_name': data.get('product_name'),
         'brand': data.get('brand'), 
          'category': data.get('category'),
-        'default_shelf_life_days': data.get('default_shelf_life_days')
+        'default_shelf_life_days': shelf_life,
+        'best_before_date': bbd,
+        'price': price,
     }
     db.session.add(Product(**product))
-    db.session.commit()
+    try:
+        bump_catalog_version(store_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'a product with this barcode already exists'}), 409
+    product['best_before_date'] = bbd.isoformat()
     return jsonify(product), 201
 
+@store_bp.route('/<store_id>/products/bulk', methods=['POST'])
+@store_employee_required
+def bulk_import_products(store_id):
+    """
+    Upserts products by barcode from an NDJSON (application/x-ndjson) or CSV (text/csv) body.
+    The body is streamed, so catalogs of any size can be sent in one request.
+    """
+    report = import_products(store_id, iter_rows(request.stream, request.content_type))
+    if report['upserted']:
+        bump_catalog_version(store_id)
+        db.session.commit()
+    return jsonify(report), 200
+
 @store_bp.route('/<store_id>/products/<product_id>', methods=['DELETE'])
 @store_employee_required
 def delete_product(store_id, product_id):
@@ -71,11 +145,51 @@ def delete_product(store_id, product_id):
         return jsonify({'error': 'not found'}), 404
     try:
         db.session.delete(product)
+        bump_catalog_version(store_id)
         db.session.commit()
         return jsonify({'status': 'deleted'}), 200
     except Exception as e:
         return jsonify({'error': 'failed', 'msg': str(e)}), 500
 
+@store_bp.route('/<store_id>/products/<product_id>/lots', methods=['GET'])
+@store_employee_required
+def list_lots(store_id, product_id):
+    lots = ProductLot.query.filter_by(store_id=store_id, product_id=product_id) \
+        .order_by(ProductLot.best_before_date, ProductLot.lot_id)
+    return render_list('lots', lots, PRODUCT_LOT)
+
+@store_bp.route('/<store_id>/products/<product_id>/lots', methods=['POST'])
+@store_employee_required
+def receive_lot(store_id, product_id):
+    """
+    Books a delivery: {"lot_number": ..., "best_before_date": "YYYY-MM-DD", "quantity": ...}.
+    Delivering a lot number again adds to its stock.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        lot_number = str(data['lot_number'])
+        best_before_date = date.fromisoformat(data['best_before_date'])
+        quantity = int(data['quantity'])
+        if quantity < 1:
+            raise ValueError
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'lot_number, best_before_date (YYYY-MM-DD) and a positive quantity are required'}), 400
+    if not Product.query.filter_by(store_id=store_id, product_id=product_id).first():
+        return jsonify({'error': 'not found'}), 404
+
+    statement = dialect_insert(ProductLot).values(
+        product_id=product_id, store_id=store_id, lot_number=lot_number,
+        best_before_date=best_before_date, quantity_available=quantity, qr_beta_data=data.get('qr_beta_data'),
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=['product_id', 'lot_number', 'store_id'],
+        set_={'quantity_available': ProductLot.quantity_available + statement.excluded.quantity_available},
+    )
+    db.session.execute(statement)
+    db.session.commit()
+    lot = ProductLot.query.filter_by(product_id=product_id, lot_number=lot_number, store_id=store_id).first()
+    return jsonify(lot.to_dict()), 201
+
 @store_bp.route('/<store_id>/employees/<employee_id>', methods=['DELETE'])
 @store_manager_required
 def delete_employee(store_id, employee_id):
@@ -0,0 +1,28 @@
+"""
+WSGI entry point for production servers, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`.
+Never resets the database; the schema is checked against schema_version instead.
+"""
+import os
+
+from app import create_app
+
+HEAVY_MODULES = ('stripe', 'weasyprint')
+
+
+def preload_heavy_modules():
+    """
+    Imports the lazily loaded dependencies up front. Called in the gunicorn master with
+    PRELOAD_HEAVY=1 so forked workers share those pages instead of each importing them.
+    """
+    import importlib
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+
+
+app = create_app(reset_db=False)
+
+if os.environ.get('PRELOAD_HEAVY') == '1':
+    preload_heavy_modules()